@@ -0,0 +1,82 @@
+"""
+Benchmarks for every differ in `diffing_server.DIFF_ROUTES`, run on each pair
+of pages in the corpus (see `corpus.py`).
+
+For each differ and pair, this records:
+
+- `time_diff`: wall time to decode and diff the pages.
+- `peakmem_diff`: peak memory (RSS) of the process while diffing.
+- `track_output_size`: size of the diff, as JSON, in bytes.
+
+`HtmlTokenPhases` also breaks down the time `html_token` spends in each phase
+of its work (parsing, tokenizing, matching, and serializing), with all three
+of its outputs requested.
+
+Run `asv continuous master HEAD` to compare with master, or pass `--bench`
+to run only some benchmarks, e.g. `--bench "html_token"`.
+"""
+import json
+from web_monitoring import diffing_server, metrics
+from .corpus import PAIRS, load_pair
+
+
+def _differs():
+    "Get the names of differs in DIFF_ROUTES, skipping deprecated synonyms."
+    names = []
+    seen = set()
+    for name, func in diffing_server.DIFF_ROUTES.items():
+        if func not in seen:
+            seen.add(func)
+            names.append(name)
+    return names
+
+
+def _response(url, body):
+    return diffing_server.MockResponse(
+        url, body, {'Content-Type': 'text/html; charset=UTF-8'})
+
+
+class DifferSuite:
+    params = (_differs(), list(PAIRS))
+    param_names = ('differ', 'pair')
+    # Some differs are very slow on large pages.
+    timeout = 600
+
+    def setup(self, differ, pair):
+        a_body, b_body = load_pair(pair)
+        self.func = diffing_server.DIFF_ROUTES[differ]
+        self.a = _response(f'http://example.com/{pair}/a', a_body)
+        self.b = _response(f'http://example.com/{pair}/b', b_body)
+
+    def diff(self):
+        return diffing_server.caller(self.func, self.a, self.b)
+
+    def time_diff(self, differ, pair):
+        self.diff()
+
+    def peakmem_diff(self, differ, pair):
+        self.diff()
+
+    def track_output_size(self, differ, pair):
+        return len(json.dumps(self.diff()))
+
+    track_output_size.unit = 'bytes'
+
+
+class HtmlTokenPhases:
+    params = (list(PAIRS), ['parse', 'tokenize', 'match', 'serialize'])
+    param_names = ('pair', 'phase')
+    timeout = 600
+
+    def setup(self, pair, phase):
+        a_body, b_body = load_pair(pair)
+        self.func = diffing_server.DIFF_ROUTES['html_token']
+        self.a = _response(f'http://example.com/{pair}/a', a_body)
+        self.b = _response(f'http://example.com/{pair}/b', b_body)
+
+    def track_phase_time(self, pair, phase):
+        _, phases = metrics.call_recording_phases(
+            diffing_server.caller, self.func, self.a, self.b, include='all')
+        return phases.get(phase, 0)
+
+    track_phase_time.unit = 'seconds'
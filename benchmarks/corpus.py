@@ -0,0 +1,100 @@
+"""
+Pairs of pages to run benchmarks on.
+
+Real pages come from the true- and false-positive examples in `archives/`.
+Synthetic pages are generated from a fixed seed, so they are the same on every
+run and for every commit being compared.
+"""
+from pathlib import Path
+import random
+
+
+ARCHIVES = Path(__file__).resolve().parent.parent / 'archives'
+
+# Names of the example pairs in `archives/`. Each has an `-a.html` and a
+# `-b.html` file.
+ARCHIVED_PAIRS = (
+    'falsepos-footer',
+    'falsepos-num-views',
+    'falsepos-small-changes',
+    'truepos-dataset-removal',
+    'truepos-image-removal',
+    'truepos-major-changes',
+)
+
+WORDS = ('climate', 'data', 'energy', 'agency', 'report', 'water', 'air',
+         'policy', 'research', 'public', 'health', 'program', 'national',
+         'environmental', 'protection', 'the', 'of', 'and', 'to', 'in')
+
+
+def _sentence(rng, length=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize()
+
+
+def _section(rng, index):
+    paragraphs = ''.join(f'<p>{_sentence(rng, 40)}.</p>\n' for _ in range(4))
+    links = ''.join(f'<li><a href="/page/{index}/{link}">{_sentence(rng, 4)}'
+                    f'</a></li>\n' for link in range(8))
+    rows = ''.join(f'<tr><td>{row}</td><td>{rng.randint(0, 10000)}</td>'
+                   f'<td>{_sentence(rng, 3)}</td></tr>\n' for row in range(6))
+    return (f'<section id="s{index}">\n'
+            f'<h2>{_sentence(rng, 5)}</h2>\n'
+            f'{paragraphs}'
+            f'<ul>{links}</ul>\n'
+            f'<table>{rows}</table>\n'
+            f'<img src="/images/{index}.png" alt="{_sentence(rng, 3)}">\n'
+            f'</section>\n')
+
+
+def synthetic_page(sections, seed=0):
+    "Generate a large HTML page with `sections` sections of mixed content."
+    rng = random.Random(seed)
+    body = ''.join(_section(rng, index) for index in range(sections))
+    return (f'<!doctype html>\n<html><head><title>Synthetic page</title>'
+            f'</head>\n<body>\n{body}</body></html>\n')
+
+
+def changed_page(html, fraction, seed=1):
+    """
+    Change some of a page's sections: remove some, replace the text in others
+    and add new ones, touching about `fraction` of them overall.
+    """
+    rng = random.Random(seed)
+    head, *sections = html.split('<section ')
+    changed = []
+    for index, section in enumerate(sections):
+        section = '<section ' + section
+        if rng.random() < fraction:
+            change = rng.choice(('remove', 'replace', 'add'))
+            if change == 'replace':
+                section = _section(rng, index)
+            elif change == 'add':
+                changed.append(_section(rng, len(sections) + index))
+            else:
+                section = ''
+        changed.append(section)
+    return head + ''.join(changed)
+
+
+def synthetic_pair(sections, fraction):
+    a = synthetic_page(sections)
+    return a.encode('utf-8'), changed_page(a, fraction).encode('utf-8')
+
+
+# Synthetic pairs, by name. Each item is a function that creates the pair.
+SYNTHETIC_PAIRS = {
+    # About 1 MB per page, with few changes (the common case).
+    'synthetic-large-few-changes': lambda: synthetic_pair(400, 0.02),
+    # About 1 MB per page, with many changes.
+    'synthetic-large-many-changes': lambda: synthetic_pair(400, 0.3),
+}
+
+PAIRS = ARCHIVED_PAIRS + tuple(SYNTHETIC_PAIRS)
+
+
+def load_pair(name):
+    "Get the `a` and `b` bodies (as bytes) of a named pair."
+    if name in SYNTHETIC_PAIRS:
+        return SYNTHETIC_PAIRS[name]()
+    return ((ARCHIVES / f'{name}-a.html').read_bytes(),
+            (ARCHIVES / f'{name}-b.html').read_bytes())
@@ -0,0 +1,254 @@
+"""
+Load test the diffing server to see how much concurrent work it sustains.
+
+This starts the server (from `diffing_server.make_app()`) in a separate
+process, serves the pages to diff from a local stand-in for upstream servers
+(so no network is needed), and sends diff requests at several levels of
+concurrency. For each level, it reports throughput, latency percentiles, and
+error rates for each differ.
+
+The server is configured with the usual environment variables, so, for
+example, to see how a different number of workers performs:
+
+    DIFFER_PARALLELISM=4 python -m benchmarks.load_test --mix html_token
+
+By default, the server's caches are turned off and every request diffs unique
+content (the stand-in adds a different comment to each page it serves), so
+results reflect the cost of actually diffing. Use `--cache` to measure with
+caching and with the same content requested repeatedly.
+"""
+import asyncio
+import itertools
+import json
+import multiprocessing
+import random
+import time
+from urllib.parse import urlencode
+from docopt import docopt
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+from .corpus import ARCHIVED_PAIRS, load_pair
+
+
+USAGE = """Load test the diffing server. Run with `python -m benchmarks.load_test`.
+
+Usage:
+  load_test [options]
+
+Options:
+  -h --help               Show this screen.
+  --mix <mix>             Differs to request, as comma-separated `name:weight`
+                          pairs (weights are optional). [default: html_token]
+  --pairs <names>         Comma-separated names of page pairs to diff (see
+                          `benchmarks/corpus.py`). Defaults to the pairs in
+                          `archives/`.
+  --concurrency <levels>  Comma-separated numbers of requests to have in
+                          progress at once. [default: 1,2,4,8,16]
+  --requests <count>      Number of requests to send at each concurrency
+                          level. [default: 100]
+  --timeout <seconds>     Time limit for each request. [default: 300]
+  --cache                 Keep the server's caches on and send the same
+                          content for every request of a given pair.
+  --seed <seed>           Seed for choosing differs and pairs. [default: 0]
+  --json                  Print results as JSON.
+"""
+
+
+def parse_mix(mix):
+    "Parse a `name:weight,name:weight` string to a dict of weights."
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition(':')
+        if name:
+            weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values, percent):
+    "Get a percentile of a sorted list of values, using the nearest rank."
+    if not values:
+        return None
+    rank = max(1, round(percent / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+class PageHandler(tornado.web.RequestHandler):
+    "Serves a page from the corpus at `/<pair>/<a or b>`."
+    def initialize(self, pages, unique):
+        self.pages = pages
+        self.unique = unique
+
+    def get(self, pair, side):
+        if pair not in self.pages:
+            self.pages[pair] = dict(zip('ab', load_pair(pair)))
+        body = self.pages[pair][side]
+        if self.unique:
+            body += f'\n<!-- {self.get_argument("n", "")} -->\n'.encode()
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        self.write(body)
+
+
+def make_upstream_app(unique):
+    return tornado.web.Application([
+        (r'/([\w-]+)/(a|b)', PageHandler, {'pages': {}, 'unique': unique}),
+    ])
+
+
+def _serve(port, cache):
+    "Run the diffing server. This is the target of the server process."
+    from web_monitoring.diffing_server import make_app
+
+    async def serve():
+        app = make_app()
+        if not cache:
+            app.settings['fetch_cache'] = None
+            app.settings['result_cache'] = None
+        app.listen(port, address='127.0.0.1')
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def wait_for_server(url, timeout=30):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.fetch(url)
+            return
+        except (OSError, tornado.httpclient.HTTPClientError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run_level(server, upstream, jobs, concurrency, timeout):
+    """
+    Send diff requests for a list of `(differ, pair)` jobs, with up to
+    `concurrency` requests in progress at once. Returns the total time taken
+    and a list of `(differ, status code, seconds)` for each request.
+    """
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True,
+                                                max_clients=concurrency)
+    queue = list(reversed(jobs))
+    results = []
+    counter = itertools.count()
+
+    async def work():
+        while queue:
+            differ, pair = queue.pop()
+            number = next(counter)
+            url = f'{server}/{differ}?' + urlencode({
+                'a': f'{upstream}/{pair}/a?n={number}',
+                'b': f'{upstream}/{pair}/b?n={number}'})
+            start = time.monotonic()
+            try:
+                response = await client.fetch(url, raise_error=False,
+                                              request_timeout=timeout)
+                code = response.code
+            except Exception:
+                code = 599
+            results.append((differ, code, time.monotonic() - start))
+
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(work() for _ in range(concurrency)))
+    finally:
+        client.close()
+    return time.monotonic() - start, results
+
+
+def summarize(duration, results):
+    "Get throughput, latency, and error stats for each differ and overall."
+    groups = {'all': results}
+    for result in results:
+        groups.setdefault(result[0], []).append(result)
+
+    summary = {}
+    for name, group in groups.items():
+        latencies = sorted(seconds for _, _, seconds in group)
+        errors = sum(1 for _, code, _ in group if code != 200)
+        summary[name] = {
+            'requests': len(group),
+            'throughput': len(group) / duration if duration else 0,
+            'error_rate': errors / len(group),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
+    return summary
+
+
+def format_report(levels):
+    lines = [f'{"concurrency":>11}  {"differ":<20} {"requests":>8} '
+             f'{"req/s":>8} {"errors":>7} {"p50":>8} {"p95":>8} {"p99":>8}']
+    for concurrency, summary in levels.items():
+        for name, stats in summary.items():
+            lines.append(f'{concurrency:>11}  {name:<20} '
+                         f'{stats["requests"]:>8} '
+                         f'{stats["throughput"]:>8.2f} '
+                         f'{stats["error_rate"]:>7.1%} '
+                         f'{stats["p50"]:>8.3f} '
+                         f'{stats["p95"]:>8.3f} '
+                         f'{stats["p99"]:>8.3f}')
+    return '\n'.join(lines)
+
+
+async def run(mix, pairs, levels, count, timeout, cache, seed):
+    upstream_socket, upstream_port = tornado.testing.bind_unused_port()
+    upstream_server = tornado.httpserver.HTTPServer(
+        make_upstream_app(unique=not cache))
+    upstream_server.add_sockets([upstream_socket])
+    upstream = f'http://127.0.0.1:{upstream_port}'
+
+    server_socket, server_port = tornado.testing.bind_unused_port()
+    server_socket.close()
+    server = f'http://127.0.0.1:{server_port}'
+    # Start a fresh interpreter rather than forking this one, which is in the
+    # middle of running an event loop. (Diff pools start their own processes,
+    # so this can't be a daemon.)
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=_serve, args=(server_port, cache))
+    process.start()
+    try:
+        await wait_for_server(f'{server}/healthcheck')
+        rng = random.Random(seed)
+        differs, weights = zip(*mix.items())
+        results = {}
+        for concurrency in levels:
+            jobs = [(differ, rng.choice(pairs))
+                    for differ in rng.choices(differs, weights, k=count)]
+            duration, responses = await run_level(server, upstream, jobs,
+                                                  concurrency, timeout)
+            results[concurrency] = summarize(duration, responses)
+        return results
+    finally:
+        process.terminate()
+        process.join()
+        upstream_server.stop()
+
+
+def main():
+    arguments = docopt(USAGE)
+    pairs = ARCHIVED_PAIRS
+    if arguments['--pairs']:
+        pairs = [name.strip() for name in arguments['--pairs'].split(',')]
+    results = asyncio.run(run(
+        mix=parse_mix(arguments['--mix']),
+        pairs=pairs,
+        levels=[int(level) for level in arguments['--concurrency'].split(',')],
+        count=int(arguments['--requests']),
+        timeout=float(arguments['--timeout']),
+        cache=arguments['--cache'],
+        seed=int(arguments['--seed'])))
+
+    if arguments['--json']:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_report(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,534 @@
+"""
+Size-aware caches used by the diffing server to avoid repeating expensive
+work, like fetching the same version of a page or diffing the same pair of
+versions over and over.
+
+Caches are made up of tiers: an in-memory `LruCache` that is bounded by the
+total size of the things it holds and, optionally, a `DiskCache` that stores
+bytes as files in a directory. `TieredCache` combines the two.
+
+Work that is still in progress can't be cached yet, so `Coalescer` lets
+concurrent requests for the same thing share a single result.
+"""
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+import time
+import tornado.httputil
+from .utils import hash_content
+
+
+logger = logging.getLogger(__name__)
+
+# Used to distinguish a cache miss from a cached value of `None`.
+MISSING = object()
+
+
+class LruCache:
+    """
+    An in-memory, least-recently-used cache that is bounded by the total size
+    of its values rather than by the number of entries.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum total size (as measured by `sizeof`) of all values in the
+        cache. Values larger than this are never stored.
+    sizeof : callable, optional
+        Function that returns the size of a value, usually in bytes.
+        Defaults to `len`.
+    """
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=None):
+        """
+        Add a value to the cache, evicting the least recently used values if
+        needed to make room. Returns `False` if the value was too large to
+        store.
+
+        If the size of the value is already known, it can be passed as
+        `size` instead of calculating it with `sizeof`.
+        """
+        self.remove(key)
+        if size is None:
+            size = self.sizeof(value)
+        if size > self.max_size:
+            return False
+
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+        return True
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size}
+
+
+class DiskCache:
+    """
+    A least-recently-used cache of bytes, stored as files in a directory.
+
+    Keys must be safe to use as file names (e.g. hex digests). Files are
+    sharded into subdirectories named for the first two characters of their
+    key. The modification time of a file is updated whenever it is read, so
+    the oldest files are evicted first when the cache grows too big.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory to store cached data in. It will be created if it does not
+        exist. Any files already in it count towards `max_size`.
+    max_size : int
+        Maximum number of bytes to store.
+    """
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = sum(file.stat().st_size for file in self._files())
+
+    def _files(self):
+        return (file for file in self.path.glob('*/*') if file.is_file())
+
+    def _path_for(self, key):
+        return self.path / key[:2] / key
+
+    def get(self, key, default=None):
+        path = self._path_for(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Write bytes to the cache, evicting the least recently used files if
+        needed to make room. Returns `False` if the data was too large to
+        store.
+        """
+        if len(data) > self.max_size:
+            return False
+
+        path = self._path_for(key)
+        path.parent.mkdir(exist_ok=True)
+        try:
+            self.size -= path.stat().st_size
+        except FileNotFoundError:
+            pass
+
+        # Write to a temporary file and move it into place so that readers
+        # (possibly in other processes) never see a partially written file.
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as file:
+            file.write(data)
+        os.replace(file.name, path)
+        self.size += len(data)
+
+        if self.size > self.max_size:
+            self._evict()
+
+        return True
+
+    def _evict(self):
+        # Listing the directory is relatively expensive, so clear out a little
+        # more than strictly necessary to avoid doing it on every write.
+        target_size = self.max_size * 0.9
+        files = sorted(((file.stat(), file) for file in self._files()),
+                       key=lambda item: item[0].st_mtime)
+        self.size = sum(stat.st_size for stat, _ in files)
+        for stat, file in files:
+            if self.size <= target_size:
+                break
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            self.size -= stat.st_size
+            self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': self.size,
+                'max_size': self.max_size}
+
+
+class TieredCache:
+    """
+    A cache with an in-memory tier and an optional on-disk tier. Values found
+    on disk are promoted to the memory tier when they are read.
+
+    Parameters
+    ----------
+    memory : LruCache
+    disk : DiskCache, optional
+    dumps : callable, optional
+        Convert a value to bytes for storage on disk. Required if `disk` is
+        set and values are not already bytes.
+    loads : callable, optional
+        Convert bytes from the disk tier back to a value.
+    """
+    def __init__(self, memory, disk=None, dumps=None, loads=None):
+        self.memory = memory
+        self.disk = disk
+        self.dumps = dumps or (lambda value: value)
+        self.loads = loads or (lambda data: data)
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, MISSING)
+        if value is MISSING and self.disk:
+            data = self.disk.get(key)
+            if data is not None:
+                try:
+                    value = self.loads(data)
+                except Exception as error:
+                    logger.warning(f'Could not load cached value for '
+                                   f'"{key}": {error}')
+                else:
+                    self.memory.put(key, value)
+
+        return default if value is MISSING else value
+
+    def put(self, key, value):
+        stored = self.memory.put(key, value)
+        if self.disk:
+            stored = self.disk.put(key, self.dumps(value)) or stored
+
+        return stored
+
+    @property
+    def evictions(self):
+        return self.memory.evictions + (self.disk and self.disk.evictions or 0)
+
+    def stats(self):
+        stats = {'memory': self.memory.stats()}
+        if self.disk:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+class CachedRequest:
+    "An HTTPRequest-like object for cached responses."
+    def __init__(self, url):
+        self.url = url
+
+
+class CachedResponse:
+    """
+    An HTTPResponse-like object for responses stored in a cache. In addition
+    to the usual attributes, it has a `content_hash` (the SHA-256 hash of its
+    body).
+    """
+    error = None
+
+    def __init__(self, url, body, headers, content_hash=None):
+        self.request = CachedRequest(url)
+        self.body = body
+        if not isinstance(headers, tornado.httputil.HTTPHeaders):
+            headers = tornado.httputil.HTTPHeaders(headers)
+        self.headers = headers
+        self.content_hash = content_hash or hash_content(body)
+
+    def for_url(self, url):
+        "Get a copy of this response, as if it were fetched from `url`."
+        if url == self.request.url:
+            return self
+        return CachedResponse(url, self.body, self.headers, self.content_hash)
+
+
+def _response_size(response):
+    return len(response.body)
+
+
+def _dump_response(response):
+    metadata = json.dumps({'url': response.request.url,
+                           'headers': list(response.headers.get_all())})
+    return metadata.encode('utf-8') + b'\n' + response.body
+
+
+def _load_response(data):
+    split_at = data.index(b'\n')
+    metadata = json.loads(data[:split_at])
+    headers = tornado.httputil.HTTPHeaders()
+    for name, value in metadata['headers']:
+        headers.add(name, value)
+    return CachedResponse(metadata['url'], data[split_at + 1:], headers)
+
+
+class FetchCache:
+    """
+    A content-addressed cache of fetched HTTP responses.
+
+    Response bodies are stored by their SHA-256 hash, so identical content
+    fetched from different URLs is only stored once and can be looked up by
+    hash alone. A small, in-memory index maps request keys (usually just the
+    URL) to the hash of the content last fetched for them. Content at a URL can
+    change, so index entries expire after `index_ttl` seconds, after which the
+    URL has to be fetched again unless the caller knows the hash it wants.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of bytes of response bodies to keep in memory.
+    directory : str or Path, optional
+        If set, also cache responses as files in this directory.
+    directory_max_size : int, optional
+        Maximum number of bytes to store in `directory`.
+    max_index_entries : int, optional
+        Maximum number of request keys to remember the content hashes of.
+    index_ttl : float, optional
+        Number of seconds to remember the content hash for a request key. If
+        `None`, entries are kept until they are evicted.
+    """
+    def __init__(self, max_size, directory=None, directory_max_size=None,
+                 max_index_entries=100_000, index_ttl=None):
+        disk = None
+        if directory:
+            disk = DiskCache(directory, directory_max_size or max_size)
+        self.content = TieredCache(LruCache(max_size, sizeof=_response_size),
+                                   disk,
+                                   dumps=_dump_response,
+                                   loads=_load_response)
+        self.index = LruCache(max_index_entries, sizeof=lambda value: 1)
+        self.index_ttl = index_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, content_hash=None, key=None):
+        """
+        Get a cached response for a URL, or `None` if there isn't one.
+
+        Parameters
+        ----------
+        url : str
+            The URL being requested.
+        content_hash : str, optional
+            The expected SHA-256 hash of the content. If set, any cached
+            response with this hash is returned, regardless of what URL it was
+            originally fetched from.
+        key : str, optional
+            Key to look the URL up by, if it should be something other than
+            the URL itself (e.g. if requests include headers that affect the
+            response). Only used if `content_hash` is not set and the key was
+            added less than `index_ttl` seconds ago.
+
+        Returns
+        -------
+        CachedResponse or None
+        """
+        if content_hash is None:
+            entry = self.index.get(key or url)
+            if entry is not None:
+                content_hash, expires = entry
+                if expires is not None and expires <= time.monotonic():
+                    self.index.remove(key or url)
+                    content_hash = None
+
+        response = None
+        if content_hash is not None:
+            response = self.content.get(content_hash)
+
+        if response is None:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return response.for_url(url)
+
+    def put(self, url, response, key=None):
+        """
+        Add a response to the cache.
+
+        Returns
+        -------
+        CachedResponse
+            A lightweight copy of `response` that can be used in its place.
+        """
+        cached = CachedResponse(url, response.body, response.headers,
+                                getattr(response, 'content_hash', None))
+        self.content.put(cached.content_hash, cached)
+        expires = None
+        if self.index_ttl is not None:
+            expires = time.monotonic() + self.index_ttl
+        self.index.put(key or url, (cached.content_hash, expires))
+        return cached
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.content.evictions,
+                **self.content.stats()}
+
+
+class ResultCache:
+    """
+    A cache of diff results. Results must be JSON-serializable dicts.
+
+    Since results can be big and are expensive to compute, this is primarily
+    useful when keyed by the hashes of the content that was diffed (rather
+    than by URL).
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum number of bytes of (JSON-encoded) results to keep in memory.
+    directory : str or Path, optional
+        If set, also cache results as files in this directory.
+    directory_max_size : int, optional
+        Maximum number of bytes to store in `directory`.
+    """
+    def __init__(self, max_size, directory=None, directory_max_size=None):
+        self.memory = LruCache(max_size)
+        self.disk = None
+        if directory:
+            self.disk = DiskCache(directory, directory_max_size or max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get a copy of a cached result, or `None` if there isn't one.
+        """
+        result = self.memory.get(key)
+        if result is None and self.disk:
+            data = self.disk.get(key)
+            if data is not None:
+                try:
+                    result = json.loads(data)
+                except ValueError as error:
+                    logger.warning(f'Could not load cached result for '
+                                   f'"{key}": {error}')
+                else:
+                    self.memory.put(key, result, size=len(data))
+
+        if result is None:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return dict(result)
+
+    def put(self, key, result):
+        data = json.dumps(result).encode('utf-8')
+        stored = self.memory.put(key, dict(result), size=len(data))
+        if self.disk:
+            stored = self.disk.put(key, data) or stored
+        return stored
+
+    @property
+    def evictions(self):
+        return self.memory.evictions + (self.disk and self.disk.evictions or 0)
+
+    def stats(self):
+        stats = {'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'memory': self.memory.stats()}
+        if self.disk:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+class Coalescer:
+    """
+    Coalesces concurrent calls for the same work (sometimes called
+    "single-flight"). While work for a given key is in progress, any other
+    calls to `run()` with the same key wait for and share its result (or
+    exception) instead of starting the work again.
+
+    Examples
+    --------
+    Only fetch a URL once, no matter how many concurrent callers want it:
+
+    >>> coalescer = Coalescer()
+    >>> async def fetch_once(url):
+    >>>     return await coalescer.run(url, lambda: client.fetch(url))
+    """
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    async def run(self, key, work):
+        """
+        Run some work or, if work with the same key is already in progress,
+        wait for its result.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the work. Calls with equal keys share results.
+        work : callable
+            A function that returns an awaitable. It is only called if there
+            is no work in progress for `key`.
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(work())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._done(key, future))
+        else:
+            self.coalesced += 1
+
+        # Shield the shared work so that one caller being cancelled (e.g.
+        # because its client disconnected) doesn't cancel it for the others.
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
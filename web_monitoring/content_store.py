@@ -0,0 +1,90 @@
+"""
+Look up content to diff by its hash in a local directory, instead of
+fetching it over HTTP.
+
+Content we diff is usually also stored in an object store, where each body is
+named by its SHA-256 hash (see `utils.hash_content`). When a mirror of that
+store is available on the same machine, the diffing server can read content
+from it directly, and only falls back to fetching a URL when the content
+isn't there.
+"""
+import mmap
+import os
+from pathlib import Path
+import re
+from .caching import CachedResponse
+from .utils import hash_content
+
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _read_mapped(path):
+    "Read a whole file through a memory map."
+    with open(path, 'rb') as file:
+        # Empty files can't be memory-mapped.
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data[:]
+
+
+class ContentStore:
+    """
+    A directory of files named for the SHA-256 hashes of their contents.
+    Files are sharded into subdirectories named for the first characters of
+    their hash, e.g. with a `depth` of 2, content with the hash `abcdef...`
+    is at `ab/cd/abcdef...`.
+
+    Parameters
+    ----------
+    path : str or Path
+        The directory content is stored in.
+    depth : int, optional
+        Number of levels of subdirectories, each named for the next two
+        characters of the hash.
+    verify : bool, optional
+        If true, check the hash of each file that is read, and ignore files
+        that don't match.
+    """
+    def __init__(self, path, depth=1, verify=False):
+        self.path = Path(path)
+        self.depth = depth
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+
+    def _path_for(self, content_hash):
+        shards = [content_hash[index * 2:index * 2 + 2]
+                  for index in range(self.depth)]
+        return self.path.joinpath(*shards, content_hash)
+
+    def get(self, url, content_hash):
+        """
+        Get the content with a given hash as an HTTPResponse-like object, as
+        if it were fetched from `url`. Returns `None` if the content isn't in
+        the store.
+        """
+        content_hash = content_hash.lower()
+        if not HASH_PATTERN.match(content_hash):
+            self.misses += 1
+            return None
+
+        try:
+            body = _read_mapped(self._path_for(content_hash))
+        except (FileNotFoundError, NotADirectoryError):
+            self.misses += 1
+            return None
+
+        if self.verify and hash_content(body) != content_hash:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # The store only holds bodies, so there are no headers. Differs sniff
+        # the content to determine its type and encoding.
+        return CachedResponse(url, body, {}, content_hash)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses}
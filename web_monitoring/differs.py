@@ -1,5 +1,7 @@
 from bs4 import Comment
+from contextlib import contextmanager
 from diff_match_patch import diff, diff_bytes
+from web_monitoring.metrics import phase
 from web_monitoring.utils import get_color_palette
 from htmldiffer.diff import HTMLDiffer
 import htmltreediff
@@ -27,12 +29,66 @@ def identical_bytes(a_body, b_body):
     return {'diff': a_body == b_body}
 
 
+# Parsed documents that can be shared between differs (see
+# `shared_parses()`), keyed by the HTML they were parsed from.
+_shared_documents = None
+
+
+@contextmanager
+def shared_parses():
+    """
+    A context manager in which calls to `parse_soup()` with the same HTML
+    share a single parsed document. Use this when running several differs
+    on the same content, so each document is only parsed once.
+    """
+    global _shared_documents
+    previous = _shared_documents
+    _shared_documents = {}
+    try:
+        yield
+    finally:
+        _shared_documents = previous
+
+
+def parse_soup(html):
+    """
+    Parse HTML into a BeautifulSoup document with comment nodes removed.
+
+    Inside a `shared_parses()` block, documents are shared between callers,
+    so callers must not modify them.
+
+    Parameters
+    ----------
+    html : string
+
+    Returns
+    -------
+    soup : bs4.BeautifulSoup
+    """
+    html = html.strip()
+    if _shared_documents is not None:
+        soup = _shared_documents.get(html)
+        if soup is not None:
+            return soup
+
+    with phase('parse'):
+        soup = html5_parser.parse(html, treebuilder='soup',
+                                  return_root=False)
+        # Remove comment nodes since they generally don't affect display.
+        # NOTE: This could affect display if the removed are conditional
+        # comments, but it's unclear how we'd meaningfully visualize those
+        # anyway.
+        [element.extract() for element in
+         soup.find_all(string=lambda text: isinstance(text, Comment))]
+
+    if _shared_documents is not None:
+        _shared_documents[html] = soup
+    return soup
+
+
 def _get_text(html):
     "Extract textual content from HTML."
-    soup = html5_parser.parse(html, treebuilder='soup', return_root=False)
-    [element.extract() for element in
-     soup.find_all(string=lambda text: isinstance(text, Comment))]
-    return soup.find_all(text=True)
+    return parse_soup(html).find_all(text=True)
 
 
 INVISIBLE_TAGS = set(['style', 'script', '[document]', 'head', 'title'])
@@ -62,10 +118,12 @@ def side_by_side_text(a_text, b_text):
 
 def compute_dmp_diff(a_text, b_text, timelimit=4):
     if (isinstance(a_text, str) and isinstance(b_text, str)):
-        changes = diff(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True, counts_only=False)
+        with phase('match'):
+            changes = diff(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True, counts_only=False)
     elif (isinstance(a_text, bytes) and isinstance(b_text, bytes)):
-        changes = diff_bytes(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True,
-                             counts_only=False)
+        with phase('match'):
+            changes = diff_bytes(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True,
+                                 counts_only=False)
     else:
         raise TypeError("Both the texts should be either of type 'str' or 'bytes'.")
 
@@ -1,23 +1,33 @@
 import asyncio
 import codecs
-import concurrent.futures
 from docopt import docopt
 import hashlib
 import inspect
 import functools
+import json
 import os
 import re
 import cchardet
 import sentry_sdk
 import tornado.httpclient
+import tornado.httputil
 import tornado.ioloop
+import tornado.log
 import tornado.web
+import time
 import traceback
 import web_monitoring
+from web_monitoring.caching import (CachedResponse, Coalescer, FetchCache,
+                                    ResultCache)
+from web_monitoring.content_store import ContentStore
+from web_monitoring.content_type import is_not_html
 import web_monitoring.differs
 from web_monitoring.diff_errors import UndiffableContentError, UndecodableContentError
+from web_monitoring.scheduling import (DiffPool, DiffScheduler,
+                                       DiffTimeoutError, PoolFullError)
 import web_monitoring.html_diff_render
 import web_monitoring.links_diff
+from web_monitoring import metrics, transfer, upstream
 
 # Track errors with Sentry.io. It will automatically detect the `SENTRY_DSN`
 # environment variable. If not set, all its methods will operate conveniently
@@ -27,7 +37,116 @@ sentry_sdk.init(ignore_errors=[KeyboardInterrupt])
 # by default. We don't really want those logs.
 sentry_sdk.integrations.logging.ignore_logger('tornado.access')
 
-DIFFER_PARALLELISM = os.environ.get('DIFFER_PARALLELISM', 10)
+DIFFER_PARALLELISM = int(os.environ.get('DIFFER_PARALLELISM', 10))
+
+# Maximum number of diffs that can wait for a worker process. When the queue
+# is full, new diffs get a 503 response with a `Retry-After` header.
+DIFFER_QUEUE_SIZE = int(os.environ.get('DIFFER_QUEUE_SIZE', 100))
+
+# Differs that are cheap enough to run directly in the server process instead
+# of in a worker process. (Comma-separated names from `DIFF_ROUTES`.)
+INLINE_DIFFERS = [name.strip() for name in
+                  os.environ.get('DIFFER_INLINE',
+                                 'length,identical_bytes').split(',')
+                  if name.strip()]
+
+# Maximum number of seconds a diff can run for before its worker process is
+# killed and the request fails with a 504 status. Set to 0 for no limit.
+DIFFER_TIMEOUT = float(os.environ.get('DIFFER_TIMEOUT', 120))
+
+# Time limits for specific differs, as comma-separated `name:seconds` pairs,
+# e.g. `html_tree:30,length:5`. Differs that aren't listed use DIFFER_TIMEOUT.
+DIFFER_TIMEOUTS = {
+    name.strip(): float(timeout)
+    for name, timeout in (item.split(':') for item in
+                          os.environ.get('DIFFER_TIMEOUTS', '').split(',')
+                          if item.strip())
+}
+
+# Additional worker pools, so slow differs can't starve others. This is a JSON
+# object mapping pool names to their configuration, e.g:
+#   {"slow": {"size": 2, "queue": 20, "differs": ["html_tree"]}}
+# Differs that aren't assigned to a pool use the default pool, which is
+# configured by DIFFER_PARALLELISM and DIFFER_QUEUE_SIZE.
+DIFFER_POOLS = json.loads(os.environ.get('DIFFER_POOLS') or '{}')
+
+# Priorities for differs waiting for a worker, as comma-separated
+# `name:priority` pairs, e.g. `html_text_dmp:-1,html_tree:5`. Lower numbers go
+# first; the default is 0.
+DIFFER_PRIORITIES = {
+    name.strip(): int(priority)
+    for name, priority in (item.split(':') for item in
+                           os.environ.get('DIFFER_PRIORITIES', '').split(',')
+                           if item.strip())
+}
+
+# Fetched content is cached (in memory and, optionally, on disk) so that
+# repeated diffs involving the same versions can skip the network entirely.
+# Set the size to 0 and leave the directory unset to disable caching.
+FETCH_CACHE_SIZE = int(os.environ.get('DIFFER_FETCH_CACHE_SIZE',
+                                      256 * 1024 * 1024))
+FETCH_CACHE_DIRECTORY = os.environ.get('DIFFER_FETCH_CACHE_DIRECTORY')
+FETCH_CACHE_DIRECTORY_SIZE = int(os.environ.get(
+    'DIFFER_FETCH_CACHE_DIRECTORY_SIZE', 2 * 1024 * 1024 * 1024))
+# Content at a URL can change, so a request without an `a_hash` or `b_hash`
+# only reuses the content cached for its URL for this many seconds. Set it to 0
+# to only reuse content when the request specifies its hash.
+FETCH_CACHE_INDEX_TTL = float(os.environ.get('DIFFER_FETCH_CACHE_INDEX_TTL',
+                                             300))
+
+# Diff results are cached by the hashes of the content being diffed, so a
+# second request for the same diff doesn't have to be recomputed. As above,
+# set the size to 0 and leave the directory unset to disable caching.
+RESULT_CACHE_SIZE = int(os.environ.get('DIFFER_RESULT_CACHE_SIZE',
+                                       128 * 1024 * 1024))
+RESULT_CACHE_DIRECTORY = os.environ.get('DIFFER_RESULT_CACHE_DIRECTORY')
+RESULT_CACHE_DIRECTORY_SIZE = int(os.environ.get(
+    'DIFFER_RESULT_CACHE_DIRECTORY_SIZE', 1024 * 1024 * 1024))
+
+# A local directory of content named by SHA-256 hash (e.g. a mirror of the
+# object store that versions are archived in). When a request includes the
+# `a_hash` or `b_hash` parameter, content is read from here if possible
+# instead of being fetched from its URL. Files are in subdirectories named for
+# the first two characters of their hash (or the next two, and so on, for
+# DIFFER_CONTENT_STORE_DEPTH levels). Set DIFFER_CONTENT_STORE_VERIFY to check
+# the hashes of files as they are read.
+CONTENT_STORE_DIRECTORY = os.environ.get('DIFFER_CONTENT_STORE')
+CONTENT_STORE_DEPTH = int(os.environ.get('DIFFER_CONTENT_STORE_DEPTH', 1))
+CONTENT_STORE_VERIFY = os.environ.get(
+    'DIFFER_CONTENT_STORE_VERIFY', 'False').strip().lower() == 'true'
+
+# Content and results at least this many bytes long are passed to and from
+# diff worker processes through memory-mapped temporary files instead of
+# being pickled through a pipe. Set to 0 to always use the pipe. Files are
+# stored in /dev/shm if it exists, or in DIFFER_TRANSFER_DIRECTORY if set.
+TRANSFER_THRESHOLD = int(os.environ.get('DIFFER_TRANSFER_THRESHOLD',
+                                        256 * 1024))
+TRANSFER_DIRECTORY = os.environ.get('DIFFER_TRANSFER_DIRECTORY')
+
+# Maximum size, in bytes, of content fetched for a diff. Fetching stops as
+# soon as a response grows past this, and the request fails with a 413
+# status. Set to 0 for no limit.
+MAX_BODY_SIZE = int(os.environ.get('DIFFER_MAX_BODY_SIZE', 50 * 1024 * 1024))
+
+# Settings for the HTTP client that fetches content from upstream servers.
+# See `upstream.UpstreamClient` for details. The `curl` backend (which reuses
+# connections and is required for HTTP/2) needs the `pycurl` package.
+UPSTREAM_BACKEND = os.environ.get('DIFFER_UPSTREAM_BACKEND', 'simple')
+UPSTREAM_HTTP2 = \
+    os.environ.get('DIFFER_UPSTREAM_HTTP2', 'False').strip().lower() == 'true'
+UPSTREAM_MAX_CLIENTS = int(os.environ.get('DIFFER_UPSTREAM_MAX_CLIENTS', 10))
+# Maximum requests to a single host at once. Set to 0 for no limit.
+UPSTREAM_MAX_PER_HOST = int(os.environ.get('DIFFER_UPSTREAM_MAX_PER_HOST', 0))
+# Number of seconds to cache DNS lookups for. Set to 0 to not cache them.
+UPSTREAM_DNS_CACHE_TTL = float(os.environ.get('DIFFER_UPSTREAM_DNS_CACHE_TTL',
+                                              300))
+UPSTREAM_CONNECT_TIMEOUT = float(
+    os.environ.get('DIFFER_UPSTREAM_CONNECT_TIMEOUT', 20))
+UPSTREAM_REQUEST_TIMEOUT = float(
+    os.environ.get('DIFFER_UPSTREAM_REQUEST_TIMEOUT', 20))
+
+# Maximum number of jobs from a single `/batch` request to work on at once.
+BATCH_CONCURRENCY = int(os.environ.get('DIFFER_BATCH_CONCURRENCY', 10))
 
 # Map tokens in the REST API to functions in modules.
 # The modules do not have to be part of the web_monitoring package.
@@ -54,6 +173,31 @@ DIFF_ROUTES = {
     "html_differ": web_monitoring.differs.html_differ,
 }
 
+REQUEST_COUNT = metrics.Counter(
+    'diff_requests_total',
+    'Number of requests handled, by differ and status code.',
+    labels=('differ', 'code'),
+    registry=metrics.REGISTRY)
+REQUEST_DURATION = metrics.Histogram(
+    'diff_request_duration_seconds',
+    'Time taken to handle requests, by differ.',
+    labels=('differ',),
+    registry=metrics.REGISTRY)
+PHASE_DURATION = metrics.Histogram(
+    'diff_phase_duration_seconds',
+    'Time spent in each phase of a diff: `fetch` (requesting content from '
+    'upstream), `queue` (waiting for a worker), `compute` (all the time '
+    'spent in a worker), `decode` (decoding content, including `encoding` '
+    'detection), and `diff` (running the differ, including `parse`, '
+    '`tokenize`, `match`, and `serialize` steps).',
+    labels=('phase',),
+    registry=metrics.REGISTRY)
+UPSTREAM_ERRORS = metrics.Counter(
+    'diff_upstream_errors_total',
+    'Number of failures fetching content to diff, by type.',
+    labels=('type',),
+    registry=metrics.REGISTRY)
+
 # Matches a <meta> tag in HTML used to specify the character encoding:
 # <meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">
 # <meta charset="utf-8" />
@@ -67,7 +211,15 @@ XML_PROLOG_PATTERN = re.compile(
     b'<?xml\\s[^>]*encoding=[\'"]([^\'"]+)[\'"].*\?>',
     re.IGNORECASE)
 
-client = tornado.httpclient.AsyncHTTPClient()
+client = upstream.UpstreamClient(
+    backend=UPSTREAM_BACKEND,
+    max_clients=UPSTREAM_MAX_CLIENTS,
+    max_per_host=UPSTREAM_MAX_PER_HOST,
+    http2=UPSTREAM_HTTP2,
+    dns_cache_ttl=UPSTREAM_DNS_CACHE_TTL,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    request_timeout=UPSTREAM_REQUEST_TIMEOUT,
+    max_body_size=MAX_BODY_SIZE)
 
 
 class MockRequest:
@@ -83,6 +235,117 @@ class MockResponse:
         self.headers = headers
         self.error = None
 
+
+class StreamedResponse:
+    """
+    Collects an HTTP response as it is streamed from an upstream server. Use
+    `on_header` and `on_chunk` as the `header_callback` and
+    `streaming_callback` of a request.
+
+    The body is hashed as it arrives, so it never needs to be hashed again,
+    and the response is abandoned as soon as it grows larger than `max_size`
+    or its first chunk shows it is not HTML. To abandon a response, the
+    callback raises a `PublicError` and stores it as `error`. (HTTP clients
+    generally report this as a closed connection, so check `error` when a
+    request fails.)
+
+    Parameters
+    ----------
+    url : str
+    max_size : int, optional
+        Maximum number of bytes in the body. If 0 or `None`, there's no limit.
+    content_type_options : str, optional
+        How to check that the response is HTML (see
+        `content_type.is_not_html()`). The default, `ignore`, doesn't check.
+    """
+    # Enough of the body to recognize any type in `NON_HTML_PATTERN`.
+    SNIFF_SIZE = 64
+
+    def __init__(self, url, max_size=None, content_type_options='ignore'):
+        self.url = url
+        self.max_size = max_size
+        self.content_type_options = content_type_options
+        self.headers = tornado.httputil.HTTPHeaders()
+        self.size = 0
+        self._chunks = []
+        self._hash = hashlib.sha256()
+        self._sniffed = content_type_options == 'ignore'
+        self.error = None
+
+    def on_header(self, line):
+        if line.startswith('HTTP/'):
+            # The start of a new response, e.g. after a `100 Continue`.
+            self.headers = tornado.httputil.HTTPHeaders()
+        elif line.strip():
+            self.headers.parse_line(line)
+        elif self.max_size:
+            # Stop before reading the body if it's declared to be too big.
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = 0
+            if length > self.max_size:
+                self._stop_for_size()
+
+    def _stop_for_size(self):
+        self._stop(PublicError(413,
+                               reason=(f'Content at "{self.url}" is larger '
+                                       f'than {self.max_size} bytes.'),
+                               extra={'type': 'CONTENT_TOO_LARGE',
+                                      'url': self.url,
+                                      'max_size': self.max_size}))
+
+    def on_chunk(self, chunk):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            self._stop_for_size()
+
+        if not self._sniffed:
+            start = chunk.lstrip()[:self.SNIFF_SIZE]
+            if start:
+                self._sniffed = True
+                # Latin-1 maps each byte to the code point with the same
+                # value, which is what `NON_HTML_PATTERN` expects.
+                if is_not_html(start.decode('latin-1'), self.headers,
+                               self.content_type_options):
+                    self._stop(PublicError(422,
+                                           reason=(f'Content at '
+                                                   f'"{self.url}" is not an '
+                                                   f'HTML document.'),
+                                           extra={'type': 'NOT_HTML',
+                                                  'url': self.url}))
+
+        self._hash.update(chunk)
+        self._chunks.append(chunk)
+
+    def response(self):
+        "Get the complete response as a `CachedResponse`."
+        return CachedResponse(self.url, b''.join(self._chunks), self.headers,
+                              self._hash.hexdigest())
+
+    def _stop(self, error):
+        UPSTREAM_ERRORS.inc(type=error.extra['type'])
+        self._chunks.clear()
+        self.error = error
+        raise error
+
+
+def _is_not_stopped_fetch(record):
+    """
+    Logging filter that drops errors raised by `StreamedResponse` to stop a
+    fetch. Tornado logs them as uncaught, even though they are handled.
+    """
+    error = record.exc_info and record.exc_info[1]
+    while error is not None:
+        if isinstance(error, PublicError):
+            return False
+        error = error.__context__
+    return True
+
+
+tornado.log.app_log.addFilter(_is_not_stopped_fetch)
+
+
 DEBUG_MODE = os.environ.get('DIFFING_SERVER_DEBUG', 'False').strip().lower() == 'true'
 
 VALIDATE_TARGET_CERTIFICATES = \
@@ -91,6 +354,28 @@ VALIDATE_TARGET_CERTIFICATES = \
 access_control_allow_origin_header = \
     os.environ.get('ACCESS_CONTROL_ALLOW_ORIGIN_HEADER')
 
+class PublicError(tornado.web.HTTPError):
+    """
+    An error whose message is safe to show to clients, e.g. because it was
+    caused by a bad request or by a problem with an upstream server.
+
+    Parameters
+    ----------
+    status_code : int
+        The HTTP status code to respond with.
+    reason : str
+        A description of the error.
+    extra : dict, optional
+        Additional data to include in the error response.
+    headers : dict, optional
+        Additional headers to include in the error response.
+    """
+    def __init__(self, status_code, reason, extra=None, headers=None):
+        super().__init__(status_code, reason=reason)
+        self.extra = extra or {}
+        self.headers = headers or {}
+
+
 class BaseHandler(tornado.web.RequestHandler):
 
     def set_default_headers(self):
@@ -125,6 +410,16 @@ class DiffHandler(BaseHandler):
                         self.request.arguments.items()}
         return query_params
 
+    # Name used for this handler's requests in metrics.
+    def metrics_name(self):
+        differ = self.path_args[0] if self.path_args else None
+        return differ if differ in self.differs else 'unknown'
+
+    def on_finish(self):
+        name = self.metrics_name()
+        REQUEST_COUNT.inc(differ=name, code=self.get_status())
+        REQUEST_DURATION.observe(self.request.request_time(), differ=name)
+
     # Compute our own ETag header values.
     def compute_etag(self):
         # We're not actually hashing content for this, since that is expensive.
@@ -148,61 +443,149 @@ class DiffHandler(BaseHandler):
             self.finish()
             return
 
+        query_params = dict(self.decode_query_params())
+        debug_timing = self.pop_debug_timing(query_params)
+        try:
+            res = await self.run_diff(differ, query_params,
+                                      self.fetch_diffable_content)
+        except PublicError as error:
+            self.send_public_error(error)
+            return
+
+        self.write_with_timing(res, debug_timing)
+
+    def prepare(self):
+        # Seconds spent in each phase of handling this request.
+        self.timings = {}
+
+    def add_timing(self, phase, seconds):
+        "Add time spent in a phase to the timings for this request."
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def pop_debug_timing(self, query_params):
+        """
+        Remove the `debug_timing` parameter (which shouldn't affect the diff)
+        from a dict of query parameters and return whether it was true.
+        """
+        return query_params.pop('debug_timing', '').lower() == 'true'
+
+    def write_with_timing(self, res, debug_timing=False):
+        """
+        Write a result and report the request's timings in the
+        `Server-Timing` header. If `debug_timing` is true, also add them
+        (in milliseconds) to the result as `timing`.
+        """
+        timings = {phase: seconds * 1000
+                   for phase, seconds in self.timings.items()}
+        timings['total'] = self.request.request_time() * 1000
+        self.set_header('Server-Timing', ', '.join(
+            f'{phase};dur={duration:.3f}'
+            for phase, duration in timings.items()))
+        if debug_timing:
+            res['timing'] = {phase: round(duration, 3)
+                             for phase, duration in timings.items()}
+        self.write(res)
+
+    async def run_diff(self, differ, query_params, fetch):
+        """
+        Fetch the content for a diff and run the differ on it. Raises
+        `PublicError` if the content could not be fetched.
+
+        Parameters
+        ----------
+        differ : str
+            Name of the differ to use.
+        query_params : dict
+            Parameters for the diff, including the `a` and `b` URLs. This
+            dictionary will be modified.
+        fetch : coroutine function
+            Used to fetch the content to diff. It has the same signature as
+            `fetch_diffable_content()`.
+        """
         # Find the diffing function registered with the name given by `differ`.
         try:
             func = self.differs[differ]
         except KeyError:
-            self.send_error(404,
-                            reason=f'Unknown diffing method: `{differ}`. '
-                                   f'You can get a list of '
-                                   f'supported differs from '
-                                   f'the `/` endpoint.')
-            return
+            raise PublicError(404,
+                              reason=f'Unknown diffing method: `{differ}`. '
+                                     f'You can get a list of '
+                                     f'supported differs from '
+                                     f'the `/` endpoint.')
+
+        content = await self.fetch_pair(query_params, fetch,
+                                        require_html=_requires_html(func))
+
+        # Differs are deterministic, so a diff of the same content with the
+        # same parameters can be served from the result cache.
+        diff_key = _diff_key(func, content[0], content[1], query_params)
+        result_cache = self.settings.get('result_cache')
+        res = result_cache and result_cache.get(diff_key)
+        if res is None:
+            async def compute_diff():
+                # Pass the bytes and any remaining args to the diffing function.
+                result = await self.diff(func, content[0], content[1],
+                                         query_params, differ=differ)
+                if result_cache and result is not None:
+                    result_cache.put(diff_key, result)
+                return result
+
+            # If the same diff is already in progress for another request,
+            # share its result instead of computing it again. (Copy it, since
+            # each request adds its own metadata.)
+            res = dict(await self.settings['coalescer'].run(
+                ('diff', diff_key), compute_diff))
+
+        res['version'] = web_monitoring.__version__
+        # Echo the client's request unless the differ func has specified
+        # somethine else.
+        res.setdefault('type', differ)
+        return res
 
-        query_params = self.decode_query_params()
+    async def fetch_pair(self, query_params, fetch, require_html=False):
+        """
+        Fetch the content for the `a` and `b` URLs in a set of query
+        parameters. The `a`, `b`, `a_hash`, and `b_hash` parameters are
+        removed from `query_params`. Returns a list of the two responses.
+        `require_html` is passed on to `fetch`.
+        """
         # The logic here is a bit tortured in order to allow one or both URLs
         # to be local files, while still optimizing the common case of two
         # remote URLs that we want to fetch in parallel.
         try:
             urls = {param: query_params.pop(param) for param in ('a', 'b')}
         except KeyError:
-            self.send_error(
+            raise PublicError(
                 400,
                 reason='Malformed request. '
                        'You must provide a URL as the value '
                        'for both `a` and `b` query parameters.')
-            return
 
-        # TODO: Add caching of fetched URIs.
-        requests = [self.fetch_diffable_content(url,
-                                                query_params.pop(f'{param}_hash', None),
-                                                query_params)
+        requests = [fetch(url,
+                          query_params.pop(f'{param}_hash', None),
+                          query_params,
+                          require_html=require_html)
                     for param, url in urls.items()]
+        start = time.monotonic()
         content = await asyncio.gather(*requests)
-        if not all(content):
-            return
+        self.add_timing('fetch', time.monotonic() - start)
+        return content
 
-        # Pass the bytes and any remaining args to the diffing function.
-        res = await self.diff(func, content[0], content[1], query_params)
-        res['version'] = web_monitoring.__version__
-        # Echo the client's request unless the differ func has specified
-        # somethine else.
-        res.setdefault('type', differ)
-        self.write(res)
-
-    async def fetch_diffable_content(self, url, expected_hash, query_params):
+    async def fetch_diffable_content(self, url, expected_hash, query_params,
+                                     require_html=False):
         """
-        Fetch and validate a content to diff from a given URL.
+        Fetch and validate a content to diff from a given URL. Raises
+        `PublicError` if the content could not be fetched or is not valid.
+        If `require_html` is true, fetching stops early if the content turns
+        out not to be HTML (according to the `content_type_options` query
+        parameter).
         """
         response = None
 
         # For testing convenience, support file:// URLs in development.
         if url.startswith('file://'):
             if os.environ.get('WEB_MONITORING_APP_ENV') == 'production':
-                self.send_error(
-                    403, reason=('Local files cannot be used in '
-                                 'production environment.'))
-                return None
+                raise PublicError(403, reason=('Local files cannot be used in '
+                                               'production environment.'))
             # FIXME: set content-type based on file extension.
             headers = {'Content-Type': 'application/html; charset=UTF-8'}
             with open(url[7:], 'rb') as f:
@@ -222,81 +605,175 @@ class DiffHandler(BaseHandler):
                     if header_value:
                         headers[header_key] = header_value
 
+            # Passed headers could change what the upstream server responds
+            # with, so they need to be part of the cache key.
+            cache = self.settings.get('fetch_cache')
+            cache_key = url
+            if headers:
+                cache_key = f'{url}\n{sorted(headers.items())}'
+            if cache:
+                response = cache.get(url, expected_hash, key=cache_key)
+
+            # Content with a known hash might be available locally.
+            store = self.settings.get('content_store')
+            if response is None and store and expected_hash:
+                response = store.get(url, expected_hash)
+
+            if response is None:
+                content_type_options = 'ignore'
+                if require_html:
+                    content_type_options = query_params.get(
+                        'content_type_options', 'normal')
+                response = await self.fetch_upstream(url, headers, cache_key,
+                                                     content_type_options)
+
+        if expected_hash:
+            actual_hash = _content_hash(response)
+            if actual_hash != expected_hash:
+                UPSTREAM_ERRORS.inc(type='HASH_MISMATCH')
+                raise PublicError(502,
+                                  reason=(f'Fetched content at "{url}" does '
+                                          f'not match hash "{expected_hash}".'),
+                                  extra={'type': 'HASH_MISMATCH',
+                                         'url': url,
+                                         'expected_hash': expected_hash,
+                                         'actual_hash': actual_hash})
+
+        return response
+
+    async def fetch_upstream(self, url, headers, key,
+                             content_type_options='ignore'):
+        """
+        Fetch a URL over HTTP, raising `PublicError` if the request failed,
+        the response was larger than `MAX_BODY_SIZE`, or it was not HTML
+        (checked according to `content_type_options`, which defaults to not
+        checking). Concurrent requests for the same `key` (usually the URL)
+        share a single upstream request.
+        """
+        cache = self.settings.get('fetch_cache')
+
+        async def fetch():
+            start = time.monotonic()
+            # Stream the body so it can be checked (and the request stopped)
+            # before all of a large or non-HTML response has been loaded.
+            stream = StreamedResponse(url, MAX_BODY_SIZE, content_type_options)
             try:
-                response = await client.fetch(url, headers=headers,
-                                              validate_cert=VALIDATE_TARGET_CERTIFICATES)
-            except ValueError as error:
-                self.send_error(400, reason=str(error))
-            except OSError as error:
-                self.send_error(502, reason=f'Could not fetch {url}: {error}')
-            except tornado.simple_httpclient.HTTPTimeoutError:
-                self.send_error(504, reason=f'Timed out while fetching "{url}"')
-            except tornado.httpclient.HTTPError as error:
+                await client.fetch(url, headers=headers,
+                                   validate_cert=VALIDATE_TARGET_CERTIFICATES,
+                                   header_callback=stream.on_header,
+                                   streaming_callback=stream.on_chunk)
+            except Exception as error:
+                if stream.error is not None:
+                    raise stream.error from None
                 # If the response is actually coming from a web archive,
                 # allow error codes. The Memento-Datetime header indicates
                 # the response is an archived one, and not an actual failure
                 # to respond with the desired content.
-                if error.response is not None and \
-                        error.response.headers.get('Memento-Datetime') is not None:
-                    response = error.response
-                else:
-                    self.send_error(502,
-                                    reason=f'Received a {error.response.code} '
-                                           f'status while fetching "{url}": '
-                                           f'{error}',
-                                    extra={'type': 'UPSTREAM_ERROR',
-                                           'url': url,
-                                           'upstream_code': error.response.code})
-
-        if response and expected_hash:
-            actual_hash = hashlib.sha256(response.body).hexdigest()
-            if actual_hash != expected_hash:
-                response = None
-                self.send_error(502,
-                                reason=(f'Fetched content at "{url}" does not '
-                                        f'match hash "{expected_hash}".'),
-                                extra={'type': 'HASH_MISMATCH',
-                                       'url': url,
-                                       'expected_hash': expected_hash,
-                                       'actual_hash': actual_hash})
+                if not isinstance(error, tornado.httpclient.HTTPError) or \
+                        error.response is None or \
+                        stream.headers.get('Memento-Datetime') is None:
+                    raise
+            finally:
+                PHASE_DURATION.observe(time.monotonic() - start,
+                                       phase='fetch')
+
+            response = stream.response()
+            if cache:
+                response = cache.put(url, response, key=key)
+            return response
 
-        return response
+        try:
+            return await self.settings['coalescer'].run(
+                ('fetch', key, content_type_options), fetch)
+        except ValueError as error:
+            UPSTREAM_ERRORS.inc(type='INVALID_URL')
+            raise PublicError(400, reason=str(error))
+        except OSError as error:
+            UPSTREAM_ERRORS.inc(type='CONNECTION_ERROR')
+            raise PublicError(502, reason=f'Could not fetch {url}: {error}')
+        except tornado.simple_httpclient.HTTPTimeoutError:
+            UPSTREAM_ERRORS.inc(type='TIMEOUT')
+            raise PublicError(504, reason=f'Timed out while fetching "{url}"')
+        except tornado.httpclient.HTTPError as error:
+            UPSTREAM_ERRORS.inc(type='UPSTREAM_ERROR')
+            raise PublicError(502,
+                              reason=f'Received a {error.code} '
+                                     f'status while fetching "{url}": '
+                                     f'{error}',
+                              extra={'type': 'UPSTREAM_ERROR',
+                                     'url': url,
+                                     'upstream_code': error.code})
+
+    async def diff(self, func, a, b, params, differ=None):
+        """
+        Actually do a diff between two pieces of content. `differ` is the
+        name the differ was requested by, which determines where it runs.
+        """
+        return await self.run_diff_task([differ],
+                                        functools.partial(caller, func),
+                                        a, b, params)
 
-    async def diff(self, func, a, b, params, tries=2):
+    async def run_diff_task(self, differs, worker, a, b, params):
         """
-        Actually do a diff between two pieces of content, optionally retrying
-        if the process pool that executes the diff breaks.
+        Call `worker(a, b, **params)` inline or in a worker process, as
+        determined by the diff scheduler for the named differs. Raises
+        `PublicError` if there is no room for the task in its worker pool.
         """
-        executor = self.get_diff_executor()
-        loop = asyncio.get_running_loop()
-        for attempt in range(tries):
+        scheduler = self.settings['diff_scheduler']
+        timings = {}
+        if scheduler.is_inline(differs):
+            result, phases = metrics.call_recording_phases(worker, a, b,
+                                                           **params)
+        else:
+            result, phases = await self._run_in_pool(scheduler, differs,
+                                                     worker, a, b, params,
+                                                     timings)
+
+        # The worker measures its own phases and sends them back.
+        timings.update(phases)
+        for phase, seconds in timings.items():
+            PHASE_DURATION.observe(seconds, phase=phase)
+            self.add_timing(phase, seconds)
+        return result
+
+    async def _run_in_pool(self, scheduler, differs, worker, a, b, params,
+                           timings):
+        with transfer.worker_responses((a, b), TRANSFER_THRESHOLD,
+                                       TRANSFER_DIRECTORY) as (a, b):
+            task = functools.partial(
+                transfer.run_and_share,
+                functools.partial(metrics.call_recording_phases, worker, a, b,
+                                  **params),
+                TRANSFER_THRESHOLD,
+                TRANSFER_DIRECTORY)
             try:
-                return await loop.run_in_executor(
-                    executor, functools.partial(caller, func, a, b, **params))
-            except concurrent.futures.process.BrokenProcessPool:
-                executor = self.get_diff_executor(reset=True)
-
-    # NOTE: this doesn't do anything async, but if we change it to do so, we
-    # need to add a lock (either asyncio.Lock or tornado.locks.Lock).
-    def get_diff_executor(self, reset=False):
-        executor = self.settings.get('diff_executor')
-        if reset or not executor:
-            if executor:
-                try:
-                    executor.shutdown(wait=False)
-                except Exception:
-                    pass
-            executor = concurrent.futures.ProcessPoolExecutor(
-                DIFFER_PARALLELISM)
-            self.settings['diff_executor'] = executor
-
-        return executor
+                return transfer.receive(
+                    await scheduler.run(differs, task, timings=timings))
+            except PoolFullError as error:
+                raise PublicError(503,
+                                  reason='The server is too busy to run '
+                                         'this diff right now.',
+                                  extra={'type': 'SERVER_BUSY',
+                                         'retry_after': error.retry_after},
+                                  headers={'Retry-After': error.retry_after})
+            except DiffTimeoutError as error:
+                raise PublicError(504,
+                                  reason=f'The diff did not finish within '
+                                         f'{error.timeout} seconds.',
+                                  extra={'type': 'DIFF_TIMEOUT'})
+
+    def send_public_error(self, error):
+        "Send an error response for a `PublicError`."
+        self.send_error(error.status_code, reason=error.reason,
+                        extra=error.extra, headers=error.headers)
 
     def write_error(self, status_code, **kwargs):
         response = {'code': status_code, 'error': self._reason}
         if 'extra' in kwargs:
             for key, value in kwargs['extra'].items():
                 response[key] = value
+        for name, value in kwargs.get('headers', {}).items():
+            self.set_header(name, value)
 
         # Handle errors that are allowed to be public
         # TODO: this error filtering should probably be in `send_error()`
@@ -335,6 +812,273 @@ class DiffHandler(BaseHandler):
         self.finish(response)
 
 
+class BatchDiffHandler(DiffHandler):
+    """
+    Run many diffs in one request. The request body should be a JSON list of
+    jobs, where each job is an object like:
+
+        {"differ": "html_token", "a": "<url>", "b": "<url>",
+         "params": {"include": "all", "a_hash": "<hash>"}}
+
+    (`params` is optional and takes the same values as the query parameters
+    for a single diff.)
+
+    If any job is malformed, the whole request fails with a 400 status.
+
+    Results are streamed back as newline-delimited JSON in the order they
+    finish. Each result has an `index` property that identifies the job it is
+    for. Failed jobs produce the same kind of object as a failed single diff,
+    e.g. `{"index": 2, "code": 502, "error": "..."}`, and do not affect the
+    other jobs in the batch.
+    """
+    SUPPORTED_METHODS = ('POST', 'OPTIONS')
+
+    def metrics_name(self):
+        return 'batch'
+
+    def set_default_headers(self):
+        super().set_default_headers()
+        if access_control_allow_origin_header is not None:
+            self.set_header('Access-Control-Allow-Headers',
+                            'x-requested-with, content-type')
+            self.set_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+
+    async def post(self):
+        try:
+            jobs = json.loads(self.request.body)
+            if not isinstance(jobs, list):
+                raise ValueError('Expected a list of jobs')
+            for index, job in enumerate(jobs):
+                _validate_batch_job(index, job)
+        except ValueError as error:
+            self.send_error(400, reason=f'Malformed request: {error}')
+            return
+
+        # Content for a version is often used in more than one job (e.g. as
+        # the `b` of one diff and the `a` of the next), so share fetches.
+        fetches = {}
+
+        def fetch(url, expected_hash, query_params, require_html=False):
+            key = (url, expected_hash, query_params.get('pass_headers'),
+                   require_html and query_params.get('content_type_options'))
+            if key not in fetches:
+                fetches[key] = asyncio.ensure_future(
+                    self.fetch_diffable_content(url, expected_hash,
+                                                query_params,
+                                                require_html=require_html))
+            return fetches[key]
+
+        # Limit how many jobs are in progress at once so a big batch doesn't
+        # flood upstream servers with requests.
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def run_job(index, job):
+            async with semaphore:
+                return await self.run_batch_job(index, job, fetch)
+
+        self.set_header('Content-Type', 'application/x-ndjson')
+        tasks = [run_job(index, job) for index, job in enumerate(jobs)]
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            self.write(json.dumps(result) + '\n')
+            await self.flush()
+
+        self.finish()
+
+    async def run_batch_job(self, index, job, fetch):
+        """
+        Run a single job from a batch, returning either its result or an
+        error object.
+        """
+        try:
+            query_params = {key: str(value) for key, value
+                            in job.get('params', {}).items()}
+            query_params['a'] = job['a']
+            query_params['b'] = job['b']
+
+            result = await self.run_diff(job['differ'], query_params, fetch)
+        except PublicError as error:
+            result = {'code': error.status_code,
+                      'error': error.reason,
+                      **error.extra}
+        except (UndiffableContentError, UndecodableContentError) as error:
+            result = {'code': 422, 'error': str(error)}
+        except Exception as error:
+            tornado.log.app_log.error(f'Error in batch job {index}',
+                                      exc_info=True)
+            message = 'Internal Server Error'
+            if self.settings.get('serve_traceback'):
+                message = str(error)
+            result = {'code': 500, 'error': message}
+
+        return {'index': index, **result}
+
+
+def _validate_batch_job(index, job):
+    """
+    Raise a `ValueError` describing what is wrong with a job from a batch
+    request (see `BatchDiffHandler`), if it isn't well-formed.
+    """
+    if not isinstance(job, dict):
+        raise ValueError(f'Job {index} must be an object')
+    for name in ('differ', 'a', 'b'):
+        if not isinstance(job.get(name), str):
+            raise ValueError(f'Job {index} must have a `{name}` string')
+    if not isinstance(job.get('params', {}), dict):
+        raise ValueError(f'The `params` of job {index} must be an object')
+
+
+class MultiDiffHandler(DiffHandler):
+    """
+    Run several differs on the same pair of documents, e.g.:
+
+        /multi?differs=html_token,links_json,html_text_dmp&a=<url>&b=<url>
+
+    The content is fetched and decoded once, and the differs all run in the
+    same worker process, where they share parsed HTML documents. Any other
+    query parameters are passed to every differ.
+
+    The response has a `results` object with the result of each differ,
+    keyed by name. If a differ can't handle the content, its result is an
+    error object, e.g. `{"code": 422, "error": "..."}`.
+    """
+
+    def metrics_name(self):
+        return 'multi'
+
+    async def get(self):
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        query_params = dict(self.decode_query_params())
+        debug_timing = self.pop_debug_timing(query_params)
+        try:
+            res = await self.run_multi_diff(query_params,
+                                            self.fetch_diffable_content)
+        except PublicError as error:
+            self.send_public_error(error)
+            return
+
+        self.write_with_timing(res, debug_timing)
+
+    async def run_multi_diff(self, query_params, fetch):
+        """
+        Fetch the content for a diff and run several differs on it. This
+        takes the same arguments as `DiffHandler.run_diff()`, except the
+        differs are named by the `differs` query parameter.
+        """
+        names = [name.strip() for name
+                 in query_params.pop('differs', '').split(',')
+                 if name.strip()]
+        if not names:
+            raise PublicError(400,
+                              reason='Malformed request. You must provide a '
+                                     'comma-separated list of differs as the '
+                                     'value for the `differs` query '
+                                     'parameter.')
+
+        funcs = {}
+        for name in names:
+            try:
+                funcs[name] = self.differs[name]
+            except KeyError:
+                raise PublicError(404,
+                                  reason=f'Unknown diffing method: `{name}`. '
+                                         f'You can get a list of '
+                                         f'supported differs from '
+                                         f'the `/` endpoint.')
+
+        # Only stop fetching non-HTML content early if none of the differs
+        # could use it.
+        a, b = await self.fetch_pair(
+            query_params, fetch,
+            require_html=all(map(_requires_html, funcs.values())))
+
+        result_cache = self.settings.get('result_cache')
+        keys = {name: _diff_key(func, a, b, query_params)
+                for name, func in funcs.items()}
+        results = {}
+        pending = {}
+        for name, func in funcs.items():
+            cached = result_cache and result_cache.get(keys[name])
+            if cached is None:
+                pending[name] = func
+            else:
+                cached.setdefault('type', name)
+                results[name] = cached
+
+        if pending:
+            async def compute_diffs():
+                computed = await self.run_diff_task(
+                    list(pending),
+                    functools.partial(multi_caller, pending),
+                    a, b, query_params)
+                # Key results by diff key rather than differ name: another
+                # request can share this work using a synonym for a differ.
+                computed = {keys[name]: result
+                            for name, result in computed.items()}
+                if result_cache:
+                    for key, result in computed.items():
+                        if isinstance(result, dict):
+                            result_cache.put(key, result)
+                return computed
+
+            diff_keys = tuple(sorted(keys[name] for name in pending))
+            computed = await self.settings['coalescer'].run(
+                ('multi', diff_keys), compute_diffs)
+            for name in pending:
+                result = computed[keys[name]]
+                if isinstance(result, Exception):
+                    results[name] = {'code': 422, 'error': str(result)}
+                else:
+                    results[name] = dict(result)
+                    results[name].setdefault('type', name)
+
+        return {'version': web_monitoring.__version__,
+                'type': 'multi',
+                'results': {name: results[name] for name in funcs}}
+
+
+def _content_hash(response):
+    "Get the SHA-256 hash of a response's body."
+    # Cached responses already know their hash.
+    return getattr(response, 'content_hash', None) \
+        or hashlib.sha256(response.body).hexdigest()
+
+
+def _requires_html(func):
+    """
+    Determine whether a differ only works on HTML content. Differs that do
+    check for HTML take a `content_type_options` parameter.
+    """
+    return 'content_type_options' in inspect.signature(func).parameters
+
+
+def _diff_key(func, a, b, query_params):
+    """
+    Create a key that identifies the result of diffing two responses, for
+    caching or sharing results. It depends on the differ, the content being
+    diffed (and the URLs it came from, if the differ uses them), and any other
+    query parameters.
+    """
+    parameters = inspect.signature(func).parameters
+    key_data = [
+        web_monitoring.__version__,
+        f'{func.__module__}.{func.__qualname__}',
+        [_content_hash(a), a.headers.get('Content-Type')],
+        [_content_hash(b), b.headers.get('Content-Type')],
+        sorted(query_params.items()),
+    ]
+    if 'a_url' in parameters or 'b_url' in parameters:
+        key_data.append([a.request.url, b.request.url])
+
+    return web_monitoring.utils.hash_content(
+        json.dumps(key_data).encode('utf-8'))
+
+
 def _extract_encoding(headers, content):
     encoding = None
     content_type = headers.get('Content-Type', '').lower()
@@ -377,7 +1121,8 @@ def _extract_encoding(headers, content):
 
 
 def _decode_body(response, name, raise_if_binary=True):
-    encoding = _extract_encoding(response.headers, response.body)
+    with metrics.phase('encoding'):
+        encoding = _extract_encoding(response.headers, response.body)
     text = response.body.decode(encoding, errors='replace')
     text_length = len(text)
     if text_length == 0:
@@ -434,14 +1179,13 @@ def caller(func, a, b, **query_params):
     sig = inspect.signature(func)
 
     raise_if_binary = not query_params.get('ignore_decoding_errors', False)
-    if 'a_text' in sig.parameters:
-        query_params.setdefault(
-            'a_text',
-            _decode_body(a, 'a', raise_if_binary=raise_if_binary))
-    if 'b_text' in sig.parameters:
-        query_params.setdefault(
-            'b_text',
-            _decode_body(b, 'b', raise_if_binary=raise_if_binary))
+    with metrics.phase('decode'):
+        if 'a_text' in sig.parameters and 'a_text' not in query_params:
+            query_params['a_text'] = _decode_body(
+                a, 'a', raise_if_binary=raise_if_binary)
+        if 'b_text' in sig.parameters and 'b_text' not in query_params:
+            query_params['b_text'] = _decode_body(
+                b, 'b', raise_if_binary=raise_if_binary)
 
     kwargs = dict()
     for name, param in sig.parameters.items():
@@ -453,7 +1197,53 @@ def caller(func, a, b, **query_params):
                 raise KeyError("{} requires a parameter {} which was not "
                                "provided in the query"
                                "".format(func.__name__, name))
-    return func(**kwargs)
+    with metrics.phase('diff'):
+        return func(**kwargs)
+
+
+def multi_caller(funcs, a, b, **query_params):
+    """
+    Run several differ functions on the same pair of HTTPResponses (see
+    `caller()`). The responses are only decoded once, and parsed HTML
+    documents are shared between the differs.
+
+    Parameters
+    ----------
+    funcs : dict
+        'differ' functions, keyed by name
+    a : tornado.httpclient.HTTPResponse
+    b : tornado.httpclient.HTTPResponse
+    **query_params
+        additional parameters parsed from the REST diffing request
+
+    Returns
+    -------
+    results : dict
+        The result of each differ, keyed by name. If a differ could not diff
+        or decode the content, its result is the `UndiffableContentError` or
+        `UndecodableContentError` it raised.
+    """
+    raise_if_binary = not query_params.get('ignore_decoding_errors', False)
+    results = {}
+    with web_monitoring.differs.shared_parses():
+        for name, func in funcs.items():
+            parameters = inspect.signature(func).parameters
+            try:
+                # Decode text the first time a differ needs it and pass the
+                # same text to all the others.
+                with metrics.phase('decode'):
+                    for param, response in (('a', a), ('b', b)):
+                        text_param = f'{param}_text'
+                        if text_param in parameters and \
+                                text_param not in query_params:
+                            query_params[text_param] = _decode_body(
+                                response, param,
+                                raise_if_binary=raise_if_binary)
+                results[name] = caller(func, a, b, **query_params)
+            except (UndiffableContentError, UndecodableContentError) as error:
+                results[name] = error
+
+    return results
 
 
 class IndexHandler(BaseHandler):
@@ -473,16 +1263,210 @@ class HealthCheckHandler(BaseHandler):
         self.write({})
 
 
+class MetricsHandler(BaseHandler):
+    """
+    Serves metrics about the server in the Prometheus text format.
+    """
+
+    async def get(self):
+        self.set_header('Content-Type',
+                        'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.REGISTRY.render())
+        self.write(collect_server_metrics(self.settings).render())
+
+
+def collect_server_metrics(settings):
+    """
+    Get a `metrics.Registry` with the current state of an application's diff
+    worker pools, caches, upstream requests, and in-flight work.
+    """
+    registry = metrics.Registry()
+
+    def gauge(name, description, labels=()):
+        return metrics.Gauge(name, description, labels, registry=registry)
+
+    def counter(name, description, labels=()):
+        return metrics.Counter(name, description, labels, registry=registry)
+
+    scheduler = settings.get('diff_scheduler')
+    if scheduler:
+        pool_metrics = {
+            'size': gauge('diff_pool_workers',
+                          'Number of worker processes in a pool.',
+                          ('pool',)),
+            'running': gauge('diff_pool_running',
+                             'Number of diffs running in a pool.',
+                             ('pool',)),
+            'queued': gauge('diff_pool_queued',
+                            'Number of diffs waiting for a worker.',
+                            ('pool',)),
+            'max_queue': gauge('diff_pool_max_queued',
+                               'Maximum number of diffs that can wait for '
+                               'a worker.',
+                               ('pool',)),
+            'completed': counter('diff_pool_tasks_total',
+                                 'Number of tasks that finished successfully '
+                                 'in a pool.',
+                                 ('pool',)),
+            'failed': counter('diff_pool_failures_total',
+                              'Number of tasks in a pool that raised an '
+                              'error, timed out, or whose worker died.',
+                              ('pool',)),
+            'rejected': counter('diff_pool_rejected_total',
+                                'Number of tasks rejected because a pool '
+                                'was full.',
+                                ('pool',)),
+            'timeouts': counter('diff_pool_timeouts_total',
+                                'Number of tasks stopped for running past '
+                                'their time limit.',
+                                ('pool',)),
+        }
+        for pool, stats in scheduler.stats().items():
+            for key, metric in pool_metrics.items():
+                metric.set(stats[key], pool=pool)
+
+    caches = {name: settings.get(f'{name}_cache')
+              for name in ('fetch', 'result')}
+    if any(caches.values()):
+        cache_metrics = {
+            'hits': counter('diff_cache_hits_total',
+                            'Number of cache hits.', ('cache',)),
+            'misses': counter('diff_cache_misses_total',
+                              'Number of cache misses.', ('cache',)),
+            'evictions': counter('diff_cache_evictions_total',
+                                 'Number of entries evicted from a cache.',
+                                 ('cache',)),
+        }
+        size = gauge('diff_cache_size_bytes',
+                     'Size of the data in a cache.', ('cache', 'tier'))
+        max_size = gauge('diff_cache_max_size_bytes',
+                         'Maximum size of the data in a cache.',
+                         ('cache', 'tier'))
+        for name, cache in caches.items():
+            if not cache:
+                continue
+            stats = cache.stats()
+            for key, metric in cache_metrics.items():
+                metric.set(stats[key], cache=name)
+            for tier in ('memory', 'disk'):
+                if tier in stats:
+                    size.set(stats[tier]['size'], cache=name, tier=tier)
+                    max_size.set(stats[tier]['max_size'], cache=name,
+                                 tier=tier)
+
+    if isinstance(client, upstream.UpstreamClient):
+        requests = gauge('diff_upstream_requests',
+                         'Number of requests to upstream servers that are in '
+                         'progress (`active`) or waiting because too many '
+                         'requests are going to the same host (`waiting`).',
+                         ('state',))
+        for state, count in client.stats().items():
+            requests.set(count, state=state)
+
+    store = settings.get('content_store')
+    if store:
+        stats = store.stats()
+        counter('diff_content_store_hits_total',
+                'Number of times content was found in the local content '
+                'store.').set(stats['hits'])
+        counter('diff_content_store_misses_total',
+                'Number of times content was not found in the local content '
+                'store.').set(stats['misses'])
+
+    coalescer = settings.get('coalescer')
+    if coalescer:
+        gauge('diff_in_flight',
+              'Number of fetches and diffs in progress.').set(len(coalescer))
+        counter('diff_coalesced_total',
+                'Number of requests that shared an in-progress fetch or '
+                'diff.').set(coalescer.coalesced)
+
+    return registry
+
+
+def make_fetch_cache():
+    """
+    Create a cache for fetched content based on the `DIFFER_FETCH_CACHE_*`
+    environment variables. Returns `None` if caching is disabled.
+    """
+    if FETCH_CACHE_SIZE <= 0 and not FETCH_CACHE_DIRECTORY:
+        return None
+    return FetchCache(FETCH_CACHE_SIZE,
+                      directory=FETCH_CACHE_DIRECTORY,
+                      directory_max_size=FETCH_CACHE_DIRECTORY_SIZE,
+                      index_ttl=FETCH_CACHE_INDEX_TTL)
+
+
+def make_result_cache():
+    """
+    Create a cache for diff results based on the `DIFFER_RESULT_CACHE_*`
+    environment variables. Returns `None` if caching is disabled.
+    """
+    if RESULT_CACHE_SIZE <= 0 and not RESULT_CACHE_DIRECTORY:
+        return None
+    return ResultCache(RESULT_CACHE_SIZE,
+                       directory=RESULT_CACHE_DIRECTORY,
+                       directory_max_size=RESULT_CACHE_DIRECTORY_SIZE)
+
+
+def make_content_store():
+    """
+    Create a local content store based on the `DIFFER_CONTENT_STORE*`
+    environment variables. Returns `None` if there's no store.
+    """
+    if not CONTENT_STORE_DIRECTORY:
+        return None
+    return ContentStore(CONTENT_STORE_DIRECTORY,
+                        depth=CONTENT_STORE_DEPTH,
+                        verify=CONTENT_STORE_VERIFY)
+
+
+def make_diff_scheduler():
+    """
+    Create a scheduler for diffs based on the `DIFFER_PARALLELISM`,
+    `DIFFER_QUEUE_SIZE`, `DIFFER_INLINE`, `DIFFER_POOLS`,
+    `DIFFER_PRIORITIES`, `DIFFER_TIMEOUT`, and `DIFFER_TIMEOUTS` environment
+    variables.
+    """
+    pools = {'default': DiffPool('default', DIFFER_PARALLELISM,
+                                 DIFFER_QUEUE_SIZE)}
+    routes = {}
+    for name, options in DIFFER_POOLS.items():
+        pools[name] = DiffPool(name,
+                               int(options.get('size', DIFFER_PARALLELISM)),
+                               int(options.get('queue', DIFFER_QUEUE_SIZE)))
+        for differ in options.get('differs', []):
+            routes[differ] = name
+
+    return DiffScheduler(pools, routes=routes, inline=INLINE_DIFFERS,
+                         priorities=DIFFER_PRIORITIES,
+                         # A time limit of 0 means no limit.
+                         timeouts={name: timeout or None for name, timeout
+                                   in DIFFER_TIMEOUTS.items()},
+                         default_timeout=DIFFER_TIMEOUT or None)
+
+
 def make_app():
     class BoundDiffHandler(DiffHandler):
         differs = DIFF_ROUTES
 
+    class BoundBatchDiffHandler(BatchDiffHandler):
+        differs = DIFF_ROUTES
+
+    class BoundMultiDiffHandler(MultiDiffHandler):
+        differs = DIFF_ROUTES
+
     return tornado.web.Application([
         (r"/healthcheck", HealthCheckHandler),
+        (r"/batch", BoundBatchDiffHandler),
+        (r"/multi", BoundMultiDiffHandler),
+        (r"/metrics", MetricsHandler),
         (r"/([A-Za-z0-9_]+)", BoundDiffHandler),
         (r"/", IndexHandler),
     ], debug=DEBUG_MODE, compress_response=True,
-       diff_executor=None)
+       diff_scheduler=make_diff_scheduler(), fetch_cache=make_fetch_cache(),
+       result_cache=make_result_cache(), content_store=make_content_store(),
+       coalescer=Coalescer())
 
 
 def start_app(port):
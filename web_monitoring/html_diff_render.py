@@ -14,19 +14,20 @@ For now, you can mentally divide this module into two sections:
    depends on some parts of the LXML module, but that could change. (The entry
    point for this is _htmldiff)
 """
-from bs4 import BeautifulSoup, Comment
+from array import array
 from collections import Counter, namedtuple
-from enum import Enum
 from functools import lru_cache
 import copy
-import difflib
 from web_monitoring.utils import get_color_palette
 import html
 import html5_parser
+import itertools
 import logging
 import re
 from .content_type import raise_if_not_diffable_html
 from .differs import compute_dmp_diff
+from .metrics import phase
+from .sequence_matching import MyersSequenceMatcher
 
 # Imports only used in forked tokenization code; may be ripe for removal:
 from lxml import etree
@@ -175,6 +176,9 @@ ACTIVE_ELEMENTS = ('script', 'style')
 SEPARATABLE_TAGS = set(['blockquote', 'section', 'article', 'header', 'footer',
                         'pre', 'ul', 'ol', 'li', 'table', 'p'])
 # SEPARATABLE_TAGS = block_level_tags
+# Tags are matched by prefix, so this includes some extras, like `<pre>` and
+# `<param>` for `p`.
+SEPARATABLE_TAG_STARTS = tuple(f'<{name}' for name in SEPARATABLE_TAGS)
 
 # A simplistic, empty HTML document to use in place of totally empty content
 EMPTY_HTML = '''<html>
@@ -185,7 +189,9 @@ EMPTY_HTML = '''<html>
 </html>'''
 
 # Maximum number of spacer tokens to add to a token stream for a document.
-# Adding too many can cause SequenceMatcher to choke.
+# Adding too many can cause SequenceMatcher to choke. This applies across all
+# the changed regions of a document, in order (unchanged regions don't get
+# tokenized, so they don't use any).
 MAX_SPACERS = 2500
 
 
@@ -199,13 +205,17 @@ class WaybackUrlComparator:
     matcher = re.compile(r'web/\d{14}(im_|js_|cs_)?/(https?://)?(www.)?')
 
     def compare(self, url_a, url_b):
-        match_a = self.matcher.search(url_a)
-        match_b = self.matcher.search(url_b)
-        if match_a and match_b:
-            url_a = url_a[match_a.end():]
-            url_b = url_b[match_b.end():]
-            return url_a == url_b
-        return url_a == url_b
+        return self.key(url_a) == self.key(url_b)
+
+    def key(self, url):
+        """
+        Get a value that is the same for all URLs this comparator considers
+        equivalent to `url`.
+        """
+        match = self.matcher.search(url)
+        if match:
+            return ('archived', url[match.end():])
+        return url
 
 
 class WaybackUkUrlComparator(WaybackUrlComparator):
@@ -231,9 +241,14 @@ class ServletSessionUrlComparator:
     matcher = re.compile(r';jsessionid=[^;]+')
 
     def compare(self, url_a, url_b):
-        match_a = self.matcher.sub('', url_a, count=1)
-        match_b = self.matcher.sub('', url_b, count=1)
-        return match_a == match_b
+        return self.key(url_a) == self.key(url_b)
+
+    def key(self, url):
+        """
+        Get a value that is the same for all URLs this comparator considers
+        equivalent to `url`.
+        """
+        return self.matcher.sub('', url, count=1)
 
 
 class CompoundComparator:
@@ -255,6 +270,13 @@ class CompoundComparator:
 
         return False
 
+    def keys(self, url):
+        """
+        Get the key for `url` from each comparator. Two URLs are equivalent
+        if any of their keys are the same.
+        """
+        return [comparator.key(url) for comparator in self.comparators]
+
 
 class UrlRules:
     """
@@ -371,51 +393,36 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
 
     comparator = UrlRules.get_comparator(url_rules)
 
-    soup_old = html5_parser.parse(a_text.strip() or EMPTY_HTML,
-                                  treebuilder='soup', return_root=False)
-    soup_new = html5_parser.parse(b_text.strip() or EMPTY_HTML,
-                                  treebuilder='soup', return_root=False)
-
-    # Remove comment nodes since they generally don't affect display.
-    # NOTE: This could affect display if the removed are conditional comments,
-    # but it's unclear how we'd meaningfully visualize those anyway.
-    [element.extract() for element in
-     soup_old.find_all(string=lambda text:isinstance(text, Comment))]
-    [element.extract() for element in
-     soup_new.find_all(string=lambda text:isinstance(text, Comment))]
-
-    soup_old = _cleanup_document_structure(soup_old)
-    soup_new = _cleanup_document_structure(soup_new)
+    with phase('parse'):
+        old_document = _parse_document(a_text.strip() or EMPTY_HTML)
+        new_document = _parse_document(b_text.strip() or EMPTY_HTML)
 
-    results, diff_bodies = diff_elements(soup_old.body, soup_new.body, comparator, include)
+    results, diff_bodies = diff_elements(old_document.find('body'),
+                                         new_document.find('body'),
+                                         comparator, include)
 
     for diff_type, diff_body in diff_bodies.items():
-        soup = None
-        if diff_type == 'deletions':
-            soup = copy.copy(soup_old)
-        elif diff_type == 'insertions':
-            soup = copy.copy(soup_new)
-        else:
-            soup = copy.copy(soup_new)
-            title_meta = soup.new_tag(
-                'meta',
-                content=_diff_title(soup_old, soup_new))
-            title_meta.attrs['name'] = 'wm-diff-title'
-            soup.head.append(title_meta)
-
-            old_head = soup.new_tag('template', id='wm-diff-old-head')
-            if soup_old.head:
-                for node in soup_old.head.contents.copy():
-                    old_head.append(copy.copy(node))
-            soup.head.append(old_head)
-
-        change_styles = soup.new_tag(
-            "style",
-            type="text/css",
-            id='wm-diff-style')
+        source = old_document if diff_type == 'deletions' else new_document
+        document = _copy_without_body(source)
+        if diff_type == 'combined':
+            head = document.find('head')
+            etree.SubElement(head, 'meta', {
+                'content': _diff_title(old_document, new_document),
+                'name': 'wm-diff-title'})
+
+            old_head = etree.SubElement(head, 'template',
+                                        {'id': 'wm-diff-old-head'})
+            source_head = old_document.find('head')
+            old_head.text = source_head.text
+            for node in source_head:
+                old_head.append(copy.deepcopy(node))
+
+        change_styles = etree.SubElement(document.find('head'), 'style', {
+            'type': 'text/css',
+            'id': 'wm-diff-style'})
 
         color_palette = get_color_palette()
-        change_styles.string = f'''
+        change_styles.text = f'''
             ins.wm-diff, ins.wm-diff > * {{background-color:
                 {color_palette['differ_insertion']} !important;
                 all: unset;}}
@@ -423,49 +430,89 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
                 {color_palette['differ_deletion']} !important;
                 all: unset;}}
             script {{display: none !important;}}'''
-        soup.head.append(change_styles)
-
-        soup.body.replace_with(diff_body)
-        # The method we use above to append HTML strings (the diffs) to the soup
-        # results in a non-navigable soup. So we serialize and re-parse :(
-        # (Note we use no formatter for this because proper encoding escapes
-        # the tags our differ generated.)
-        soup = html5_parser.parse(soup.prettify(formatter=None),
-                                  treebuilder='soup', return_root=False)
-        runtime_scripts = soup.new_tag('script', id='wm-diff-script')
-        runtime_scripts.string = UPDATE_CONTRAST_SCRIPT
-        soup.body.append(runtime_scripts)
+
+        _replace_element(document.find('body'), diff_body)
+        runtime_scripts = etree.SubElement(diff_body, 'script',
+                                           {'id': 'wm-diff-script'})
+        runtime_scripts.text = UPDATE_CONTRAST_SCRIPT
         if diff_type == 'combined':
-            _deactivate_deleted_active_elements(soup)
-        results[diff_type] = soup.prettify(formatter='minimal')
+            _deactivate_deleted_active_elements(document)
+        with phase('serialize'):
+            results[diff_type] = _serialize_document(
+                document, source.getroottree().docinfo.doctype)
 
     return results
 
 
-def _cleanup_document_structure(soup):
-    """Ensure a BeautifulSoup document has a <head> and <body>"""
-    if not soup.head:
-        head = soup.new_tag('head')
-        soup.html.insert(0, head)
-    if not soup.body:
-        body = soup.new_tag('body')
-        soup.html.append(body)
-    return soup
+def _parse_document(html):
+    """
+    Parse an HTML document into an lxml element for diffing. Comment nodes are
+    removed, and the document is guaranteed to have a `<head>` and `<body>`.
+    """
+    document = html5_parser.parse(html, treebuilder='lxml')
+    # Remove comment nodes since they generally don't affect display.
+    # NOTE: This could affect display if the removed are conditional
+    # comments, but it's unclear how we'd meaningfully visualize those
+    # anyway.
+    etree.strip_elements(document, etree.Comment, with_tail=False)
+    return _cleanup_document_structure(document)
+
+
+def _serialize_document(document, doctype=None):
+    "Serialize an lxml document to HTML, with a doctype if given."
+    html = etree.tostring(document, method='html', encoding=str)
+    if doctype:
+        html = f'{doctype}\n{html}'
+    return html
+
+
+def _replace_element(old, new):
+    "Replace an lxml element with another, keeping the text that follows it."
+    new.tail = old.tail
+    old.tail = None
+    old.getparent().replace(old, new)
 
 
-def _deactivate_deleted_active_elements(soup):
-    for element in soup.find_all(ACTIVE_ELEMENTS):
-        if element.find_parent('del'):
-            wrapper = soup.new_tag('template')
-            wrapper['class'] = 'wm-diff-deleted-inert'
-            element.wrap(wrapper)
+def _copy_without_body(document):
+    """
+    Copy an lxml document, but with an empty `<body>`. (Diffs replace the
+    body, so copying everything in it would be wasted work.)
+    """
+    body = document.find('body')
+    placeholder = etree.Element('body')
+    _replace_element(body, placeholder)
+    try:
+        return copy.deepcopy(document)
+    finally:
+        _replace_element(placeholder, body)
+
+
+def _cleanup_document_structure(document):
+    """Ensure an lxml document has a <head> and <body>"""
+    if document.find('head') is None:
+        document.insert(0, etree.Element('head'))
+    if document.find('body') is None:
+        document.append(etree.Element('body'))
+    return document
 
-    return soup
 
+def _deactivate_deleted_active_elements(document):
+    for element in list(document.iter(*ACTIVE_ELEMENTS)):
+        if next(element.iterancestors('del'), None) is not None:
+            wrapper = etree.Element('template',
+                                    {'class': 'wm-diff-deleted-inert'})
+            _replace_element(element, wrapper)
+            wrapper.append(element)
+
+    return document
 
-def get_title(soup):
-    "Get the title of a Beautiful Soup document."
-    return soup.title and soup.title.string or ''
+
+def get_title(document):
+    "Get the title of a Beautiful Soup document or an lxml element."
+    if etree.iselement(document):
+        title = document.find('.//title')
+        return title is not None and title.text or ''
+    return document.title and document.title.string or ''
 
 
 def _html_for_dmp_operation(operation):
@@ -482,96 +529,460 @@ def _html_for_dmp_operation(operation):
 def _diff_title(old, new):
     """
     Create an HTML diff (i.e. a string with `<ins>` and `<del>` tags) of the
-    title of two Beautiful Soup documents.
+    title of two documents.
     """
     diff = compute_dmp_diff(get_title(old), get_title(new))
     return ''.join(map(_html_for_dmp_operation, diff))
 
 
 def diff_elements(old, new, comparator, include='all'):
-    if not old:
-        old = BeautifulSoup().new_tag('div')
-    if not new:
-        new = BeautifulSoup().new_tag('div')
-
-    def fill_element(element, diff):
-        result_element = copy.copy(element)
-        result_element.clear()
-        result_element.append(diff)
+    """
+    Diff the contents of two lxml elements. Returns a tuple of the diff's
+    metadata and a dict of new elements (like `old` or `new`, but containing
+    the diff) for each type of diff in `include`.
+    """
+    if old is None:
+        old = etree.Element('div')
+    if new is None:
+        new = etree.Element('div')
+
+    def fill_element(element, parts):
+        # Make an empty copy of the element (copying the element itself would
+        # copy all its descendants, too, which we'd just throw away).
+        result_element = etree.Element(element.tag, dict(element.attrib))
+        with phase('parse'):
+            diff = _join_diff(parts, unchanged_runs)
+            fragment = _parse_fragment(diff)
+            at_end = bool(unchanged_runs) and diff.endswith(
+                _unchanged_placeholder(len(unchanged_runs) - 1))
+            if not _fill_unchanged(fragment, new, unchanged_runs, at_end):
+                fragment = _parse_fragment(
+                    _join_diff(parts, unchanged_runs, expand=True))
+        result_element.text = fragment.text
+        result_element.extend(fragment)
         return result_element
 
     results = {}
-    metadata, raw_diffs = _htmldiff(_diffable_fragment(old),
-                                    _diffable_fragment(new),
-                                    comparator,
-                                    include)
+    _remove_ins_and_del(old)
+    _remove_ins_and_del(new)
+    metadata, raw_diffs, unchanged_runs = _htmldiff(old, new, comparator,
+                                                    include)
 
-    for diff_type, diff in raw_diffs.items():
-        element = diff_type == 'deletions' and old or new
-        results[diff_type] = fill_element(element, diff)
+    for diff_type, parts in raw_diffs.items():
+        element = old if diff_type == 'deletions' else new
+        results[diff_type] = fill_element(element, parts)
 
     return metadata, results
 
 
-def _diffable_fragment(element):
+# Marks the placeholders for runs of unchanged elements in a diff (see
+# `_join_diff` and `_fill_unchanged`).
+UNCHANGED_ATTRIBUTE = 'data-wm-diff-unchanged'
+
+
+def _unchanged_placeholder(index):
+    return f'<template {UNCHANGED_ATTRIBUTE}="{index}"></template>'
+
+
+def _join_diff(parts, unchanged_runs, expand=False):
+    """
+    Join the parts of a diff from `_htmldiff` into an HTML string. Runs of
+    unchanged elements are included as placeholders (each preceded by a space;
+    see `_fill_unchanged`), or, if `expand` is true, as their actual HTML.
+    """
+    html = ''.join(
+        part if isinstance(part, str)
+        else _items_html(unchanged_runs[part]) if expand
+        else _unchanged_placeholder(part)
+        for part in parts)
+    html = html.strip().replace('</li> ', '</li>')
+    if not expand:
+        html = html.replace(f'<template {UNCHANGED_ATTRIBUTE}=',
+                            f' <template {UNCHANGED_ATTRIBUTE}=')
+    return html
+
+
+def _items_html(items):
+    "Serialize a list of text and lxml elements (with their tails) to HTML."
+    return ''.join(html_escape(item) if isinstance(item, str)
+                   else etree.tostring(item, method='html', encoding=str)
+                   for item in items)
+
+
+def _fill_unchanged(fragment, root, unchanged_runs, at_end=False):
+    """
+    Replace the placeholders in a parsed diff with copies of the runs of
+    unchanged elements they stand for, so the unchanged parts of a page don't
+    have to be parsed again for each type of diff. `root` is the element the
+    runs came from, and `at_end` says whether the diff ended with the last
+    run.
+
+    The copies should be the same as if the runs' HTML had been parsed in
+    place, which is only true if the placeholders were parsed into the same
+    context their elements came from. The space before each placeholder also
+    makes the parser reopen any formatting elements a changed region left
+    open, like the runs' text would. If a placeholder isn't right where its
+    elements came from, this returns `False` and the diff must be parsed with
+    the runs' HTML instead.
+    """
+    placeholders = [element for element in fragment.iter('template')
+                    if element.get(UNCHANGED_ATTRIBUTE) is not None]
+    # The page could have its own elements that look like placeholders.
+    if ([placeholder.get(UNCHANGED_ATTRIBUTE) for placeholder in placeholders]
+            != [str(index) for index in range(len(unchanged_runs))]):
+        return False
+
+    for placeholder, run in zip(placeholders, unchanged_runs):
+        if (_tag_path(placeholder.getparent(), fragment)
+                != _tag_path(run[0].getparent(), root)):
+            return False
+        previous = placeholder.getprevious()
+        if previous is None:
+            text = placeholder.getparent().text
+        else:
+            text = previous.tail
+        if not text or not text.endswith(' '):
+            return False
+
+    for placeholder in placeholders:
+        previous = placeholder.getprevious()
+        if previous is None:
+            placeholder.getparent().text = placeholder.getparent().text[:-1]
+        else:
+            previous.tail = previous.tail[:-1]
+
+    for index, (placeholder, run) in enumerate(zip(placeholders,
+                                                   unchanged_runs)):
+        copies = [copy.deepcopy(element) for element in run]
+        last = copies[-1]
+        last.tail = (last.tail or '') + (placeholder.tail or '')
+        if at_end and index == len(unchanged_runs) - 1:
+            last.tail = last.tail.rstrip()
+        # Match what `_join_diff` does to the HTML of everything else.
+        for element in copies:
+            for item in element.iter('li'):
+                if item.tail and item.tail.startswith(' '):
+                    item.tail = item.tail[1:]
+
+        parent = placeholder.getparent()
+        position = parent.index(placeholder)
+        parent[position:position + 1] = copies
+
+    return True
+
+
+def _tag_path(element, root):
+    "Get the tags of an element and its ancestors, up to (not including) root."
+    path = []
+    while element is not None and element is not root:
+        path.append(element.tag)
+        element = element.getparent()
+    return path
+
+
+def _parse_fragment(html):
+    """
+    Parse a fragment of HTML that belongs in a document's `<body>` (like the
+    output of `_join_diff`). Returns the `<body>` element it was parsed into.
+    """
+    document = html5_parser.parse(f'<body>{html}', treebuilder='lxml')
+    return document.find('body')
+
+
+def _remove_ins_and_del(element):
     """
-    Convert a beautiful soup element into an HTML fragment string with just the
-    element's *contents* that is ready for diffing.
+    Unwrap any `<ins>` and `<del>` elements in an lxml element, leaving their
+    contents in place.
     """
     # FIXME: we have to remove <ins> and <del> tags because *we* use them to
     # indicate changes that we find. We probably shouldn't do that:
     # https://github.com/edgi-govdata-archiving/web-monitoring-processing/issues/69#issuecomment-321424897
-    for edit_tag in element.find_all(_is_ins_or_del):
-        edit_tag.unwrap()
-    # Create a fragment string of just the element's contents
-    return ''.join(map(str, element.children))
-
+    etree.strip_tags(element, 'ins', 'del')
 
-def _is_ins_or_del(tag):
-    return tag.name == 'ins' or tag.name == 'del'
 
-
-# FIXME: this should take two BeautifulSoup elements to diff (since we've
-# already parsed and generated those), not two HTML fragment strings that have
-# to get parsed again.
 def _htmldiff(old, new, comparator, include='all'):
     """
     A slightly customized version of htmldiff that uses different tokens.
+
+    Parts of the documents that are exactly the same are copied to the
+    result as-is; only the regions that differ are tokenized and diffed (see
+    `_find_changed_regions`).
+
+    Returns a tuple of the diff's metadata, a dict of the parts of each type
+    of diff, and a list of runs of unchanged elements. Parts are strings of
+    HTML or, for unchanged elements, indexes into the list of runs (see
+    `_join_diff`).
     """
-    old_tokens = tokenize(old, comparator)
-    new_tokens = tokenize(new, comparator)
-    # old_tokens = [_customize_token(token) for token in old_tokens]
-    # new_tokens = [_customize_token(token) for token in new_tokens]
-    old_tokens = _limit_spacers(_customize_tokens(old_tokens), MAX_SPACERS)
-    new_tokens = _limit_spacers(_customize_tokens(new_tokens), MAX_SPACERS)
-    # result = htmldiff_tokens(old_tokens, new_tokens)
-    # result = diff_tokens(old_tokens, new_tokens) #, include='delete')
-    logger.debug('CUSTOMIZED!')
-
-    # HACK: The whole "spacer" token thing above in this code triggers the
-    # `autojunk` mechanism in SequenceMatcher, so we need to explicitly turn
-    # that off. That's probably not great, but I don't have a better approach.
-    matcher = InsensitiveSequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
-    # matcher = SequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
-    opcodes = matcher.get_opcodes()
+    diff_types = ['combined', 'insertions', 'deletions']
+    if include != 'all':
+        diff_types = [include]
+
+    with phase('tokenize'):
+        old_tree = old if etree.iselement(old) else parse_html(old)
+        new_tree = new if etree.iselement(new) else parse_html(new)
+        regions = list(_find_changed_regions(old_tree, new_tree))
+
+    opcodes = []
+    parts = {diff_type: [] for diff_type in diff_types}
+    unchanged_runs = []
+    old_spacers = new_spacers = MAX_SPACERS
+    for unchanged, old_items, new_items in regions:
+        if isinstance(unchanged, list):
+            # Runs of unchanged elements are left as placeholders, so they can
+            # be copied into each type of diff instead of serialized and
+            # parsed again (see `_fill_unchanged`).
+            if unchanged and isinstance(unchanged[0], str):
+                for diff_parts in parts.values():
+                    diff_parts.append(html_escape(unchanged[0]))
+                unchanged = unchanged[1:]
+            if unchanged:
+                for diff_parts in parts.values():
+                    diff_parts.append(len(unchanged_runs))
+                unchanged_runs.append(unchanged)
+            continue
+        elif unchanged is not None:
+            for diff_parts in parts.values():
+                diff_parts.append(unchanged)
+            continue
+
+        with phase('tokenize'):
+            old_tokens = _tokenize_items(old_items, comparator)
+            new_tokens = _tokenize_items(new_items, comparator)
+            old_tokens, old_spacers = _limit_spacers(
+                _customize_tokens(old_tokens), old_spacers)
+            new_tokens, new_spacers = _limit_spacers(
+                _customize_tokens(new_tokens), new_spacers)
+
+        with phase('match'):
+            old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+            matcher = InsensitiveSequenceMatcher(a=old_ids, b=new_ids)
+            region_opcodes = matcher.get_opcodes()
+        opcodes.extend(region_opcodes)
+
+        region_diffs = assemble_diffs(old_tokens, new_tokens, region_opcodes,
+                                      diff_types)
+        for diff_type, diff_parts in parts.items():
+            diff_parts.extend(region_diffs[diff_type])
 
     metadata = _count_changes(opcodes)
-    diffs = {}
+    return metadata, parts, unchanged_runs
 
-    def render_diff(diff_type):
-        diff = assemble_diff(old_tokens, new_tokens, opcodes, diff_type)
-        # return fixup_ins_del_tags(''.join(diff).strip())
-        result = ''.join(diff).strip().replace('</li> ', '</li>')
-        return result
 
-    if include == 'all' or include == 'combined':
-        diffs['combined'] = render_diff('combined')
-    if include == 'all' or include == 'insertions':
-        diffs['insertions'] = render_diff('insertions')
-    if include == 'all' or include == 'deletions':
-        diffs['deletions'] = render_diff('deletions')
+def _find_changed_regions(old, new, subtree_ids=None):
+    """
+    Split the contents of two lxml elements into regions that are the same in
+    both and regions that need diffing, so unchanged parts of a page can skip
+    the expensive tokenizing and matching steps.
+
+    Block-level children are compared by their contents (including their
+    tails; see `_identify_subtrees`), and are paired up with a sequence diff.
+    Runs of identical children are unchanged; the runs of children between
+    them are changed.
+    When a changed run is just one element on each side with the same start
+    tag and tail (e.g. a `<main>` or wrapper `<div>` that has changes inside
+    it), this continues into its children, so the changed regions are as
+    small as possible.
+
+    Yields tuples of `(unchanged, old_items, new_items)`. For unchanged
+    regions, the items are `None` and `unchanged` is either a string of HTML
+    (the start or end tag of an element whose children are diffed) or a list
+    of unchanged text and child elements from `new`. For changed regions,
+    `unchanged` is `None` and the items are lists of text (the element's text
+    before its first child) and child elements to diff with
+    `_tokenize_items`.
+    """
+    if subtree_ids is None:
+        subtree_ids = _identify_subtrees(old, new)
+    old_items = [old.text or '', *old]
+    new_items = [new.text or '', *new]
+    keys = {}
+
+    def item_ids(items):
+        ids = array('i')
+        for item in items:
+            if isinstance(item, str):
+                key = ('text', item)
+            elif _is_block(item):
+                key = ('element', subtree_ids[item])
+            else:
+                # Only block-level elements are paired; everything else is
+                # diffed with whatever is around it.
+                key = ('unique', len(keys))
+            ids.append(keys.setdefault(key, len(keys)))
+        return ids
+
+    matcher = MyersSequenceMatcher(item_ids(old_items), item_ids(new_items))
+    for command, i1, i2, j1, j2 in matcher.get_opcodes():
+        if command == 'equal':
+            yield new_items[j1:j2], None, None
+            continue
+
+        old_run = [item for item in old_items[i1:i2] if item != '']
+        new_run = [item for item in new_items[j1:j2] if item != '']
+        if (len(old_run) == 1 and len(new_run) == 1
+                and _can_diff_inside(old_run[0], new_run[0])):
+            element = new_run[0]
+            yield start_tag(element), None, None
+            yield from _find_changed_regions(old_run[0], element,
+                                             subtree_ids)
+            end_tag = f'</{element.tag}>{html_escape(element.tail or "")}'
+            yield end_tag, None, None
+        elif old_run or new_run:
+            yield None, old_run, new_run
+
+
+def _identify_subtrees(*roots):
+    """
+    Give every element in the trees under `roots` an integer ID, where
+    elements have the same ID if they and everything in them (including
+    their tails) are the same. Returns a dict of IDs, keyed by element.
+
+    IDs are assigned bottom-up, so each element is only looked at once,
+    rather than once for each of its ancestors.
+    """
+    keys = {}
+    ids = {}
+    for root in roots:
+        # Children come after their parents in `iter()`, so reversing it
+        # visits them first.
+        for element in reversed(list(root.iter())):
+            key = (element.tag, tuple(element.items()), element.text,
+                   element.tail, tuple(ids[child] for child in element))
+            ids[element] = keys.setdefault(key, len(keys))
+    return ids
+
+
+def _can_diff_inside(old, new):
+    """
+    Determine whether the contents of two elements can be diffed separately
+    from their surroundings.
+    """
+    return (not isinstance(old, str) and not isinstance(new, str)
+            and _is_block(old)
+            and old.tag not in void_tags
+            and start_tag(old) == start_tag(new)
+            and (old.tail or '') == (new.tail or ''))
+
+
+def _is_block(element):
+    return element.tag in block_level_tags or element.tag in ('head', 'body')
+
+
+def _intern_tokens(old_tokens, new_tokens):
+    """
+    Map each token to an integer ID, where tokens have the same ID only if
+    they are equal, so they can be matched by comparing integers instead of
+    calling the tokens' `__eq__` methods (which, for links and images, call
+    into URL comparators). Returns a sequence of IDs for each list of tokens.
+
+    Links and images are equal when any of their comparators' keys for any of
+    their URLs are the same. That isn't transitive -- A can match B and B can
+    match C while A doesn't match C -- so they can't always be given IDs.
+    Links and images whose keys are connected are grouped together (see
+    `_group_overlapping_sets`). If every token in a group shares a key, they
+    are all equal and get the same ID. Otherwise, they are wrapped in
+    `_UninternedToken`, which falls back to comparing with `__eq__`.
+    """
+    def url_keys(kind, urls, comparator):
+        keys = set()
+        for url in urls:
+            if comparator:
+                for index, key in enumerate(comparator.keys(url)):
+                    keys.add((kind, index, key))
+            else:
+                keys.add((kind, url))
+        return frozenset(keys)
+
+    def token_key(token):
+        if isinstance(token, href_token):
+            return url_keys('href', [str(token)], token.comparator)
+        elif isinstance(token, ImgTagToken):
+            return url_keys('img', token.data, token.comparator)
+        else:
+            return str(token)
+
+    old_keys = [token_key(token) for token in old_tokens]
+    new_keys = [token_key(token) for token in new_tokens]
+    groups = _group_overlapping_sets(
+        key for key in itertools.chain(old_keys, new_keys)
+        if isinstance(key, frozenset))
+
+    ids = {}
+
+    def token_id(token, key):
+        if isinstance(key, frozenset):
+            if not key:
+                # A token with no keys is not equal to anything, not even
+                # itself.
+                return ids.setdefault(object(), len(ids))
+            group, shares_key = groups[key]
+            if not shares_key:
+                return _UninternedToken(token, group)
+            key = ('group', group)
+        return ids.setdefault(key, len(ids))
+
+    old_ids = list(map(token_id, old_tokens, old_keys))
+    new_ids = list(map(token_id, new_tokens, new_keys))
+    if all(shares_key for _, shares_key in groups.values()):
+        return array('i', old_ids), array('i', new_ids)
+    return old_ids, new_ids
+
+
+def _group_overlapping_sets(sets):
+    """
+    Group sets that are connected by having items in common, either directly
+    or through other sets. Returns a dict keyed by set, where each value is a
+    tuple of the group's number and whether every set in the group has an item
+    in common.
+    """
+    # Union-find of items. Each item's parent is another item in its group.
+    parents = {}
+
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    unique_sets = list(dict.fromkeys(items for items in sets if items))
+    for items in unique_sets:
+        root = None
+        for item in items:
+            parents.setdefault(item, item)
+            if root is None:
+                root = find(item)
+            else:
+                parents[find(item)] = root
+
+    roots = [find(next(iter(items))) for items in unique_sets]
+    common_items = {}
+    for root, items in zip(roots, unique_sets):
+        common_items[root] = common_items.get(root, items) & items
+    numbers = {root: number for number, root in enumerate(common_items)}
+    return {items: (numbers[root], bool(common_items[root]))
+            for root, items in zip(roots, unique_sets)}
+
+
+class _UninternedToken:
+    """
+    Stands in for a link or image token in `_intern_tokens` when it can't be
+    given an ID, comparing with the token's own `__eq__`. Tokens that might be
+    equal are always in the same group, so the group number is the hash.
+    """
+
+    __slots__ = ('token', 'group')
+
+    def __init__(self, token, group):
+        self.token = token
+        self.group = group
+
+    def __eq__(self, other):
+        if isinstance(other, _UninternedToken):
+            return self.token == other.token
+        return False
 
-    return metadata, diffs
+    def __hash__(self):
+        return hash(self.group)
 
 
 # FIXME: this is utterly ridiculous -- the crazy spacer token solution we came
@@ -580,6 +991,10 @@ def _htmldiff(old, new, comparator, include='all'):
 # really re-examine the whole spacer token concept now that we control the
 # tokenization phase, though.
 def _limit_spacers(tokens, max_spacers):
+    """
+    Remove spacer tokens after the first `max_spacers` of them. Returns the
+    remaining tokens and the number of spacers that could still be added.
+    """
     limited_tokens = []
     for token in tokens:
         if isinstance(token, SpacerToken):
@@ -588,7 +1003,7 @@ def _limit_spacers(tokens, max_spacers):
             max_spacers -= 1
         limited_tokens.append(token)
 
-    return limited_tokens
+    return limited_tokens, max_spacers
 
 
 def _count_changes(opcodes):
@@ -620,7 +1035,7 @@ def expand_tokens(tokens, equal=False):
             yield post
 
 
-class DiffToken(str):
+class DiffToken:
     """ Represents a diffable token, generally a word that is displayed to
     the user.  Opening tags are attached to this token when they are
     adjacent (pre_tags) and closing tags that follow the word
@@ -631,35 +1046,56 @@ class DiffToken(str):
     We also keep track of whether the word was originally followed by
     whitespace, even though we do not want to treat the word as
     equivalent to a similar word that does not have a trailing
-    space."""
+    space.
+
+    Tokens compare and hash like their text, as if they were strings. (They
+    used to be `str` subclasses, but a page can have hundreds of thousands of
+    tokens, and a `str` subclass can't use `__slots__`, so each one needed
+    its own `__dict__`.)"""
+
+    __slots__ = ('text', 'pre_tags', 'post_tags', 'trailing_whitespace')
 
     # When this is true, the token will be eliminated from the
     # displayed diff if no change has occurred:
     hide_when_equal = False
 
-    def __new__(cls, text, pre_tags=None, post_tags=None, trailing_whitespace=""):
-        obj = str.__new__(cls, text)
+    def __init__(self, text, pre_tags=None, post_tags=None, trailing_whitespace=""):
+        self.text = text
 
         if pre_tags is not None:
-            obj.pre_tags = pre_tags
+            self.pre_tags = pre_tags
         else:
-            obj.pre_tags = []
+            self.pre_tags = []
 
         if post_tags is not None:
-            obj.post_tags = post_tags
+            self.post_tags = post_tags
         else:
-            obj.post_tags = []
+            self.post_tags = []
+
+        self.trailing_whitespace = trailing_whitespace
 
-        obj.trailing_whitespace = trailing_whitespace
+    def __str__(self):
+        return self.text
 
-        return obj
+    def __len__(self):
+        return len(self.text)
+
+    def __eq__(self, other):
+        if isinstance(other, DiffToken):
+            return self.text == other.text
+        elif isinstance(other, str):
+            return self.text == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.text)
 
     def __repr__(self):
-        return 'DiffToken(%s, %r, %r, %r)' % (str.__repr__(self), self.pre_tags,
+        return 'DiffToken(%r, %r, %r, %r)' % (self.text, self.pre_tags,
                                               self.post_tags, self.trailing_whitespace)
 
     def html(self):
-        return str(self)
+        return self.text
 
 
 class tag_token(DiffToken):
@@ -668,17 +1104,18 @@ class tag_token(DiffToken):
     the <img> tag, which takes up visible space just like a word but
     is only represented in a document by a tag.  """
 
-    def __new__(cls, tag, data, html_repr, comparator, pre_tags=None,
-                post_tags=None, trailing_whitespace=""):
-        obj = DiffToken.__new__(cls, "%s: %s" % (type, data),
-                            pre_tags=pre_tags,
-                            post_tags=post_tags,
-                            trailing_whitespace=trailing_whitespace)
-        obj.tag = tag
-        obj.data = data
-        obj.html_repr = html_repr
-        obj.comparator = comparator
-        return obj
+    __slots__ = ('tag', 'data', 'html_repr', 'comparator')
+
+    def __init__(self, tag, data, html_repr, comparator, pre_tags=None,
+                 post_tags=None, trailing_whitespace=""):
+        DiffToken.__init__(self, "%s: %s" % (type, data),
+                           pre_tags=pre_tags,
+                           post_tags=post_tags,
+                           trailing_whitespace=trailing_whitespace)
+        self.tag = tag
+        self.data = data
+        self.html_repr = html_repr
+        self.comparator = comparator
 
     def __repr__(self):
         return 'tag_token(%s, %s, html_repr=%s, post_tags=%r, pre_tags=%r, trailing_whitespace=%r)' % (
@@ -697,16 +1134,17 @@ class href_token(DiffToken):
     """ Represents the href in an anchor tag.  Unlike other words, we only
     show the href when it changes.  """
 
+    __slots__ = ('comparator',)
+
     hide_when_equal = True
 
-    def __new__(cls, href, comparator, pre_tags=None,
-                post_tags=None, trailing_whitespace=""):
-        obj = DiffToken.__new__(cls, text=href,
-                                pre_tags=pre_tags,
-                                post_tags=post_tags,
-                                trailing_whitespace=trailing_whitespace)
-        obj.comparator = comparator
-        return obj
+    def __init__(self, href, comparator, pre_tags=None,
+                 post_tags=None, trailing_whitespace=""):
+        DiffToken.__init__(self, text=href,
+                           pre_tags=pre_tags,
+                           post_tags=post_tags,
+                           trailing_whitespace=trailing_whitespace)
+        self.comparator = comparator
 
     def __eq__(self, other):
         # This equality check aims to apply specific rules to the contents of
@@ -725,12 +1163,9 @@ class href_token(DiffToken):
 
 
 class UndiffableContentToken(DiffToken):
-    pass
+    __slots__ = ()
 
 
-# FIXME: this should be adapted to work off a BeautifulSoup element instead of
-# an etree/lxml element, since we already have that and could avoid re-parsing
-# the whole document a second time.
 def tokenize(html, comparator, include_hrefs=True):
     """
     Parse the given HTML and returns token objects (words with attached tags).
@@ -750,10 +1185,9 @@ def tokenize(html, comparator, include_hrefs=True):
         body_el = html
     else:
         body_el = parse_html(html)
-    # Then we split the document into text chunks for each tag, word, and end tag:
-    chunks = flatten_el(body_el, skip_tag=True, include_hrefs=include_hrefs)
-    # Finally re-joining them into token objects:
-    return fixup_chunks(chunks, comparator)
+    tokens = _tokenize_items([body_el], comparator,
+                             include_hrefs=include_hrefs, skip_tag=True)
+    return tokens or [DiffToken('')]
 
 def parse_html(html):
     """
@@ -770,113 +1204,101 @@ def split_trailing_whitespace(word):
     stripped_length = len(word.rstrip())
     return word[0:stripped_length], word[stripped_length:]
 
-class TokenType(Enum):
-    undiffable = 0
-    start_tag = 1
-    end_tag = 2
-    word = 3
-    href = 4
-    img = 5
+def _tokenize_items(items, comparator, include_hrefs=True, skip_tag=False):
+    """
+    Create tokens (words with attached tags) from a list of text and lxml
+    elements, like the changed regions from `_find_changed_regions`.
 
+    Each start tag, word, and end tag is visited in document order and turned
+    directly into tokens. Tags are attached to the word after them
+    (`pre_tags`), except for end tags that directly follow a word
+    (`post_tags`). Elements are walked with an explicit stack rather than
+    recursively, so deeply nested pages can't hit Python's recursion limit.
 
-def fixup_chunks(chunks, comparator):
-    """
-    This function takes a list of chunks and produces a list of tokens.
+    If skip_tag is true, the tags of the elements in `items` are not included
+    (just their contents).
     """
+    tokens = []
     tag_accum = []
-    cur_word = None
-    result = []
-    for chunk in chunks:
-        current_token = chunk[0]
-        if current_token == TokenType.img:
-            src = chunk[1]
-            tag, trailing_whitespace = split_trailing_whitespace(chunk[2])
-            cur_word = ImgTagToken('img', data=src, html_repr=tag,
-                                   comparator=comparator, pre_tags=tag_accum,
-                                   trailing_whitespace=trailing_whitespace)
-            tag_accum = []
-            result.append(cur_word)
-
-        elif current_token == TokenType.href:
-            href = chunk[1]
-            cur_word = href_token(href, comparator=comparator, pre_tags=tag_accum, trailing_whitespace=" ")
-            tag_accum = []
-            result.append(cur_word)
-
-        elif current_token == TokenType.undiffable:
-            cur_word = UndiffableContentToken(chunk[1], pre_tags=tag_accum)
-            tag_accum = []
-            result.append(cur_word)
-
-        elif current_token == TokenType.word:
-            chunk, trailing_whitespace = split_trailing_whitespace(chunk[1])
-            cur_word = DiffToken(chunk, pre_tags=tag_accum, trailing_whitespace=trailing_whitespace)
-            tag_accum = []
-            result.append(cur_word)
-
-        elif current_token == TokenType.start_tag:
-            tag_accum.append(chunk[1])
-
-        elif current_token == TokenType.end_tag:
-            if tag_accum:
-                tag_accum.append(chunk[1])
-            else:
-                assert cur_word, (
-                    "Weird state, cur_word=%r, result=%r, chunks=%r of %r"
-                    % (cur_word, result, chunk, chunks))
-                cur_word.post_tags.append(chunk[1])
-        else:
-            assert(0)
 
-    if not result:
-        return [DiffToken('', pre_tags=tag_accum)]
-    else:
-        result[-1].post_tags.extend(tag_accum)
+    def add_words(text):
+        nonlocal tag_accum
+        if text:
+            # Escaping never adds or removes whitespace, so it's faster to
+            # escape the whole text at once than each word.
+            for word, trailing_whitespace in split_words_re.findall(html_escape(text)):
+                tokens.append(DiffToken(word, pre_tags=tag_accum,
+                                        trailing_whitespace=trailing_whitespace))
+                tag_accum = []
+
+    # Items are `(element, is_start, skip_tag)`, or text.
+    stack = [(item, True, skip_tag) if etree.iselement(item) else item
+             for item in reversed(items)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            add_words(item)
+            continue
 
-    return result
+        el, is_start, skip = item
+        if is_start:
+            if not skip:
+                if el.tag == 'img':
+                    src_array = []
+                    el_src = el.get('src')
+                    if el_src is not None:
+                        src_array.append(el_src)
+                    srcset = el.get('srcset')
+                    if srcset is not None:
+                        for src in srcset.split(','):
+                            src_array.append(src.split(' ', maxsplit=1)[0])
+                    tag, trailing_whitespace = split_trailing_whitespace(
+                        start_tag(el))
+                    tokens.append(ImgTagToken(
+                        'img', data=src_array, html_repr=tag,
+                        comparator=comparator, pre_tags=tag_accum,
+                        trailing_whitespace=trailing_whitespace))
+                    tag_accum = []
+                elif el.tag in undiffable_content_tags:
+                    element_source = etree.tostring(el, encoding=str,
+                                                    method='html')
+                    tokens.append(UndiffableContentToken(element_source,
+                                                         pre_tags=tag_accum))
+                    tag_accum = []
+                    continue
+                else:
+                    tag_accum.append(start_tag(el))
+            if (el.tag in void_tags and not el.text and not len(el)
+                    and not el.tail):
+                continue
+            add_words(el.text)
+            stack.append((el, False, skip))
+            stack.extend((child, True, False) for child in reversed(el))
+        else:
+            if el.tag == 'a' and include_hrefs:
+                href = el.get('href')
+                if href:
+                    tokens.append(href_token(href, comparator=comparator,
+                                             pre_tags=tag_accum,
+                                             trailing_whitespace=' '))
+                    tag_accum = []
+            if not skip:
+                if tag_accum:
+                    tag_accum.append(end_tag(el))
+                else:
+                    assert tokens, f'Weird state, end tag {el.tag} before any words'
+                    tokens[-1].post_tags.append(end_tag(el))
+                add_words(el.tail)
 
+    if tokens:
+        tokens[-1].post_tags.extend(tag_accum)
+    elif tag_accum:
+        tokens.append(DiffToken('', pre_tags=tag_accum))
+    return tokens
 
-def flatten_el(el, include_hrefs, skip_tag=False):
-    """ Takes an lxml element el, and generates all the text chunks for
-    that tag.  Each start tag is a chunk, each word is a chunk, and each
-    end tag is a chunk.
-
-    If skip_tag is true, then the outermost container tag is
-    not returned (just its contents)."""
-    if not skip_tag:
-        if el.tag == 'img':
-            src_array = []
-            el_src = el.get('src')
-            if el_src is not None:
-                src_array.append(el_src)
-            srcset = el.get('srcset')
-            if srcset is not None:
-                for src in srcset.split(','):
-                    src_array.append(src.split(' ', maxsplit=1)[0])
-            yield (TokenType.img, src_array, start_tag(el))
-        elif el.tag in undiffable_content_tags:
-            element_source = etree.tostring(el, encoding=str, method='html')
-            yield (TokenType.undiffable, element_source)
-            return
-        else:
-            yield (TokenType.start_tag, start_tag(el))
-    if el.tag in void_tags and not el.text and not len(el) and not el.tail:
-        return
-    start_words = split_words(el.text)
-    for word in start_words:
-        yield (TokenType.word, html_escape(word))
-    for child in el:
-        for item in flatten_el(child, include_hrefs=include_hrefs):
-            yield item
-    if el.tag == 'a' and el.get('href') and include_hrefs:
-        yield (TokenType.href, el.get('href'))
-    if not skip_tag:
-        yield (TokenType.end_tag, end_tag(el))
-        end_words = split_words(el.tail)
-        for word in end_words:
-            yield (TokenType.word, html_escape(word))
-
-split_words_re = re.compile(r'\S+(?:\s+|$)', re.U)
+
+# Find words and the whitespace after them.
+split_words_re = re.compile(r'(\S+)(\s*)', re.U)
 
 def split_words(text):
     """ Splits some text into words. Includes trailing whitespace
@@ -884,8 +1306,8 @@ def split_words(text):
     if not text or not text.strip():
         return []
 
-    words = split_words_re.findall(text)
-    return words
+    return [word + whitespace
+            for word, whitespace in split_words_re.findall(text)]
 
 start_whitespace_re = re.compile(r'^[ \t\n\r]')
 
@@ -942,21 +1364,7 @@ class MinimalHrefToken(href_token):
 # Explicitly designed to render repeatable crap so you can force-create
 # unchanged areas in the diff, but not render that crap to the final result.
 class SpacerToken(DiffToken):
-    # def __new__(cls, text, pre_tags=None, post_tags=None, trailing_whitespace=""):
-    #     obj = str.__new__(cls, text)
-
-    #     if pre_tags is not None:
-    #         obj.pre_tags = pre_tags
-    #     else:
-    #         obj.pre_tags = []
-
-    #     if post_tags is not None:
-    #         obj.post_tags = post_tags
-    #     else:
-    #         obj.post_tags = []
-
-    #     obj.trailing_whitespace = trailing_whitespace
-    #     return obj
+    __slots__ = ()
 
     def html(self):
         return ''
@@ -966,17 +1374,18 @@ class SpacerToken(DiffToken):
 # no spaces, but now that I know this differ more deeply, this is pointless.
 class ImgTagToken(tag_token):
 
-    def __new__(cls, tag, data, html_repr, comparator, pre_tags=None,
-                post_tags=None, trailing_whitespace=""):
-        obj = DiffToken.__new__(cls, "\n\nImg:%s\n\n" % str(data),
-                                pre_tags=pre_tags,
-                                post_tags=post_tags,
-                                trailing_whitespace=trailing_whitespace)
-        obj.tag = tag
-        obj.data = data
-        obj.html_repr = html_repr
-        obj.comparator = comparator
-        return obj
+    __slots__ = ()
+
+    def __init__(self, tag, data, html_repr, comparator, pre_tags=None,
+                 post_tags=None, trailing_whitespace=""):
+        DiffToken.__init__(self, "\n\nImg:%s\n\n" % str(data),
+                           pre_tags=pre_tags,
+                           post_tags=post_tags,
+                           trailing_whitespace=trailing_whitespace)
+        self.tag = tag
+        self.data = data
+        self.html_repr = html_repr
+        self.comparator = comparator
 
     def __eq__(self, other):
         if isinstance(other, ImgTagToken):
@@ -1007,43 +1416,15 @@ def _customize_tokens(tokens):
     #
     # TODO: when we get around to also forking the parse/tokenize part of this
     # diff, do this as part of the original tokenization instead.
-    for token_index, token in enumerate(tokens):
-        # logger.debug(f'Handling token {token_index}: {token}')
-        if token_index == 0:
-            continue
-        previous = tokens[token_index - 1]
-        previous_post_complete = False
-        for post_index, tag in enumerate(previous.post_tags):
-            if not tag.startswith('</'):
-                # TODO: should we attempt to fill pure-structure tags here with
-                # spacers? e.g. should we take the "<p><em></em></p>" here and
-                # wrap a spacer token in it instead of moving to "next-text's"
-                # pre_tags? "text</p><p><em></em></p><p>next-text"
-                token.pre_tags = previous.post_tags[post_index:] + token.pre_tags
-                previous.post_tags = previous.post_tags[:post_index]
-                previous_post_complete = True
-                break
-
-        if not previous_post_complete:
-            for pre_index, tag in enumerate(token.pre_tags):
-                if not tag.startswith('</'):
-                    if pre_index > 0:
-                        previous.post_tags.extend(token.pre_tags[:pre_index])
-                        token.pre_tags = token.pre_tags[pre_index:]
-                    break
-            else:
-                previous.post_tags.extend(token.pre_tags)
-                token.pre_tags = []
-
-
-        # logger.debug(f'  Result...\n    pre: {token.pre_tags}\n    token: "{token}"\n    post: {token.post_tags}')
-
+    #
+    # This all happens in one pass over the tokens: each token's tags are
+    # balanced with the next token's before the token is split up and added
+    # to the result, so every token's tags are final by the time it's used.
     result = []
-    # for token in tokens:
+    last_index = len(tokens) - 1
     for token_index, token in enumerate(tokens):
-        # if str(token).lower().startswith('impacts'):
-        # if str(token).lower().startswith('although'):
-        #     logger.debug(f'SPECIAL TAG!\n  pre: {token.pre_tags}\n  token: "{token}"\n  post: {token.post_tags}')
+        if token_index < last_index:
+            _balance_tags(token, tokens[token_index + 1])
 
         # hahaha, this is crazy. But anyway, insert "spacers" that have
         # identical text the diff algorithm can latch onto as an island of
@@ -1053,33 +1434,17 @@ def _customize_tokens(tokens):
         # list items, major page sections, etc.
         # See farther down in this same method for a repeat of this with
         # `post_tags`
-        try_splitting = len(token.pre_tags) > 0
+        pre_tags = token.pre_tags
         split_start = 0
-        while try_splitting:
-            for tag_index, tag in enumerate(token.pre_tags[split_start:]):
-                split_here = False
-                for name in SEPARATABLE_TAGS:
-                    if tag.startswith(f'<{name}'):
-                        split_here = True
-                        break
-                if split_here:
-                    # new_token = SpacerToken(SPACER_STRING, pre_tags=token.pre_tags[0:tag_index + 1])
-                    # token.pre_tags = token.pre_tags[tag_index + 1:]
-
-                    new_token = SpacerToken(SPACER_STRING, pre_tags=token.pre_tags[0:tag_index + split_start])
-                    token.pre_tags = token.pre_tags[tag_index + split_start:]
-
-                    # tokens.insert(token_index + 1, token)
-                    # token = new_token
-                    result.append(new_token)
-                    result.append(SpacerToken(SPACER_STRING))
-                    result.append(SpacerToken(SPACER_STRING))
-                    try_splitting = len(token.pre_tags) > 1
-                    split_start = 1
-                    break
-                else:
-                    try_splitting = False
-
+        for tag_index, tag in enumerate(pre_tags):
+            if tag.startswith(SEPARATABLE_TAG_STARTS):
+                result.append(SpacerToken(SPACER_STRING,
+                                          pre_tags=pre_tags[split_start:tag_index]))
+                result.append(SpacerToken(SPACER_STRING))
+                result.append(SpacerToken(SPACER_STRING))
+                split_start = tag_index
+        if split_start:
+            token.pre_tags = pre_tags[split_start:]
 
         # This is a CRITICAL scenario, but should probably be generalized and
         # a bit better understood. The case is empty elements that are fully
@@ -1090,18 +1455,12 @@ def _customize_tokens(tokens):
         # All the tags preceeding `Text!` get set as pre_tags for `Text!` and,
         # later, when stuff gets rebalanced, `Text!` gets moved down inside the
         # <div> that completely precedes it.
-        for index, tag in enumerate(token.pre_tags):
-            if tag.startswith('<a') and len(token.pre_tags) > index + 1:
-                next_tag = token.pre_tags[index + 1]
-                if next_tag and next_tag.startswith('</a'):
-                    result.append(SpacerToken('~EMPTY~', pre_tags=token.pre_tags[0:index], post_tags=token.pre_tags[index:]))
-                    token.pre_tags = []
-
-        # if _has_separation_tags(token.pre_tags):
-        #     # result.append(SpacerToken(SPACER_STRING, token.pre_tags))
-        #     # token.pre_tags = []
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
+        pre_tags = token.pre_tags
+        for index in range(len(pre_tags) - 1):
+            if pre_tags[index].startswith('<a') and pre_tags[index + 1].startswith('</a'):
+                result.append(SpacerToken('~EMPTY~', pre_tags=pre_tags[0:index], post_tags=pre_tags[index:]))
+                token.pre_tags = []
+                break
 
         customized = _customize_token(token)
         result.append(customized)
@@ -1118,40 +1477,10 @@ def _customize_tokens(tokens):
                     result.append(new_token)
                     customized.post_tags = customized.post_tags[:tag_index]
 
-        # if isinstance(customized, ImgTagToken):
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     logger.debug(f'IMAGE TOKEN:')
-        #     logger.debug(f'  pre: {customized.pre_tags}\n  token: "{customized}"\n  post: {customized.post_tags}')
-
-        # if len(customized.post_tags) > 0:
-        #     result.append(SpacerToken('', post_tags=customized.post_tags))
-        #     customized.post_tags = []
-
-        # if (_has_separation_tags(customized.post_tags)):
-        #     result.append(SpacerToken(SPACER_STRING, pre_tags=customized.post_tags))
-        #     # result.append(SpacerToken(SPACER_STRING, post_tags=customized.post_tags, trailing_whitespace=customized.trailing_whitespace))
-        #     customized.post_tags = []
-        #     # customized.trailing_whitespace = ''
         for tag_index, tag in enumerate(customized.post_tags):
-            split_here = False
-            for name in SEPARATABLE_TAGS:
-                if tag.startswith(f'<{name}'):
-                    split_here = True
-                    break
-            if split_here:
-                # new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index + 1:])
-                # customized.post_tags = customized.post_tags[0:tag_index + 1]
-
-                # new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index:])
-                # customized.post_tags = customized.post_tags[0:tag_index]
-
+            if tag.startswith(SEPARATABLE_TAG_STARTS):
                 new_token = SpacerToken(SPACER_STRING, post_tags=customized.post_tags[tag_index:])
                 customized.post_tags = customized.post_tags[0:tag_index]
-
-                # tokens.insert(token_index + 1, token)
-                # token = new_token
                 result.append(new_token)
                 result.append(SpacerToken(SPACER_STRING))
                 result.append(SpacerToken(SPACER_STRING))
@@ -1160,6 +1489,33 @@ def _customize_tokens(tokens):
     return result
 
 
+def _balance_tags(token, next_token):
+    """
+    Move tags between the end of one token and the start of the next so that
+    closing tags are post tags of `token` and opening tags are pre tags of
+    `next_token`.
+    """
+    for post_index, tag in enumerate(token.post_tags):
+        if not tag.startswith('</'):
+            # TODO: should we attempt to fill pure-structure tags here with
+            # spacers? e.g. should we take the "<p><em></em></p>" here and
+            # wrap a spacer token in it instead of moving to "next-text's"
+            # pre_tags? "text</p><p><em></em></p><p>next-text"
+            next_token.pre_tags = token.post_tags[post_index:] + next_token.pre_tags
+            token.post_tags = token.post_tags[:post_index]
+            return
+
+    for pre_index, tag in enumerate(next_token.pre_tags):
+        if not tag.startswith('</'):
+            if pre_index > 0:
+                token.post_tags.extend(next_token.pre_tags[:pre_index])
+                next_token.pre_tags = next_token.pre_tags[pre_index:]
+            break
+    else:
+        token.post_tags.extend(next_token.pre_tags)
+        next_token.pre_tags = []
+
+
 # One would *think* including `<h#>` tags here would make sense, but it turns
 # out we've seen a variety of real-world situations where tags flip from inline
 # markup to headings or headings nested by themselves (!) in other structural
@@ -1335,124 +1691,148 @@ def assemble_diff(html1_tokens, html2_tokens, commands, include='combined'):
     Assembles a renderable HTML string from a set of old and new tokens and a
     list of operations to perform agains them.
     """
-    include_insert = include == 'combined' or include == 'insertions'
-    include_delete = include == 'combined' or include == 'deletions'
+    return assemble_diffs(html1_tokens, html2_tokens, commands,
+                          [include])[include]
+
+
+def assemble_diffs(html1_tokens, html2_tokens, commands,
+                   includes=('combined',)):
+    """
+    Like `assemble_diff`, but assembles any of the `combined`, `insertions`,
+    and `deletions` views at once, in a single pass over the operations. Work
+    that is the same for each view (like expanding tokens into HTML) is only
+    done once. Returns a dict of lists of HTML strings, keyed by view.
+    """
+    results = {include: [] for include in includes}
+    combined = results.get('combined')
+    insertions = results.get('insertions')
+    deletions = results.get('deletions')
+    need_new = combined is not None or insertions is not None
+    need_old = combined is not None or deletions is not None
 
     # Generating a combined diff view is a relatively complicated affair. We
     # keep track of all the consecutive insertions and deletions in buffers
     # until we find a portion of the document that is unchanged, at which point
     # we reconcile the DOM structures of the changes before inserting the
     # unchanged parts.
-    result = []
     insert_buffer = []
     delete_buffer = []
 
     for command, i1, i2, j1, j2 in commands:
         if command == 'equal':
-            # When encountering an unchanged series of tokens, we first expand
-            # them to include the HTML elements that are attached to the
-            # tokenized text. Then we find the changed HTML tags before and
-            # after the unchanged text and add them to the previous buffer of
-            # changes and the next buffer of changes, respectively. This
-            # ensures that the reconciliation routine that handles differences
-            # in DOM structure is used on them, while portions that are exactly
-            # the same are simply inserted as-is.
-            #
-            # TODO: this splitting approach could probably be handled better if
-            # it was part of or better integrated with expanding the tokens, so
-            # we could just look at the first token's `pre_tags` and the last
-            # token's `post_tags` instead of having to reverse engineer them.
-            equal_buffer_delete = []
-            equal_buffer_insert = []
-            equal_buffer_delete_next = []
-            equal_buffer_insert_next = []
-            if include_insert and include_delete:
-                merge_change_groups(
-                    expand_tokens(html1_tokens[i1:i2], equal=True),
-                    equal_buffer_delete,
-                    tag_type=None)
-                merge_change_groups(
-                    expand_tokens(html2_tokens[j1:j2], equal=True),
-                    equal_buffer_insert,
-                    tag_type=None)
-
-                first_delete_group = -1
-                first_insert_group = -1
-                for token_index, token in enumerate(equal_buffer_delete):
-                    if isinstance(token, list):
-                        first_delete_group = token_index
-                        break
-                for token_index, token in enumerate(equal_buffer_insert):
-                    if isinstance(token, list):
-                        first_insert_group = token_index
-                        break
-                # In theory we should always find both, but sanity check anyway
-                if first_delete_group > -1 and first_insert_group > -1:
-                    max_index = min(first_delete_group, first_insert_group)
-                    unequal_reverse_index = max_index
-                    for reverse_index in range(max_index):
-                        delete_token = equal_buffer_delete[first_delete_group - 1 - reverse_index]
-                        insert_token = equal_buffer_insert[first_insert_group - 1 - reverse_index]
-                        if delete_token != insert_token:
-                            unequal_reverse_index = reverse_index
-                            break
-                    delete_buffer.extend(equal_buffer_delete[:first_delete_group - unequal_reverse_index])
-                    equal_buffer_delete = equal_buffer_delete[first_delete_group - unequal_reverse_index:]
-                    insert_buffer.extend(equal_buffer_insert[:first_insert_group - unequal_reverse_index])
-                    equal_buffer_insert = equal_buffer_insert[first_insert_group - unequal_reverse_index:]
-
-                last_delete_group = -1
-                last_insert_group = -1
-                # FIXME: totally inefficient; should go backward
-                for token_index, token in enumerate(equal_buffer_delete):
-                    if isinstance(token, list):
-                        last_delete_group = token_index
-                for token_index, token in enumerate(equal_buffer_insert):
-                    if isinstance(token, list):
-                        last_insert_group = token_index
-
-                # In theory we should always find both, but sanity check anyway
-                if last_delete_group > -1 and last_insert_group > -1:
-                    max_range = min(len(equal_buffer_delete) - last_delete_group, len(equal_buffer_insert) - last_insert_group)
-                    unequal_index = max(1, max_range)
-                    for index in range(1, max_range):
-                        delete_token = equal_buffer_delete[last_delete_group + index]
-                        insert_token = equal_buffer_insert[last_insert_group + index]
-                        if delete_token != insert_token:
-                            unequal_index = index
-                            break
-                    equal_buffer_delete_next = equal_buffer_delete[last_delete_group + unequal_index:]
-                    equal_buffer_delete = equal_buffer_delete[:last_delete_group + unequal_index]
-                    equal_buffer_insert_next = equal_buffer_insert[last_insert_group + unequal_index:]
-                    equal_buffer_insert = equal_buffer_insert[:last_insert_group + unequal_index]
-
-            if insert_buffer or delete_buffer:
-                reconcile_change_groups(insert_buffer, delete_buffer, result)
-
-            if include_insert and include_delete:
-                result.extend(flatten_groups(equal_buffer_insert))
-                delete_buffer.extend(equal_buffer_delete_next)
-                insert_buffer.extend(equal_buffer_insert_next)
-            elif include_insert:
-                result.extend(expand_tokens(html2_tokens[j1:j2], equal=True))
-            else:
-                result.extend(expand_tokens(html1_tokens[i1:i2], equal=True))
+            old_chunks = need_old and list(
+                expand_tokens(html1_tokens[i1:i2], equal=True))
+            new_chunks = need_new and list(
+                expand_tokens(html2_tokens[j1:j2], equal=True))
+            if combined is not None:
+                _assemble_combined_equal(old_chunks, new_chunks,
+                                         insert_buffer, delete_buffer,
+                                         combined)
+            if insertions is not None:
+                insertions.extend(new_chunks)
+            if deletions is not None:
+                deletions.extend(old_chunks)
             continue
-        if (command == 'insert' or command == 'replace') and include_insert:
-            ins_tokens = expand_tokens(html2_tokens[j1:j2])
-            if include_delete:
-                merge_change_groups(ins_tokens, insert_buffer, 'ins')
-            else:
-                merge_changes(ins_tokens, result, 'ins')
-        if (command == 'delete' or command == 'replace') and include_delete:
-            del_tokens = expand_tokens(html1_tokens[i1:i2])
-            if include_insert:
+        if (command == 'insert' or command == 'replace') and need_new:
+            ins_chunks = list(expand_tokens(html2_tokens[j1:j2]))
+            if combined is not None:
+                merge_change_groups(ins_chunks, insert_buffer, 'ins')
+            if insertions is not None:
+                merge_changes(ins_chunks, insertions, 'ins')
+        if (command == 'delete' or command == 'replace') and need_old:
+            del_tokens = list(expand_tokens(html1_tokens[i1:i2]))
+            if combined is not None:
                 merge_change_groups(del_tokens, delete_buffer, 'del')
-            else:
-                merge_changes(del_tokens, result, 'del')
+            if deletions is not None:
+                merge_changes(del_tokens, deletions, 'del')
 
-    reconcile_change_groups(insert_buffer, delete_buffer, result)
-    return result
+    if combined is not None:
+        reconcile_change_groups(insert_buffer, delete_buffer, combined)
+    return results
+
+
+def _assemble_combined_equal(old_chunks, new_chunks, insert_buffer,
+                             delete_buffer, result):
+    """
+    Add a run of unchanged chunks to a combined diff view (see
+    `assemble_diffs`), reconciling any buffered changes before it.
+    """
+    # When encountering an unchanged series of tokens, we first expand
+    # them to include the HTML elements that are attached to the
+    # tokenized text. Then we find the changed HTML tags before and
+    # after the unchanged text and add them to the previous buffer of
+    # changes and the next buffer of changes, respectively. This
+    # ensures that the reconciliation routine that handles differences
+    # in DOM structure is used on them, while portions that are exactly
+    # the same are simply inserted as-is.
+    #
+    # TODO: this splitting approach could probably be handled better if
+    # it was part of or better integrated with expanding the tokens, so
+    # we could just look at the first token's `pre_tags` and the last
+    # token's `post_tags` instead of having to reverse engineer them.
+    equal_buffer_delete = []
+    equal_buffer_insert = []
+    equal_buffer_delete_next = []
+    equal_buffer_insert_next = []
+    merge_change_groups(old_chunks, equal_buffer_delete, tag_type=None)
+    merge_change_groups(new_chunks, equal_buffer_insert, tag_type=None)
+
+    first_delete_group = -1
+    first_insert_group = -1
+    for token_index, token in enumerate(equal_buffer_delete):
+        if isinstance(token, list):
+            first_delete_group = token_index
+            break
+    for token_index, token in enumerate(equal_buffer_insert):
+        if isinstance(token, list):
+            first_insert_group = token_index
+            break
+    # In theory we should always find both, but sanity check anyway
+    if first_delete_group > -1 and first_insert_group > -1:
+        max_index = min(first_delete_group, first_insert_group)
+        unequal_reverse_index = max_index
+        for reverse_index in range(max_index):
+            delete_token = equal_buffer_delete[first_delete_group - 1 - reverse_index]
+            insert_token = equal_buffer_insert[first_insert_group - 1 - reverse_index]
+            if delete_token != insert_token:
+                unequal_reverse_index = reverse_index
+                break
+        delete_buffer.extend(equal_buffer_delete[:first_delete_group - unequal_reverse_index])
+        equal_buffer_delete = equal_buffer_delete[first_delete_group - unequal_reverse_index:]
+        insert_buffer.extend(equal_buffer_insert[:first_insert_group - unequal_reverse_index])
+        equal_buffer_insert = equal_buffer_insert[first_insert_group - unequal_reverse_index:]
+
+    last_delete_group = -1
+    last_insert_group = -1
+    # FIXME: totally inefficient; should go backward
+    for token_index, token in enumerate(equal_buffer_delete):
+        if isinstance(token, list):
+            last_delete_group = token_index
+    for token_index, token in enumerate(equal_buffer_insert):
+        if isinstance(token, list):
+            last_insert_group = token_index
+
+    # In theory we should always find both, but sanity check anyway
+    if last_delete_group > -1 and last_insert_group > -1:
+        max_range = min(len(equal_buffer_delete) - last_delete_group, len(equal_buffer_insert) - last_insert_group)
+        unequal_index = max(1, max_range)
+        for index in range(1, max_range):
+            delete_token = equal_buffer_delete[last_delete_group + index]
+            insert_token = equal_buffer_insert[last_insert_group + index]
+            if delete_token != insert_token:
+                unequal_index = index
+                break
+        equal_buffer_delete_next = equal_buffer_delete[last_delete_group + unequal_index:]
+        equal_buffer_delete = equal_buffer_delete[:last_delete_group + unequal_index]
+        equal_buffer_insert_next = equal_buffer_insert[last_insert_group + unequal_index:]
+        equal_buffer_insert = equal_buffer_insert[:last_insert_group + unequal_index]
+
+    if insert_buffer or delete_buffer:
+        reconcile_change_groups(insert_buffer, delete_buffer, result)
+
+    result.extend(flatten_groups(equal_buffer_insert))
+    delete_buffer.extend(equal_buffer_delete_next)
+    insert_buffer.extend(equal_buffer_insert_next)
 
 
 # TODO: merge and reconcile this with `merge_changes()`, which is 90% the same
@@ -1818,7 +2198,7 @@ def flatten_groups(groups, include_non_groups=True):
     return flat
 
 
-class InsensitiveSequenceMatcher(difflib.SequenceMatcher):
+class InsensitiveSequenceMatcher(MyersSequenceMatcher):
     """
     Acts like SequenceMatcher, but tries not to find very small equal
     blocks amidst large spans of changes
@@ -1827,12 +2207,14 @@ class InsensitiveSequenceMatcher(difflib.SequenceMatcher):
     threshold = 2
 
     def get_matching_blocks(self):
-        size = min(len(self.a), len(self.b))
-        threshold = min(self.threshold, size / 4)
-        actual = difflib.SequenceMatcher.get_matching_blocks(self)
-        return [item for item in actual
-                if item[2] > threshold
-                or not item[2]]
+        if self.matching_blocks is None:
+            size = min(len(self.a), len(self.b))
+            threshold = min(self.threshold, size / 4)
+            actual = MyersSequenceMatcher.get_matching_blocks(self)
+            self.matching_blocks = [item for item in actual
+                                    if item[2] > threshold
+                                    or not item[2]]
+        return self.matching_blocks
 
 
 UPDATE_CONTRAST_SCRIPT = """
@@ -1,6 +1,8 @@
+import copy
 import html5_parser
 from .content_type import raise_if_not_diffable_html
-from .differs import compute_dmp_diff
+from .differs import compute_dmp_diff, parse_soup
+from .metrics import phase
 from web_monitoring.utils import get_color_palette
 from difflib import SequenceMatcher
 from .html_diff_render import (get_title, _html_for_dmp_operation,
@@ -29,8 +31,8 @@ def links_diff(a_text, b_text, a_headers=None, b_headers=None,
         b_headers,
         content_type_options)
 
-    a_soup = html5_parser.parse(a_text, treebuilder='soup', return_root=False)
-    b_soup = html5_parser.parse(b_text, treebuilder='soup', return_root=False)
+    a_soup = parse_soup(a_text)
+    b_soup = parse_soup(b_text)
 
     a_links = sorted(
         set([Link.from_element(element) for element in _find_outgoing_links(a_soup)]),
@@ -39,8 +41,9 @@ def links_diff(a_text, b_text, a_headers=None, b_headers=None,
         set([Link.from_element(element) for element in _find_outgoing_links(b_soup)]),
         key=lambda link: link.text.lower() + f'({link.href})')
 
-    matcher = SequenceMatcher(a=a_links, b=b_links)
-    opcodes = matcher.get_opcodes()
+    with phase('match'):
+        matcher = SequenceMatcher(a=a_links, b=b_links)
+        opcodes = matcher.get_opcodes()
     diff = list(_assemble_diff(a_links, b_links, opcodes))
 
     return {
@@ -134,9 +137,12 @@ def links_diff_html(a_text, b_text, a_headers=None, b_headers=None,
     soup.head.append(change_styles)
     soup.title.string = get_title(diff['b_parsed'])
 
+    with phase('serialize'):
+        rendered = soup.prettify(formatter=None)
+
     return {
         'change_count': diff['change_count'],
-        'diff': soup.prettify(formatter=None)
+        'diff': rendered
     }
 
 
@@ -204,6 +210,10 @@ def _get_link_text(link):
     """
     Get the "text" to diff and display for an `<a>` element.
     """
+    # Work on a copy so the document is left alone; it may be shared with
+    # other differs (see `differs.shared_parses()`).
+    link = copy.copy(link)
+
     # The content of tags like <script> and <style> shows up in the `.text`
     # attribute, so just go ahead and remove them from the DOM
     for invisible_tag in link.find_all(undiffable_content_tags):
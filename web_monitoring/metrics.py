@@ -0,0 +1,231 @@
+"""
+Minimal metrics for the diffing server, rendered in the Prometheus text
+exposition format (https://prometheus.io/docs/instrumenting/exposition_formats/)
+so they can be scraped from the `/metrics` endpoint.
+
+Metrics are `Counter`, `Gauge`, or `Histogram` objects, each of which can
+have labels. Long-lived metrics are registered with a `Registry` (usually
+`REGISTRY`) when they are created.
+
+This module also tracks how long the phases of a diff take. Code that does
+a distinct piece of work (e.g. decoding a response body) wraps it in
+`phase()`, and code that wants to know how long each phase took wraps the
+whole operation in `recording_phases()`. This works across processes: use
+`call_recording_phases()` to run a function in a worker process and send its
+phase timings back along with its result.
+"""
+from contextlib import contextmanager
+import math
+import time
+
+
+# Upper bounds (in seconds) of histogram buckets for durations.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, math.inf)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape_label(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape_label(value)}"'
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """
+    Base class for metrics.
+
+    Parameters
+    ----------
+    name : str
+    description : str
+    labels : sequence of str, optional
+        Names of the labels that values of this metric have.
+    registry : Registry, optional
+        Register the metric with this registry.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, description, labels=(), registry=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def get(self, **labels):
+        "Get the current value for a set of labels."
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        "Yield `(name, label_names, label_values, value)` for each sample."
+        for key, value in sorted(self._values.items()):
+            yield self.name, self.labels, key, value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} {self.type}']
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f'{name}{_format_labels(label_names, label_values)} '
+                         f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    "A value that only goes up, like a number of requests."
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """
+        Set the total directly. This is useful for reporting counts that are
+        tracked elsewhere, like cache hits.
+        """
+        self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    "A value that can go up or down, like the size of a cache."
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observed values, like durations, in buckets.
+
+    Parameters
+    ----------
+    buckets : sequence of float, optional
+        Upper bounds of the buckets. `math.inf` is added if not present.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels, registry)
+        self.buckets = tuple(sorted(set(buckets) | {math.inf}))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = {'counts': [0] * len(self.buckets),
+                                        'sum': 0,
+                                        'count': 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                data['counts'][index] += 1
+                break
+        data['sum'] += value
+        data['count'] += 1
+
+    def get(self, **labels):
+        "Get the count and sum of observed values for a set of labels."
+        data = self._values.get(self._key(labels))
+        if data is None:
+            return {'count': 0, 'sum': 0}
+        return {'count': data['count'], 'sum': data['sum']}
+
+    def samples(self):
+        bucket_labels = self.labels + ('le',)
+        for key, data in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, data['counts']):
+                cumulative += count
+                yield (f'{self.name}_bucket', bucket_labels,
+                       key + (_format_value(bound),), cumulative)
+            yield f'{self.name}_sum', self.labels, key, data['sum']
+            yield f'{self.name}_count', self.labels, key, data['count']
+
+
+class Registry:
+    "A collection of metrics that can be rendered together."
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+# The default registry.
+REGISTRY = Registry()
+
+
+# Phase timings that are currently being recorded (see `recording_phases()`).
+_phases = None
+
+
+@contextmanager
+def recording_phases():
+    """
+    A context manager that records how long any `phase()` blocks inside it
+    take. It yields a dict that maps phase names to the total number of
+    seconds spent in them.
+    """
+    global _phases
+    previous = _phases
+    _phases = {}
+    try:
+        yield _phases
+    finally:
+        _phases = previous
+
+
+@contextmanager
+def phase(name):
+    """
+    A context manager that times a phase of work, if phases are being
+    recorded. Time spent in phases with the same name is added together.
+    """
+    if _phases is None:
+        yield
+        return
+
+    phases = _phases
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+
+def call_recording_phases(func, *args, **kwargs):
+    """
+    Call a function and record the phases it goes through. Returns a tuple
+    of the function's result and a dict of phase timings (see
+    `recording_phases()`).
+    """
+    with recording_phases() as phases:
+        result = func(*args, **kwargs)
+    return result, phases
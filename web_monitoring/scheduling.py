@@ -0,0 +1,414 @@
+"""
+Scheduling of diffs across pools of worker processes.
+
+Each `DiffPool` manages a limited number of worker processes and a
+bounded queue of diffs waiting for a worker. Waiting diffs are started in
+order of priority (lower numbers first), and a diff that arrives when the
+queue is full is rejected with a `PoolFullError` rather than waiting
+indefinitely.
+
+Pools manage their own worker processes (rather than using
+`concurrent.futures.ProcessPoolExecutor`) so that a diff that runs past its
+time limit can be stopped by killing just the process it is running in,
+without disturbing diffs running in other processes.
+
+A `DiffScheduler` decides where each diff runs: trivially cheap differs run
+inline in the server process, and the rest are routed to named pools, so
+slow differs can be kept from starving fast ones.
+"""
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolFullError(Exception):
+    """
+    Raised when a diff can't be scheduled because its pool's queue is full.
+
+    Parameters
+    ----------
+    pool : str
+        Name of the pool that was full.
+    retry_after : int
+        Estimated number of seconds until the pool will have room.
+    """
+    def __init__(self, pool, retry_after):
+        super().__init__(f'The "{pool}" diff pool is full')
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class DiffTimeoutError(Exception):
+    """
+    Raised when a diff takes longer than its time limit. The worker process
+    it was running in is killed.
+
+    Parameters
+    ----------
+    pool : str
+        Name of the pool the diff was running in.
+    timeout : float
+        The time limit, in seconds.
+    """
+    def __init__(self, pool, timeout):
+        super().__init__(f'Diff in the "{pool}" pool did not finish within '
+                         f'{timeout} seconds')
+        self.pool = pool
+        self.timeout = timeout
+
+
+class WorkerDiedError(Exception):
+    "Raised when a worker process exits while running a task."
+
+
+def _work(connection):
+    "Run tasks sent over a connection. This is the main loop of a `Worker`."
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, OSError):
+            return
+
+        try:
+            message = (True, task())
+        except Exception as error:
+            message = (False, error)
+
+        try:
+            connection.send(message)
+        except Exception as error:
+            # The result or error might not be picklable.
+            connection.send((False, RuntimeError(
+                f'Could not send result from worker: {error!r} '
+                f'(original result: {message[1]!r})')))
+
+
+class Worker:
+    """
+    A worker process that runs one picklable callable at a time.
+
+    Parameters
+    ----------
+    context : multiprocessing context, optional
+    """
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context()
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_work,
+                                       args=(child_connection,),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def run(self, task):
+        """
+        Run a task in the worker and wait for its result. Raises
+        `WorkerDiedError` if the worker process exits before finishing.
+        This blocks, so it should be called from a thread.
+        """
+        try:
+            self.connection.send(task)
+            succeeded, value = self.connection.recv()
+        except (EOFError, OSError) as error:
+            self.connection.close()
+            raise WorkerDiedError(f'Worker process {self.process.pid} '
+                                  f'exited unexpectedly') from error
+        if succeeded:
+            return value
+        raise value
+
+    def kill(self):
+        """
+        Stop the worker process immediately. If a task is running, `run()`
+        will raise `WorkerDiedError` (and close the connection).
+        """
+        self.process.kill()
+        self.process.join()
+
+    def close(self):
+        "Stop an idle worker process and close its connection."
+        self.kill()
+        self.connection.close()
+
+
+def _ignore_result(future):
+    "Retrieve a future's result or exception so it isn't logged as unused."
+    if not future.cancelled():
+        future.exception()
+
+
+class DiffPool:
+    """
+    A pool of worker processes with a bounded, prioritized queue.
+
+    Parameters
+    ----------
+    name : str
+        A name for the pool, used in errors and stats.
+    size : int
+        Number of worker processes.
+    max_queue : int
+        Maximum number of tasks that can wait for a worker. If more tasks
+        arrive while the queue is full, they are rejected with a
+        `PoolFullError`.
+    context : multiprocessing context, optional
+        Used to create worker processes.
+    """
+    def __init__(self, name, size, max_queue, context=None):
+        self.name = name
+        self.size = size
+        self.max_queue = max_queue
+        self.running = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._context = context
+        self._idle_workers = []
+        # Workers block while running tasks, so each one needs a thread to
+        # wait on it.
+        self._threads = None
+        # Moving average of how long tasks take, for estimating when a full
+        # queue will have room again.
+        self._average_duration = 1.0
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def shutdown(self, wait=True):
+        "Stop all idle worker processes."
+        while self._idle_workers:
+            self._idle_workers.pop().close()
+        if self._threads:
+            self._threads.shutdown(wait=wait)
+            self._threads = None
+
+    async def run(self, task, priority=0, tries=2, timeout=None,
+                  timings=None):
+        """
+        Run a picklable callable in a worker process, optionally retrying if
+        the worker process dies.
+
+        Raises `PoolFullError` if the task has to wait for a worker and the
+        queue is full, or `DiffTimeoutError` if the task takes more than
+        `timeout` seconds (not including time spent waiting for a worker).
+        In the latter case, the worker process is killed and replaced.
+
+        If `timings` is a dict, the number of seconds spent waiting for a
+        worker and running in one are stored in its `queue` and `compute`
+        keys.
+        """
+        queued_at = time.monotonic()
+        await self._acquire(priority)
+        start = time.monotonic()
+        if timings is not None:
+            timings['queue'] = start - queued_at
+        try:
+            for attempt in range(tries):
+                try:
+                    result = await self._run_in_worker(task, timeout)
+                    break
+                except WorkerDiedError:
+                    if attempt + 1 == tries:
+                        raise
+                    logger.warning(f'Worker in "{self.name}" pool died; '
+                                   f'retrying task')
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            duration = time.monotonic() - start
+            if timings is not None:
+                timings['compute'] = duration
+            self._release()
+
+        # Only count tasks that finished in the average; one that timed out
+        # would add its whole time limit to it.
+        self._average_duration = 0.9 * self._average_duration + 0.1 * duration
+        self.completed += 1
+        return result
+
+    async def _run_in_worker(self, task, timeout):
+        if self._idle_workers:
+            worker = self._idle_workers.pop()
+        else:
+            worker = Worker(self._context)
+        if not self._threads:
+            self._threads = concurrent.futures.ThreadPoolExecutor(
+                self.size, thread_name_prefix=f'diff-pool-{self.name}')
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._threads, worker.run, task)
+        try:
+            done, _ = await asyncio.wait([future], timeout=timeout)
+        except asyncio.CancelledError:
+            # There's no way to get the worker back in a known state.
+            worker.kill()
+            future.add_done_callback(_ignore_result)
+            raise
+
+        if not done:
+            worker.kill()
+            future.add_done_callback(_ignore_result)
+            self.timeouts += 1
+            raise DiffTimeoutError(self.name, timeout)
+
+        try:
+            result = future.result()
+        except WorkerDiedError:
+            worker.kill()
+            raise
+        except Exception:
+            self._idle_workers.append(worker)
+            raise
+
+        self._idle_workers.append(worker)
+        return result
+
+    def retry_after(self):
+        "Estimate how many seconds until a new task could start."
+        rounds = (self.queued + 1) / self.size
+        return max(1, math.ceil(self._average_duration * rounds))
+
+    async def _acquire(self, priority):
+        if self.running < self.size and not self._waiting:
+            self.running += 1
+            return
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise PoolFullError(self.name, self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._sequence), future]
+        heapq.heappush(self._waiting, entry)
+        try:
+            # `_release()` hands its worker slot over by resolving this.
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+            raise
+
+    def _release(self):
+        while self._waiting:
+            future = heapq.heappop(self._waiting)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self):
+        return {'size': self.size,
+                'running': self.running,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts}
+
+
+class DiffScheduler:
+    """
+    Decides where diffs run: inline in the current process or in one of
+    several `DiffPool` objects.
+
+    Parameters
+    ----------
+    pools : dict
+        `DiffPool` objects, keyed by name. Must include a pool named by
+        `default_pool`.
+    routes : dict, optional
+        Maps differ names to the names of the pools they should run in.
+        Differs that aren't listed run in the default pool.
+    inline : collection of str, optional
+        Names of differs that are cheap enough to run inline, without using
+        a worker process.
+    priorities : dict, optional
+        Maps differ names to priorities. When diffs are waiting for a worker,
+        ones with lower numbers are started first. The default is 0.
+    timeouts : dict, optional
+        Maps differ names to the maximum number of seconds they can run for.
+    default_timeout : float, optional
+        Time limit, in seconds, for differs that aren't in `timeouts`. If
+        `None`, they have no time limit.
+    default_pool : str, optional
+    """
+    def __init__(self, pools, routes=None, inline=(), priorities=None,
+                 timeouts=None, default_timeout=None, default_pool='default'):
+        self.pools = pools
+        self.routes = routes or {}
+        self.inline = frozenset(inline)
+        self.priorities = priorities or {}
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.default_pool = default_pool
+
+    def is_inline(self, differs):
+        "Determine whether a task using a list of differs should run inline."
+        return all(differ in self.inline for differ in differs)
+
+    def pool_for(self, differs):
+        """
+        Get the pool for a task using a list of differs. That's the pool for
+        the first differ that doesn't run inline.
+        """
+        for differ in differs:
+            if differ not in self.inline:
+                return self.pools[self.routes.get(differ, self.default_pool)]
+        return self.pools[self.default_pool]
+
+    def priority_for(self, differs):
+        "Get the priority for a task using a list of differs."
+        return min(self.priorities.get(differ, 0) for differ in differs)
+
+    def timeout_for(self, differs):
+        """
+        Get the time limit for a task using a list of differs. Since the
+        differs run one after another, it's the sum of their time limits.
+        Returns `None` if any of them has no limit.
+        """
+        total = 0
+        for differ in differs:
+            timeout = self.timeouts.get(differ, self.default_timeout)
+            if timeout is None:
+                return None
+            total += timeout
+        return total
+
+    async def run(self, differs, task, tries=2, timings=None):
+        """
+        Run a picklable callable for a list of differs in the appropriate
+        pool. (Callers should check `is_inline()` first and run inline tasks
+        themselves.) Raises `PoolFullError` if the pool is full or
+        `DiffTimeoutError` if the task runs past its time limit. See
+        `DiffPool.run()` for details on `timings`.
+        """
+        pool = self.pool_for(differs)
+        return await pool.run(task,
+                              priority=self.priority_for(differs),
+                              tries=tries,
+                              timeout=self.timeout_for(differs),
+                              timings=timings)
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
@@ -0,0 +1,315 @@
+"""
+Find the parts two sequences have in common, like `difflib.SequenceMatcher`,
+but using Eugene Myers's O(ND) algorithm in linear space.
+
+`difflib.SequenceMatcher` looks for the longest matching block and then
+repeats on the parts before and after it, which is quadratic in the worst case
+and is very slow for long sequences with many repeated items (like the words
+and spacers in a tokenized web page). Myers's algorithm takes time
+proportional to the length of the sequences times the number of differences
+between them, so it is fast when there are few changes, which is the common
+case for versions of a page.
+
+See: Eugene W. Myers, "An O(ND) Difference Algorithm and Its Variations,"
+Algorithmica 1 (1986): 251–266.
+
+Sequences with too many differences to search through are split at items that
+are unique to both of them, like patience diff (see `_find_anchors`).
+"""
+import bisect
+from collections import Counter
+
+
+# When the number of differences between two sequences is larger than this,
+# stop looking for the shortest set of changes between them. Instead, split
+# them at "anchors" -- items that occur once in each sequence -- and diff the
+# gaps between the anchors (see `_find_anchors`), or, if there are no anchors,
+# split them at the best point found so far (similar to GNU diff's "too
+# expensive" heuristic). This keeps very different sequences from taking
+# quadratic time, at the cost of a slightly less minimal result for them.
+MAX_COST = 1024
+
+
+class MyersSequenceMatcher:
+    """
+    Compare two sequences of items that support `==`. This has the same
+    interface as `difflib.SequenceMatcher` for getting results (so it can be
+    used in place of one), but does not support junk heuristics.
+
+    Parameters
+    ----------
+    a : sequence
+    b : sequence
+    max_cost : int, optional
+        Number of differences to search through when splitting the sequences
+        before settling for an approximate split. See `MAX_COST`.
+    anchors : bool, optional
+        Whether to split sequences with more than `max_cost` differences at
+        unique anchors, rather than only at the best point found so far.
+    """
+    def __init__(self, a=(), b=(), max_cost=MAX_COST, anchors=True):
+        self.a = a
+        self.b = b
+        self.max_cost = max_cost
+        self.anchors = anchors
+        self.matching_blocks = None
+        self.opcodes = None
+
+    def get_matching_blocks(self):
+        """
+        Get a list of `(i, j, n)` triples, where `a[i:i + n] == b[j:j + n]`,
+        in increasing order of `i` and `j`. Like `difflib.SequenceMatcher`,
+        adjacent blocks are merged and the last triple is always
+        `(len(a), len(b), 0)`.
+        """
+        if self.matching_blocks is not None:
+            return self.matching_blocks
+
+        blocks = []
+        for i, j, size in _find_matches(self.a, self.b, self.max_cost,
+                                        self.anchors):
+            if blocks and (blocks[-1][0] + blocks[-1][2] == i
+                           and blocks[-1][1] + blocks[-1][2] == j):
+                blocks[-1] = (blocks[-1][0], blocks[-1][1],
+                              blocks[-1][2] + size)
+            else:
+                blocks.append((i, j, size))
+
+        blocks.append((len(self.a), len(self.b), 0))
+        self.matching_blocks = blocks
+        return blocks
+
+    def get_opcodes(self):
+        """
+        Get a list of `(tag, i1, i2, j1, j2)` tuples describing how to turn
+        `a` into `b`, where `tag` is one of `'replace'`, `'delete'`,
+        `'insert'`, or `'equal'`. This is the same as
+        `difflib.SequenceMatcher.get_opcodes()`.
+        """
+        if self.opcodes is not None:
+            return self.opcodes
+
+        i = j = 0
+        opcodes = []
+        for ai, bj, size in self.get_matching_blocks():
+            tag = ''
+            if i < ai and j < bj:
+                tag = 'replace'
+            elif i < ai:
+                tag = 'delete'
+            elif j < bj:
+                tag = 'insert'
+            if tag:
+                opcodes.append((tag, i, ai, j, bj))
+            i, j = ai + size, bj + size
+            # The last block is always empty, so don't add an equal opcode
+            # for it (or for any others that got filtered down to nothing).
+            if size:
+                opcodes.append(('equal', ai, i, bj, j))
+
+        self.opcodes = opcodes
+        return opcodes
+
+
+def _find_matches(a, b, max_cost, anchors):
+    """
+    Yield `(i, j, n)` triples for each run of items that are equal in `a` and
+    `b`, in order. Runs may be adjacent to each other.
+    """
+    # Work through ranges of `a` and `b` with an explicit stack rather than
+    # recursion, since very different sequences can be split many times.
+    # Items are either a range to diff,
+    # `(a_start, a_end, b_start, b_end, use_anchors)`, or a matching run to
+    # yield once the ranges before it are done, `(i, j, n)`.
+    stack = [(0, len(a), 0, len(b), anchors)]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            yield item
+            continue
+
+        a_start, a_end, b_start, b_end, use_anchors = item
+        # Trim (and yield) items the ranges start with in common...
+        size = 0
+        while (a_start + size < a_end and b_start + size < b_end
+               and a[a_start + size] == b[b_start + size]):
+            size += 1
+        if size:
+            yield a_start, b_start, size
+            a_start += size
+            b_start += size
+
+        # ...and find the items they end with in common, to yield later.
+        size = 0
+        while (a_end - size > a_start and b_end - size > b_start
+               and a[a_end - size - 1] == b[b_end - size - 1]):
+            size += 1
+        if size:
+            a_end -= size
+            b_end -= size
+            stack.append((a_end, b_end, size))
+
+        if a_start == a_end or b_start == b_end:
+            continue
+
+        x, y, is_middle = _split(a, b, a_start, a_end, b_start, b_end,
+                                 max_cost)
+        anchor_points = None
+        if not is_middle and use_anchors:
+            anchor_points = _find_anchors(a, b, a_start, a_end,
+                                          b_start, b_end)
+        if not anchor_points:
+            stack.append((x, a_end, y, b_end, use_anchors))
+            stack.append((a_start, x, b_start, y, use_anchors))
+            continue
+
+        # Diff the gaps between anchors separately. Only look for anchors
+        # again in gaps that are much smaller than this range, so a range
+        # can't be re-counted over and over while only shedding a few anchors
+        # each time.
+        range_size = a_end - a_start + b_end - b_start
+        gaps = []
+        gap_a_start, gap_b_start = a_start, b_start
+        for i, j in anchor_points + [(a_end, b_end)]:
+            gaps.append((gap_a_start, i, gap_b_start, j))
+            gap_a_start, gap_b_start = i + 1, j + 1
+        for index in reversed(range(len(gaps))):
+            gap_a_start, gap_a_end, gap_b_start, gap_b_end = gaps[index]
+            gap_size = gap_a_end - gap_a_start + gap_b_end - gap_b_start
+            stack.append((gap_a_start, gap_a_end, gap_b_start, gap_b_end,
+                          gap_size <= range_size // 2))
+            if index > 0:
+                stack.append((gap_a_start - 1, gap_b_start - 1, 1))
+
+
+def _find_anchors(a, b, a_start, a_end, b_start, b_end):
+    """
+    Find "anchors" for diffing `a[a_start:a_end]` and `b[b_start:b_end]`, as
+    in patience diff: items that appear exactly once in each range, and are in
+    the same order in both. Returns a list of `(i, j)` positions of the
+    longest list of anchors, where `a[i] == b[j]`.
+    """
+    a_counts = Counter(a[a_start:a_end])
+    b_counts = Counter(b[b_start:b_end])
+    a_positions = {item: i
+                   for i, item in enumerate(a[a_start:a_end], a_start)
+                   if a_counts[item] == 1}
+    pairs = [(a_positions[item], j)
+             for j, item in enumerate(b[b_start:b_end], b_start)
+             if b_counts[item] == 1 and item in a_positions]
+    if not pairs:
+        return []
+
+    # Pairs are in order of `j`, so the anchors are the longest subsequence of
+    # them where `i` is also increasing. Find it with patience sorting: each
+    # pile is a pair, and `tails` holds the `i` at the top of each pile.
+    tails = []
+    piles = []
+    previous = [None] * len(pairs)
+    for index, (i, _) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, i)
+        if pile > 0:
+            previous[index] = piles[pile - 1]
+        if pile == len(tails):
+            tails.append(i)
+            piles.append(index)
+        else:
+            tails[pile] = i
+            piles[pile] = index
+
+    anchors = []
+    index = piles[-1]
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _split(a, b, a_start, a_end, b_start, b_end, max_cost):
+    """
+    Find a point `(x, y)` on a shortest path of changes between
+    `a[a_start:a_end]` and `b[b_start:b_end]` by searching forward from the
+    start and backward from the end at the same time until the paths meet
+    (the "middle snake"). The ranges must be non-empty and must not start or
+    end with equal items.
+
+    Returns a tuple of `(x, y, is_middle)`. If there are more than `max_cost`
+    changes, this gives up and returns the furthest point the forward search
+    reached instead, with `is_middle` set to false.
+    """
+    n = a_end - a_start
+    m = b_end - b_start
+    delta = n - m
+    odd = delta % 2 != 0
+    max_d = (n + m + 1) // 2
+    # Furthest x reached on each diagonal k (where k = x - y), searching
+    # forward and backward. Offset so negative diagonals fit in the list.
+    offset = max_d + 1
+    forward = [-1] * (2 * offset + 1)
+    backward = [-1] * (2 * offset + 1)
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+    # Diagonals that have run off the edge of the grid don't need searching.
+    f_start = f_end = b_start_k = b_end_k = 0
+
+    for d in range(min(max_d, max_cost) + 1):
+        for k in range(-d + f_start, d + 1 - f_end, 2):
+            index = offset + k
+            if k == -d or (k != d and forward[index - 1] < forward[index + 1]):
+                x = forward[index + 1]
+            else:
+                x = forward[index - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_start + x] == b[b_start + y]:
+                x += 1
+                y += 1
+            forward[index] = x
+            if x > n:
+                f_end += 2
+            elif y > m:
+                f_start += 2
+            elif odd:
+                other = offset + delta - k
+                if 0 <= other < len(backward) and backward[other] != -1:
+                    if x >= n - backward[other]:
+                        return a_start + x, b_start + y, True
+
+        for k in range(-d + b_start_k, d + 1 - b_end_k, 2):
+            index = offset + k
+            if k == -d or (k != d
+                           and backward[index - 1] < backward[index + 1]):
+                x = backward[index + 1]
+            else:
+                x = backward[index - 1] + 1
+            y = x - k
+            while (x < n and y < m
+                   and a[a_end - 1 - x] == b[b_end - 1 - y]):
+                x += 1
+                y += 1
+            backward[index] = x
+            if x > n:
+                b_end_k += 2
+            elif y > m:
+                b_start_k += 2
+            elif not odd:
+                other = offset + delta - k
+                if 0 <= other < len(forward) and forward[other] != -1:
+                    forward_x = forward[other]
+                    forward_y = forward_x - (delta - k)
+                    if forward_x >= n - x:
+                        return (a_start + forward_x,
+                                b_start + forward_y, True)
+
+    # Too many changes to find the middle: settle for the point the forward
+    # search got furthest into both sequences.
+    best_x = best_y = 0
+    for k in range(-d + f_start, d + 1 - f_end, 2):
+        x = forward[offset + k]
+        y = x - k
+        if 0 <= x <= n and 0 <= y <= m and x + y > best_x + best_y:
+            best_x, best_y = x, y
+    if best_x + best_y in (0, n + m):
+        # No useful split, so treat the ranges as entirely different.
+        return a_end, b_start, False
+    return a_start + best_x, b_start + best_y, False
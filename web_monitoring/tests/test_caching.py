@@ -0,0 +1,200 @@
+import asyncio
+import tempfile
+from unittest.mock import patch
+from web_monitoring import caching
+from web_monitoring.caching import (CachedResponse, Coalescer, DiskCache,
+                                    FetchCache, LruCache, ResultCache,
+                                    TieredCache)
+from web_monitoring.utils import hash_content
+
+
+class TestLruCache:
+    def test_stores_values(self):
+        cache = LruCache(10)
+        cache.put('a', b'abc')
+        assert cache.get('a') == b'abc'
+        assert cache.get('b') is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_evicts_least_recently_used_values_by_size(self):
+        cache = LruCache(10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        # Reading `a` makes `b` the least recently used.
+        cache.get('a')
+        cache.put('c', b'cccc')
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert cache.size == 8
+        assert cache.evictions == 1
+
+    def test_does_not_store_values_larger_than_max_size(self):
+        cache = LruCache(10)
+        cache.put('a', b'aaaa')
+        assert cache.put('b', b'b' * 11) is False
+        assert 'a' in cache
+        assert 'b' not in cache
+
+    def test_replacing_a_value_updates_size(self):
+        cache = LruCache(10)
+        cache.put('a', b'aaaa')
+        cache.put('a', b'aa')
+        assert cache.size == 2
+        assert len(cache) == 1
+
+
+class TestDiskCache:
+    def test_stores_values(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, 100)
+            cache.put('abcdef', b'some data')
+            assert cache.get('abcdef') == b'some data'
+            assert cache.get('fedcba') is None
+
+            # A new instance should find data from the old one.
+            assert DiskCache(directory, 100).get('abcdef') == b'some data'
+
+    def test_evicts_data_when_full(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = DiskCache(directory, 10)
+            cache.put('aaaa', b'aaaaaa')
+            cache.put('bbbb', b'bbbbbb')
+            assert cache.get('bbbb') == b'bbbbbb'
+            assert cache.get('aaaa') is None
+            assert cache.size <= 10
+            assert cache.evictions == 1
+
+
+class TestTieredCache:
+    def test_promotes_values_from_disk_to_memory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            TieredCache(LruCache(100), DiskCache(directory, 100)).put(
+                'abcdef', b'some data')
+
+            cache = TieredCache(LruCache(100), DiskCache(directory, 100))
+            assert 'abcdef' not in cache.memory
+            assert cache.get('abcdef') == b'some data'
+            assert 'abcdef' in cache.memory
+
+
+class TestFetchCache:
+    def test_looks_up_content_by_url(self):
+        cache = FetchCache(100)
+        cache.put('http://a.com/', CachedResponse('http://a.com/', b'Hello',
+                                                  {'Content-Type': 'text/html'}))
+        response = cache.get('http://a.com/')
+        assert response.body == b'Hello'
+        assert response.headers['content-type'] == 'text/html'
+        assert response.content_hash == hash_content(b'Hello')
+        assert cache.get('http://b.com/') is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_url_index_entries_expire(self):
+        cache = FetchCache(100, index_ttl=60)
+        with patch.object(caching.time, 'monotonic', return_value=1000):
+            cache.put('http://a.com/', CachedResponse('http://a.com/',
+                                                      b'Hello', {}))
+        with patch.object(caching.time, 'monotonic', return_value=1059):
+            assert cache.get('http://a.com/').body == b'Hello'
+        with patch.object(caching.time, 'monotonic', return_value=1060):
+            assert cache.get('http://a.com/') is None
+            # Content can still be found by its hash.
+            response = cache.get('http://a.com/', hash_content(b'Hello'))
+            assert response.body == b'Hello'
+
+    def test_looks_up_content_by_hash(self):
+        cache = FetchCache(100)
+        cache.put('http://a.com/', CachedResponse('http://a.com/', b'Hello', {}))
+        response = cache.get('http://b.com/', hash_content(b'Hello'))
+        assert response.body == b'Hello'
+        assert response.request.url == 'http://b.com/'
+        assert cache.get('http://a.com/', hash_content(b'Goodbye')) is None
+
+    def test_stores_responses_on_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            FetchCache(100, directory=directory).put(
+                'http://a.com/',
+                CachedResponse('http://a.com/', b'Hello',
+                               {'Content-Type': 'text/html'}))
+
+            cache = FetchCache(100, directory=directory)
+            response = cache.get('http://a.com/', hash_content(b'Hello'))
+            assert response.body == b'Hello'
+            assert response.headers['Content-Type'] == 'text/html'
+
+
+class TestResultCache:
+    def test_stores_copies_of_results(self):
+        cache = ResultCache(1000)
+        result = {'change_count': 1, 'diff': [[1, 'Hello']]}
+        cache.put('abc', result)
+        result['version'] = '1.0'
+
+        cached = cache.get('abc')
+        assert cached == {'change_count': 1, 'diff': [[1, 'Hello']]}
+        cached['type'] = 'html_text_dmp'
+        assert 'type' not in cache.get('abc')
+
+    def test_stores_results_on_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ResultCache(1000, directory=directory).put('abc', {'diff': True})
+
+            cache = ResultCache(1000, directory=directory)
+            assert cache.get('abc') == {'diff': True}
+            assert cache.get('def') is None
+            assert cache.stats()['hits'] == 1
+            assert cache.stats()['misses'] == 1
+
+
+class TestCoalescer:
+    def test_concurrent_calls_share_work(self):
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        async def run_all():
+            coalescer = Coalescer()
+            results = await asyncio.gather(
+                coalescer.run('a', lambda: work(1)),
+                coalescer.run('a', lambda: work(2)),
+                coalescer.run('b', lambda: work(3)))
+            assert len(coalescer) == 0
+            assert coalescer.coalesced == 1
+            return results
+
+        assert asyncio.run(run_all()) == [1, 1, 3]
+        assert calls == [1, 3]
+
+    def test_concurrent_calls_share_errors(self):
+        async def work():
+            await asyncio.sleep(0.01)
+            raise ValueError('Oops')
+
+        async def run_all():
+            coalescer = Coalescer()
+            return await asyncio.gather(coalescer.run('a', work),
+                                        coalescer.run('a', work),
+                                        return_exceptions=True)
+
+        results = asyncio.run(run_all())
+        assert all(isinstance(result, ValueError) for result in results)
+
+    def test_later_calls_redo_work(self):
+        calls = []
+
+        async def work():
+            calls.append(1)
+
+        async def run_all():
+            coalescer = Coalescer()
+            await coalescer.run('a', work)
+            await coalescer.run('a', work)
+
+        asyncio.run(run_all())
+        assert len(calls) == 2
@@ -0,0 +1,63 @@
+from pathlib import Path
+import tempfile
+from web_monitoring.content_store import ContentStore
+from web_monitoring.utils import hash_content
+
+
+def store_content(directory, body, shards):
+    content_hash = hash_content(body)
+    path = Path(directory, *shards, content_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(body)
+    return content_hash
+
+
+def test_reads_content_by_hash():
+    with tempfile.TemporaryDirectory() as directory:
+        content_hash = hash_content(b'Hello')
+        store_content(directory, b'Hello', [content_hash[:2]])
+        store = ContentStore(directory)
+
+        response = store.get('http://a.com/', content_hash)
+        assert response.body == b'Hello'
+        assert response.request.url == 'http://a.com/'
+        assert response.content_hash == content_hash
+        assert store.get('http://a.com/', hash_content(b'Goodbye')) is None
+        assert store.stats() == {'hits': 1, 'misses': 1}
+
+
+def test_supports_deeper_sharding():
+    with tempfile.TemporaryDirectory() as directory:
+        content_hash = hash_content(b'Hello')
+        store_content(directory, b'Hello',
+                      [content_hash[:2], content_hash[2:4]])
+
+        assert ContentStore(directory, depth=2).get('', content_hash).body \
+            == b'Hello'
+        assert ContentStore(directory).get('', content_hash) is None
+
+
+def test_reads_empty_content():
+    with tempfile.TemporaryDirectory() as directory:
+        content_hash = hash_content(b'')
+        store_content(directory, b'', [content_hash[:2]])
+        assert ContentStore(directory).get('', content_hash).body == b''
+
+
+def test_ignores_invalid_hashes():
+    with tempfile.TemporaryDirectory() as directory:
+        Path(directory, 'secret').write_bytes(b'Secret')
+        store = ContentStore(directory, depth=0)
+        assert store.get('', 'secret') is None
+        assert store.get('', '../secret') is None
+
+
+def test_verifies_content():
+    with tempfile.TemporaryDirectory() as directory:
+        content_hash = hash_content(b'Hello')
+        Path(directory, content_hash).write_bytes(b'Goodbye')
+
+        assert ContentStore(directory, depth=0).get('', content_hash).body \
+            == b'Goodbye'
+        assert ContentStore(directory, depth=0, verify=True).get(
+            '', content_hash) is None
@@ -59,3 +59,12 @@ def test_get_visible_text():
     html = '<!--First comment--><h1>First Heading</h1><p>First paragraph.</p>'
     actual = wd._get_visible_text(html)
     assert actual == 'First Heading First paragraph.'
+
+
+def test_shared_parses():
+    html = '<p>Hello<!-- A comment --></p>'
+    assert wd.parse_soup(html) is not wd.parse_soup(html)
+    with wd.shared_parses():
+        soup = wd.parse_soup(html)
+        assert wd.parse_soup(html) is soup
+        assert soup.find('p').contents == ['Hello']
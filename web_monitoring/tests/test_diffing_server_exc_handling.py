@@ -1,10 +1,13 @@
+import asyncio
+import hashlib
 import json
 import mimetypes
 import os
 from pathlib import Path
 import re
 import tempfile
-from tornado.testing import AsyncHTTPTestCase
+import time
+from tornado.testing import AsyncHTTPTestCase, gen_test
 from unittest.mock import patch
 import web_monitoring.diffing_server as df
 from web_monitoring.diff_errors import UndecodableContentError
@@ -12,6 +15,7 @@ import web_monitoring
 from tornado.escape import utf8
 from tornado.httpclient import HTTPResponse, AsyncHTTPClient
 from tornado.httputil import HTTPHeaders
+from tornado.ioloop import IOLoop
 from io import BytesIO
 
 
@@ -82,6 +86,60 @@ class DiffingServerHealthCheckHandlingTest(DiffingServerTestCase):
         self.assertEqual(response.code, 200)
 
 
+class DiffingServerMetricsTest(DiffingServerTestCase):
+
+    def test_metrics(self):
+        self.fetch('/html_source_dmp?'
+                   f'a=file://{fixture_path("empty.txt")}&'
+                   f'b=file://{fixture_path("empty.txt")}')
+        self.fetch('/not_a_differ?'
+                   f'a=file://{fixture_path("empty.txt")}&'
+                   f'b=file://{fixture_path("empty.txt")}')
+
+        response = self.fetch('/metrics')
+        assert response.code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+        body = response.body.decode()
+        assert re.search(r'^diff_requests_total\{differ="html_source_dmp",'
+                         r'code="200"\} \d+$', body, re.MULTILINE)
+        assert re.search(r'^diff_requests_total\{differ="unknown",'
+                         r'code="404"\} \d+$', body, re.MULTILINE)
+        assert 'diff_phase_duration_seconds_count{phase="compute"}' in body
+        assert 'diff_phase_duration_seconds_count{phase="diff"}' in body
+        assert 'diff_pool_workers{pool="default"} 10' in body
+        assert 'diff_cache_misses_total{cache="result"} 1' in body
+        assert 'diff_cache_size_bytes{cache="fetch",tier="memory"} 0' in body
+
+
+class DiffingServerTimingTest(DiffingServerTestCase):
+
+    def test_server_timing_header(self):
+        response = self.fetch('/html_text_dmp?'
+                              f'a=file://{fixture_path("unknown_encoding.html")}&'
+                              f'b=file://{fixture_path("unknown_encoding.html")}')
+        assert response.code == 200
+        timings = dict(entry.split(';dur=') for entry in
+                       response.headers['Server-Timing'].split(', '))
+        for phase in ('fetch', 'queue', 'compute', 'encoding', 'decode',
+                      'parse', 'match', 'diff', 'total'):
+            assert float(timings[phase]) >= 0
+        assert 'timing' not in json.loads(response.body)
+
+    def test_debug_timing(self):
+        response = self.fetch('/multi?differs=length,html_source_dmp&'
+                              'debug_timing=true&'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+        assert response.code == 200
+        timing = json.loads(response.body)['timing']
+        assert timing['total'] >= timing['compute'] >= timing['diff']
+        # The parameter shouldn't be passed on to differs or affect caching.
+        response = self.fetch('/html_source_dmp?'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+        assert self._app.settings['result_cache'].stats()['hits'] == 1
+
+
 class DiffingServerFetchTest(DiffingServerTestCase):
 
     def test_pass_headers(self):
@@ -107,6 +165,476 @@ class DiffingServerFetchTest(DiffingServerTestCase):
             assert b_headers.get('Authorization') == 'Bearer xyz'
             assert b_headers.get('Accept') != 'application/json'
 
+    def test_large_content_is_rejected(self):
+        mock = MockAsyncHttpClient()
+        chunks = []
+        with patch.object(df, 'client', wraps=mock), \
+                patch.object(df, 'MAX_BODY_SIZE', 2000):
+            mock.respond_to(r'/a$', body='<p>Hello</p>')
+            mock.respond_to(r'/b$', body='<p>Hello</p>' * 1000)
+
+            # Record how much of the body was read before giving up.
+            original_on_chunk = df.StreamedResponse.on_chunk
+
+            def on_chunk(stream, chunk):
+                chunks.append(chunk)
+                original_on_chunk(stream, chunk)
+
+            with patch.object(df.StreamedResponse, 'on_chunk', on_chunk):
+                response = self.fetch('/length?'
+                                      'a=https://example.org/a&'
+                                      'b=https://example.org/b')
+
+        assert response.code == 413
+        assert json.loads(response.body)['type'] == 'CONTENT_TOO_LARGE'
+        assert sum(len(chunk) for chunk in chunks) < 4000
+
+    def test_non_html_content_is_rejected_early_for_html_differs(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello</p>',
+                            headers={'Content-Type': 'text/html'})
+            mock.respond_to(r'/b$', body='%PDF-1.4' + 'x' * 10000,
+                            headers={'Content-Type': 'text/plain'})
+
+            response = self.fetch('/html_token?'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b')
+            assert response.code == 422
+            assert json.loads(response.body)['type'] == 'NOT_HTML'
+
+            # Differs that don't need HTML can still use the content.
+            response = self.fetch('/length?'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b')
+            assert response.code == 200
+
+            # And HTML differs can be told not to check.
+            response = self.fetch('/html_token?content_type_options=ignore&'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b')
+            assert response.code == 200
+
+    def test_streamed_content_is_hashed(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello' * 1000)
+
+            response = self.fetch('/identical_bytes?'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/a&'
+                                  'a_hash=abc')
+            assert response.code == 502
+            assert json.loads(response.body)['actual_hash'] == \
+                hashlib.sha256(b'Hello' * 1000).hexdigest()
+
+
+class DiffingServerFetchCacheTest(DiffingServerTestCase):
+
+    def test_repeated_diffs_are_fetched_once(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello')
+            mock.respond_to(r'/b$', body='Goodbye')
+
+            for _ in range(2):
+                response = self.fetch('/html_source_dmp?'
+                                      'a=https://example.org/a&'
+                                      'b=https://example.org/b')
+                assert response.code == 200
+
+            assert mock.fetch_count == 2
+            stats = self._app.settings['fetch_cache'].stats()
+            assert stats['hits'] == 2
+            assert stats['misses'] == 2
+
+    def test_expired_urls_are_fetched_again(self):
+        mock = MockAsyncHttpClient()
+        self._app.settings['fetch_cache'].index_ttl = 0.1
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello')
+            mock.respond_to(r'/b$', body='Goodbye')
+            url = ('/identical_bytes?'
+                   'a=https://example.org/a&b=https://example.org/b')
+
+            self.fetch(url)
+            self.fetch(url)
+            assert mock.fetch_count == 2
+
+            time.sleep(0.1)
+            response = self.fetch(url)
+            assert response.code == 200
+            assert mock.fetch_count == 4
+
+    def test_cached_content_is_found_by_hash(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello')
+            mock.respond_to(r'/b$', body='Hello')
+
+            self.fetch('/identical_bytes?'
+                       'a=https://example.org/a&b=https://example.org/a')
+            # `b` has the same content as `a`, so should not be fetched.
+            response = self.fetch('/identical_bytes?'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b&'
+                                  'b_hash=185f8db32271fe25f561a6fc938b2e264306ec304eda518007d1764826381969')
+            assert response.code == 200
+            assert json.loads(response.body)['diff'] is True
+            assert 'https://example.org/b' not in mock.requests
+
+    def test_mismatched_hashes_are_checked_against_fresh_content(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello')
+
+            self.fetch('/identical_bytes?'
+                       'a=https://example.org/a&b=https://example.org/a')
+            response = self.fetch('/identical_bytes?'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/a&'
+                                  'b_hash=abc')
+            assert response.code == 502
+            assert json.loads(response.body)['type'] == 'HASH_MISMATCH'
+            assert mock.fetch_count == 2
+
+
+class DiffingServerContentStoreTest(DiffingServerTestCase):
+
+    def test_content_is_read_from_store(self):
+        mock = MockAsyncHttpClient()
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(df, 'client', wraps=mock):
+            self._app.settings['content_store'] = df.ContentStore(directory)
+            content_hash = hashlib.sha256(b'Hello').hexdigest()
+            path = Path(directory, content_hash[:2], content_hash)
+            path.parent.mkdir()
+            path.write_bytes(b'Hello')
+            mock.respond_to(r'/b$', body='Goodbye')
+
+            response = self.fetch('/html_source_dmp?'
+                                  'a=https://example.org/a&'
+                                  f'a_hash={content_hash}&'
+                                  'b=https://example.org/b&'
+                                  f'b_hash={"0" * 64}')
+            # Content that isn't in the store is fetched (and has the wrong
+            # hash here).
+            assert response.code == 502
+            assert json.loads(response.body)['url'] == 'https://example.org/b'
+            assert list(mock.requests) == ['https://example.org/b']
+
+            response = self.fetch('/identical_bytes?'
+                                  'a=https://example.org/a&'
+                                  f'a_hash={content_hash}&'
+                                  'b=https://example.org/a&'
+                                  f'b_hash={content_hash}')
+            assert response.code == 200
+            assert 'https://example.org/a' not in mock.requests
+
+
+class DiffingServerResultCacheTest(DiffingServerTestCase):
+
+    def test_repeated_diffs_are_computed_once(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello')
+            mock.respond_to(r'/b$', body='Goodbye')
+            mock.respond_to(r'/c$', body='Hello')
+
+            first = self.fetch('/html_source_dmp?'
+                               'a=https://example.org/a&'
+                               'b=https://example.org/b')
+            # Same content and parameters, so the result should be reused,
+            # even though `a` comes from a different URL.
+            second = self.fetch('/html_source_dmp?'
+                                'a=https://example.org/c&'
+                                'b=https://example.org/b')
+            # A synonym for the same differ should also reuse the result.
+            third = self.fetch('/html_source_diff?'
+                               'a=https://example.org/c&'
+                               'b=https://example.org/b')
+
+            assert first.code == second.code == third.code == 200
+            assert json.loads(first.body) == json.loads(second.body)
+            assert json.loads(third.body)['type'] == 'html_source_diff'
+            stats = self._app.settings['result_cache'].stats()
+            assert stats['misses'] == 1
+            assert stats['hits'] == 2
+
+    def test_different_parameters_are_not_shared(self):
+        with tempfile.NamedTemporaryFile() as a:
+            with tempfile.NamedTemporaryFile() as b:
+                self.fetch('/html_token?include=combined&'
+                           f'a=file://{a.name}&b=file://{b.name}')
+                response = self.fetch('/html_token?include=all&'
+                                      f'a=file://{a.name}&b=file://{b.name}')
+                assert 'deletions' in json.loads(response.body)
+                stats = self._app.settings['result_cache'].stats()
+                assert stats['misses'] == 2
+                assert stats['hits'] == 0
+
+
+class DiffingServerTransferTest(DiffingServerTestCase):
+
+    def test_large_content_is_transferred_through_files(self):
+        mock = MockAsyncHttpClient()
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.object(df, 'client', wraps=mock), \
+                    patch.object(df, 'TRANSFER_THRESHOLD', 10), \
+                    patch.object(df, 'TRANSFER_DIRECTORY', directory):
+                mock.respond_to(r'/a$', body='Hello there, world!')
+                mock.respond_to(r'/b$', body='Goodbye there, world!')
+
+                response = self.fetch('/html_source_dmp?'
+                                      'a=https://example.org/a&'
+                                      'b=https://example.org/b')
+                assert response.code == 200
+                assert json.loads(response.body)['change_count'] == 2
+                assert os.listdir(directory) == []
+
+
+class DiffingServerSchedulingTest(DiffingServerTestCase):
+
+    def get_app(self):
+        self.pool = df.DiffPool('default', 1, 0)
+        app = super().get_app()
+        app.settings['diff_scheduler'] = df.DiffScheduler(
+            {'default': self.pool}, inline=['length'], timeouts={'slow': 0.5})
+        return app
+
+    def tearDown(self):
+        self.pool.shutdown()
+        super().tearDown()
+
+    def test_cheap_differs_run_inline(self):
+        response = self.fetch('/length?'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+        assert response.code == 200
+        assert json.loads(response.body)['diff'] == 0
+        assert self.pool.stats()['completed'] == 0
+
+    def test_full_pool_responds_with_503(self):
+        # Pretend all the workers are busy.
+        self.pool.running = 1
+        response = self.fetch('/identical_bytes?'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+        self.json_check(response)
+        assert response.code == 503
+        assert json.loads(response.body)['type'] == 'SERVER_BUSY'
+        assert int(response.headers['Retry-After']) >= 1
+
+        self.pool.running = 0
+        response = self.fetch('/identical_bytes?'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+        assert response.code == 200
+
+    def test_slow_diffs_time_out(self):
+        with patch.dict(df.DIFF_ROUTES, {'slow': slow_differ}):
+            response = self.fetch('/slow?'
+                                  f'a=file://{fixture_path("empty.txt")}&'
+                                  f'b=file://{fixture_path("empty.txt")}')
+            self.json_check(response)
+            assert response.code == 504
+            assert json.loads(response.body)['type'] == 'DIFF_TIMEOUT'
+            assert self.pool.stats()['timeouts'] == 1
+
+
+class DiffingServerCoalescingTest(DiffingServerTestCase):
+
+    @gen_test
+    async def test_concurrent_identical_diffs_share_work(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello', delay=0.1)
+            mock.respond_to(r'/b$', body='Goodbye', delay=0.1)
+
+            url = self.get_url('/html_source_dmp?'
+                               'a=https://example.org/a&'
+                               'b=https://example.org/b')
+            responses = await asyncio.gather(self.http_client.fetch(url),
+                                             self.http_client.fetch(url),
+                                             self.http_client.fetch(url))
+
+            assert all(response.code == 200 for response in responses)
+            assert len(set(response.body for response in responses)) == 1
+            assert mock.fetch_count == 2
+            # Two fetches and one diff should have been shared by each of
+            # the two additional requests.
+            assert self._app.settings['coalescer'].coalesced == 6
+
+
+class DiffingServerBatchTest(DiffingServerTestCase):
+
+    def fetch_batch(self, jobs):
+        response = self.fetch('/batch', method='POST', body=json.dumps(jobs))
+        assert response.code == 200
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        results = [json.loads(line) for line in response.body.splitlines()]
+        return sorted(results, key=lambda result: result['index'])
+
+    def test_batch(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/1$', body='One')
+            mock.respond_to(r'/2$', body='Two')
+            mock.respond_to(r'/3$', body='Three')
+
+            results = self.fetch_batch([
+                {'differ': 'identical_bytes',
+                 'a': 'https://example.org/1',
+                 'b': 'https://example.org/2'},
+                {'differ': 'html_source_dmp',
+                 'a': 'https://example.org/2',
+                 'b': 'https://example.org/3',
+                 'params': {'b_hash': 'abc'}},
+                {'differ': 'length',
+                 'a': 'https://example.org/2',
+                 'b': 'https://example.org/3'},
+                {'differ': 'not_a_differ',
+                 'a': 'https://example.org/1',
+                 'b': 'https://example.org/2'},
+            ])
+
+            assert [result['index'] for result in results] == [0, 1, 2, 3]
+            assert results[0]['diff'] is False
+            assert results[0]['type'] == 'identical_bytes'
+            assert results[1]['code'] == 502
+            assert results[1]['type'] == 'HASH_MISMATCH'
+            assert results[2]['diff'] == 2
+            assert results[3]['code'] == 404
+            # Each URL should only have been fetched once.
+            assert mock.fetch_count == 3
+
+    def test_batch_with_missing_urls(self):
+        response = self.fetch('/batch', method='POST', body=json.dumps([
+            {'differ': 'length', 'a': 'https://example.org/1',
+             'b': 'https://example.org/2'},
+            {'differ': 'length'}]))
+        self.json_check(response)
+        assert response.code == 400
+        assert 'Job 1' in json.loads(response.body)['error']
+
+    def test_batch_with_malformed_job(self):
+        for job in ('length',
+                    {'differ': 'length', 'a': 1, 'b': 'https://example.org'},
+                    {'differ': 'length', 'a': 'https://example.org/1',
+                     'b': 'https://example.org/2', 'params': ['include']}):
+            response = self.fetch('/batch', method='POST',
+                                  body=json.dumps([job]))
+            self.json_check(response)
+            assert response.code == 400
+            assert 'job 0' in json.loads(response.body)['error'].lower()
+
+    def test_malformed_batch(self):
+        response = self.fetch('/batch', method='POST', body='{"jobs": []}')
+        self.json_check(response)
+        assert response.code == 400
+
+    def test_batch_requires_post(self):
+        response = self.fetch('/batch')
+        assert response.code == 405
+
+
+class DiffingServerMultiDiffTest(DiffingServerTestCase):
+
+    def test_multi(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello <a href="/x">X</a></p>')
+            mock.respond_to(r'/b$', body='<p>Goodbye <a href="/y">Y</a></p>')
+
+            response = self.fetch('/multi?'
+                                  'differs=html_token,links_json,html_text_dmp&'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b')
+
+            assert response.code == 200
+            body = json.loads(response.body)
+            assert body['type'] == 'multi'
+            results = body['results']
+            assert list(results) == ['html_token', 'links_json',
+                                     'html_text_dmp']
+            assert results['html_token']['type'] == 'html_token'
+            assert 'combined' in results['html_token']
+            assert results['links_json']['change_count'] == 2
+            assert results['html_text_dmp']['diff'][0] == [-1, 'Hello']
+            assert mock.fetch_count == 2
+
+    def test_multi_decodes_each_body_once(self):
+        headers = {'Content-Type': 'text/html; charset=UTF-8'}
+        a = df.MockResponse('https://example.org/a', b'<p>Hello</p>', headers)
+        b = df.MockResponse('https://example.org/b', b'<p>Bye</p>', headers)
+        funcs = {name: df.DIFF_ROUTES[name]
+                 for name in ('html_token', 'links_json', 'html_text_dmp')}
+        with patch.object(df, '_decode_body',
+                          wraps=df._decode_body) as decode_body:
+            results = df.multi_caller(funcs, a, b)
+
+        assert list(results) == list(funcs)
+        assert sorted(call.args[1] for call in decode_body.call_args_list) == [
+            'a', 'b']
+
+    @gen_test
+    async def test_concurrent_multi_diffs_with_synonyms(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='Hello', delay=0.1)
+            mock.respond_to(r'/b$', body='Goodbye', delay=0.1)
+
+            url = self.get_url('/multi?differs={}&'
+                               'a=https://example.org/a&'
+                               'b=https://example.org/b')
+            responses = await asyncio.gather(
+                self.http_client.fetch(url.format('html_source_dmp,length')),
+                self.http_client.fetch(url.format('html_source_diff,length')))
+
+            assert all(response.code == 200 for response in responses)
+            first, second = (json.loads(response.body)['results']
+                             for response in responses)
+            assert first['html_source_dmp']['diff'] == (
+                second['html_source_diff']['diff'])
+            assert first['html_source_dmp']['type'] == 'html_source_dmp'
+            assert second['html_source_diff']['type'] == 'html_source_diff'
+            assert first['length'] == second['length']
+
+    def test_multi_results_are_cached(self):
+        with tempfile.NamedTemporaryFile() as a:
+            with tempfile.NamedTemporaryFile() as b:
+                self.fetch(f'/html_source_dmp?a=file://{a.name}&'
+                           f'b=file://{b.name}')
+                response = self.fetch('/multi?differs=html_source_dmp,length&'
+                                      f'a=file://{a.name}&b=file://{b.name}')
+                results = json.loads(response.body)['results']
+                assert results['html_source_dmp']['change_count'] == 0
+                assert results['length']['diff'] == 0
+                stats = self._app.settings['result_cache'].stats()
+                assert stats['hits'] == 1
+
+    def test_multi_with_undiffable_content(self):
+        response = self.fetch('/multi?differs=html_token,length&'
+                              f'a=file://{fixture_path("simple.pdf")}&'
+                              f'b=file://{fixture_path("simple.pdf")}')
+        assert response.code == 200
+        results = json.loads(response.body)['results']
+        assert results['html_token']['code'] == 422
+        assert results['length']['diff'] == 0
+
+    def test_multi_requires_differs(self):
+        response = self.fetch('/multi?a=https://example.org/a&'
+                              'b=https://example.org/b')
+        self.json_check(response)
+        assert response.code == 400
+
+    def test_multi_with_unknown_differ(self):
+        response = self.fetch('/multi?differs=length,not_a_differ&'
+                              'a=https://example.org/a&'
+                              'b=https://example.org/b')
+        self.json_check(response)
+        assert response.code == 404
+
 
 class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
 
@@ -308,6 +836,11 @@ def mock_diffing_method(c_body):
     return
 
 
+def slow_differ(a_body, b_body):
+    time.sleep(10)
+    return {'diff': None}
+
+
 def fixture_path(fixture):
     return Path(__file__).resolve().parent / 'fixtures' / fixture
 
@@ -335,8 +868,10 @@ class MockAsyncHttpClient(AsyncHTTPClient):
     def __init__(self):
         self.requests = {}
         self.stub_responses = []
+        self.fetch_count = 0
 
-    def respond_to(self, matcher, code=200, body='', headers={}, **kwargs):
+    def respond_to(self, matcher, code=200, body='', headers={}, delay=0,
+                   **kwargs):
         """
         Set up a fake HTTP response. If a request is made and no fake response
         set up with `respond_to()` matches it, an error will be raised.
@@ -355,6 +890,8 @@ class MockAsyncHttpClient(AsyncHTTPClient):
             The response body to send back.
         headers : dict, optional
             Any headers to use for the response.
+        delay : float, optional
+            Number of seconds to wait before responding.
         **kwargs : any, optional
             Additional keyword args to pass to the Tornado Response.
             Reference: http://www.tornadoweb.org/en/stable/httpclient.html#tornado.httpclient.HTTPResponse
@@ -371,16 +908,47 @@ class MockAsyncHttpClient(AsyncHTTPClient):
             'code': code,
             'body': body,
             'headers': headers,
+            'delay': delay,
             'extra': kwargs
         })
 
+    # Size of the chunks to send to a request's `streaming_callback`.
+    chunk_size = 1024
+
     def fetch_impl(self, request, callback):
         stub = self._find_stub(request)
-        buffer = BytesIO(utf8(stub['body']))
+        self.requests[request.url] = request
+        self.fetch_count += 1
+        if stub['delay']:
+            IOLoop.current().call_later(stub['delay'], self._respond, request,
+                                        stub, callback)
+        else:
+            self._respond(request, stub, callback)
+
+    def _respond(self, request, stub, callback):
+        body = utf8(stub['body'])
         headers = HTTPHeaders(stub['headers'])
-        response = HTTPResponse(request, stub['code'], buffer=buffer,
+        # Like Tornado's clients, send the headers and body to callbacks if
+        # the request has them, and report errors they raise as a closed
+        # connection.
+        try:
+            if request.header_callback:
+                request.header_callback(f'HTTP/1.1 {stub["code"]} OK\r\n')
+                for name, value in headers.get_all():
+                    request.header_callback(f'{name}: {value}\r\n')
+                request.header_callback('\r\n')
+            if request.streaming_callback:
+                for index in range(0, len(body), self.chunk_size):
+                    request.streaming_callback(
+                        body[index:index + self.chunk_size])
+                body = b''
+        except Exception:
+            callback(HTTPResponse(request, 599,
+                                  error=ConnectionError('Stream closed')))
+            return
+
+        response = HTTPResponse(request, stub['code'], buffer=BytesIO(body),
                                 headers=headers, **stub['extra'])
-        self.requests[request.url] = request
         callback(response)
 
     def _find_stub(self, request):
@@ -9,10 +9,21 @@ doesn’t break or throw exceptions.
 from pathlib import Path
 from pkg_resources import resource_filename
 import html5_parser
+from lxml import etree
 import pytest
 import re
 from web_monitoring.diff_errors import UndiffableContentError
-from web_monitoring.html_diff_render import html_diff_render
+from web_monitoring.html_diff_render import (html_diff_render,
+                                             _customize_tokens,
+                                             diff_elements,
+                                             _fill_unchanged,
+                                             _find_changed_regions,
+                                             _htmldiff,
+                                             _identify_subtrees,
+                                             _intern_tokens, _items_html,
+                                             _join_diff, _parse_fragment,
+                                             DiffToken,
+                                             parse_html, tokenize, UrlRules)
 
 
 # TODO: extend these to other html differs via parameterization, a la
@@ -299,3 +310,167 @@ def test_html_diff_compound_comparisons_works():
         include='all', url_rules='jsessionid,wayback,wayback_uk')
 
     assert results['change_count'] == 0
+
+
+def test_intern_tokens_follows_token_equality():
+    comparator = UrlRules.get_comparator('wayback')
+    old_tokens = tokenize(
+        '<p>Mars <a href="/web/20171105043925/https://mars.gov/">here</a> '
+        '<img src="/web/20171105043925im_/https://mars.gov/a.jpg"> '
+        '<img src=""></p>', comparator)
+    new_tokens = tokenize(
+        '<p>Mars <a href="/web/20171203125801/https://mars.gov/">here</a> '
+        '<img src="/web/20171203125801im_/https://mars.gov/a.jpg"> '
+        '<img src=""></p>', comparator)
+    old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+
+    assert len(old_ids) == len(old_tokens)
+    for old_id, old_token in zip(old_ids, old_tokens):
+        for new_id, new_token in zip(new_ids, new_tokens):
+            assert (old_id == new_id) == (old_token == new_token)
+
+
+@pytest.mark.parametrize('old_html,new_html', [
+    ('<img src="a.jpg"> <img src="c.jpg">', '<img src="a.jpg" srcset="c.jpg">'),
+    ('<img src="c.jpg"> <img src="a.jpg">', '<img src="a.jpg" srcset="c.jpg">'),
+    ('<img src="a.jpg" srcset="c.jpg">', '<img src="a.jpg"> <img src="c.jpg">'),
+    ('<img src="a.jpg" srcset="c.jpg">', '<img src="c.jpg"> <img src="a.jpg">'),
+])
+def test_intern_tokens_handles_non_transitive_equality(old_html, new_html):
+    # Image B (with a.jpg and c.jpg) matches image A (a.jpg) and image C
+    # (c.jpg), but A does not match C. B should match both, in any order.
+    old_tokens = tokenize(f'<p>{old_html}</p>', None)
+    new_tokens = tokenize(f'<p>{new_html}</p>', None)
+    images = [token for token in old_tokens + new_tokens if token.tag == 'img']
+    assert len(images) == 3
+    assert sum(image == other for image in images for other in images) == 7
+
+    old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+    for old_id, old_token in zip(old_ids, old_tokens):
+        for new_id, new_token in zip(new_ids, new_tokens):
+            assert (old_id == new_id) == (old_token == new_token)
+
+
+def test_find_changed_regions_skips_unchanged_blocks():
+    old = parse_html('<div><p>Same one</p><p>Old words</p><p>Same two</p>'
+                     '</div><footer>Footer</footer>')
+    new = parse_html('<div><p>Same one</p><p>New words</p><p>Same two</p>'
+                     '</div><footer>Footer</footer>')
+    regions = list(_find_changed_regions(old, new))
+    changed = [(old_items, new_items)
+               for unchanged, old_items, new_items in regions
+               if unchanged is None]
+
+    assert changed == [(['Old words'], ['New words'])]
+    assert ''.join(unchanged if isinstance(unchanged, str)
+                   else _items_html(unchanged)
+                   for unchanged, _, _ in regions
+                   if unchanged is not None) == (
+        '<head></head><body><div><p>Same one</p><p></p><p>Same two</p>'
+        '</div><footer>Footer</footer></body>')
+
+
+@pytest.mark.parametrize('old_html,new_html', [
+    ('<ul><li>Same</li> <li>Old</li> <li>Same</li> </ul> ',
+     '<ul><li>Same</li> <li>New</li> <li>Same</li> </ul> '),
+    ('<table><tr><td>Same</td></tr><tr><td>Old</td></tr></table>',
+     '<table><tr><td>Same</td></tr><tr><td>New</td></tr></table>'),
+    ('<div><p>Old</p></div><p>Same</p>\n<p>Same</p> \n',
+     '<div><p>New</p></div><p>Same</p>\n<p>Same</p> \n'),
+])
+def test_diff_elements_copies_unchanged_elements_as_if_parsed(old_html,
+                                                              new_html):
+    old = parse_html(old_html).find('body')
+    new = parse_html(new_html).find('body')
+    _, results = diff_elements(old, new, None)
+    _, diffs, unchanged_runs = _htmldiff(old, new, None)
+
+    assert unchanged_runs
+    for diff_type, parts in diffs.items():
+        expected = _parse_fragment(
+            _join_diff(parts, unchanged_runs, expand=True))
+        result = results[diff_type]
+        assert _items_html([result.text or '', *result]) == (
+            _items_html([expected.text or '', *expected]))
+
+
+def test_fill_unchanged_checks_where_placeholders_were_parsed():
+    new = parse_html('<p><span>Same</span></p>').find('body')
+    unchanged_runs = [[new.find('p/span')]]
+
+    fragment = _parse_fragment('<p><b>New</b> '
+                               '<template data-wm-diff-unchanged="0">'
+                               '</template></p>')
+    assert _fill_unchanged(fragment, new, unchanged_runs)
+    assert _items_html(fragment) == '<p><b>New</b><span>Same</span></p>'
+
+    # The `<b>` is reopened around the placeholder, so `<span>` would have
+    # been parsed inside a new `<b>` instead of directly in the `<p>`.
+    fragment = _parse_fragment('<p><b><i>New</b> '
+                               '<template data-wm-diff-unchanged="0">'
+                               '</template></p>')
+    assert not _fill_unchanged(fragment, new, unchanged_runs)
+
+
+def test_identify_subtrees_matches_identical_elements():
+    old = parse_html('<div><p>Same <em>text</em></p> <p>Old</p></div>')
+    new = parse_html('<div><p>Same <em>text</em></p><p>Old</p></div>')
+    ids = _identify_subtrees(old, new)
+    old_div, new_div = old.find('.//div'), new.find('.//div')
+
+    assert ids[old_div[0][0]] == ids[new_div[0][0]]
+    # The first paragraphs have different tails.
+    assert ids[old_div[0]] != ids[new_div[0]]
+    assert ids[old_div[1]] == ids[new_div[1]]
+    assert ids[old_div] != ids[new_div]
+
+
+def test_html_diff_render_all_matches_individual_views():
+    before = ('<main><p>Some <em>unchanged</em> text.</p>'
+              '<ul><li>One</li><li>Two</li></ul><p>Old ending.</p></main>')
+    after = ('<main><p>Some <em>unchanged</em> text.</p>'
+             '<ul><li>One</li><li>Three</li></ul><p>New ending!</p></main>')
+    results = html_diff_render(before, after, include='all')
+
+    for view in ('combined', 'insertions', 'deletions'):
+        assert results[view] == html_diff_render(before, after,
+                                                 include=view)[view]
+
+
+def test_customize_tokens_adds_spacers_before_each_separatable_tag():
+    tokens = [DiffToken('One', post_tags=['</li>', '<li>', '<p>']),
+              DiffToken('Two', pre_tags=['<span>', '<ul>', '<li>'])]
+    result = _customize_tokens(tokens)
+
+    # The `<li>` and `<p>` move to the start of the next token, which then
+    # gets split before each of its four opening separatable tags.
+    assert [str(token) for token in result] == (
+        ['One'] + ['\nSPACER'] * 12 + ['Two'])
+    assert result[0].post_tags == ['</li>']
+    # Each opening separatable tag starts the tags of the token after it.
+    assert [token.pre_tags for token in result if token.pre_tags] == [
+        ['<li>'], ['<p>', '<span>'], ['<ul>'], ['<li>']]
+
+
+def test_tokenize_handles_deeply_nested_elements():
+    # Deeper than the recursion limit set in `differs.py`.
+    root = element = etree.Element('div')
+    for _ in range(20000):
+        element = etree.SubElement(element, 'span')
+    element.text = 'Deep'
+
+    tokens = tokenize(root, None)
+    assert [str(token) for token in tokens] == ['Deep']
+    assert len(tokens[0].pre_tags) == 20000
+    assert len(tokens[0].post_tags) == 20000
+
+
+def test_html_diff_render_keeps_doctype_and_removes_comments():
+    results = html_diff_render(
+        '<!doctype html><p>Old <!-- note -->words</p>',
+        '<!doctype html><p>New <!-- note -->words</p>',
+        include='all')
+
+    for view in ('combined', 'insertions', 'deletions'):
+        assert results[view].startswith('<!DOCTYPE html>')
+        assert 'note' not in results[view]
@@ -0,0 +1,65 @@
+from web_monitoring.metrics import (call_recording_phases, Counter, Gauge,
+                                    Histogram, phase, recording_phases,
+                                    Registry)
+
+
+def test_counter():
+    registry = Registry()
+    counter = Counter('requests_total', 'Number of requests.',
+                      labels=('code',), registry=registry)
+    counter.inc(code=200)
+    counter.inc(2, code=200)
+    counter.inc(code=404)
+    assert counter.get(code=200) == 3
+    assert registry.render() == (
+        '# HELP requests_total Number of requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{code="200"} 3\n'
+        'requests_total{code="404"} 1\n')
+
+
+def test_gauge_escapes_labels():
+    gauge = Gauge('size', 'Size.', labels=('name',))
+    gauge.set(1.5, name='a "quoted"\nname')
+    assert 'size{name="a \\"quoted\\"\\nname"} 1.5\n' in gauge.render()
+
+
+def test_histogram():
+    histogram = Histogram('duration_seconds', 'Duration.', buckets=(1, 5))
+    histogram.observe(0.5)
+    histogram.observe(3)
+    histogram.observe(10)
+    assert histogram.get() == {'count': 3, 'sum': 13.5}
+    lines = histogram.render().splitlines()
+    assert lines[2:] == [
+        'duration_seconds_bucket{le="1"} 1',
+        'duration_seconds_bucket{le="5"} 2',
+        'duration_seconds_bucket{le="+Inf"} 3',
+        'duration_seconds_sum 13.5',
+        'duration_seconds_count 3',
+    ]
+
+
+def test_recording_phases():
+    with phase('ignored'):
+        pass
+
+    with recording_phases() as phases:
+        with phase('decode'):
+            pass
+        with phase('decode'):
+            pass
+        with phase('diff'):
+            pass
+    assert set(phases) == {'decode', 'diff'}
+    assert all(seconds >= 0 for seconds in phases.values())
+
+
+def test_call_recording_phases():
+    def work(value):
+        with phase('work'):
+            return value * 2
+
+    result, phases = call_recording_phases(work, 2)
+    assert result == 4
+    assert list(phases) == ['work']
@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import os
+import pytest
+import time
+from web_monitoring.scheduling import (DiffPool, DiffScheduler,
+                                       DiffTimeoutError, PoolFullError,
+                                       WorkerDiedError)
+
+
+def sleep_and_return(value, seconds=0.1):
+    time.sleep(seconds)
+    return value
+
+
+class TestDiffPool:
+    def test_runs_tasks_in_order_of_priority(self):
+        pool = DiffPool('test', 1, 5)
+        finished = []
+
+        async def run(value, priority):
+            await pool.run(functools.partial(sleep_and_return, value),
+                           priority=priority)
+            finished.append(value)
+
+        async def run_all():
+            first = asyncio.ensure_future(run('first', 0))
+            await asyncio.sleep(0)
+            await asyncio.gather(first,
+                                 run('low', 5),
+                                 run('high', -5),
+                                 run('normal', 0))
+
+        try:
+            asyncio.run(run_all())
+        finally:
+            pool.shutdown()
+        assert finished == ['first', 'high', 'normal', 'low']
+        assert pool.stats()['completed'] == 4
+        assert pool.running == 0
+
+    def test_rejects_tasks_when_queue_is_full(self):
+        pool = DiffPool('test', 1, 1)
+
+        async def run_all():
+            return await asyncio.gather(
+                pool.run(functools.partial(sleep_and_return, 1)),
+                pool.run(functools.partial(sleep_and_return, 2)),
+                pool.run(functools.partial(sleep_and_return, 3)),
+                return_exceptions=True)
+
+        try:
+            results = asyncio.run(run_all())
+        finally:
+            pool.shutdown()
+        assert results[:2] == [1, 2]
+        assert isinstance(results[2], PoolFullError)
+        assert results[2].retry_after >= 1
+        assert pool.stats()['rejected'] == 1
+
+    def test_cancelled_tasks_leave_the_queue(self):
+        pool = DiffPool('test', 1, 1)
+
+        async def run_all():
+            first = asyncio.ensure_future(
+                pool.run(functools.partial(sleep_and_return, 1)))
+            waiting = asyncio.ensure_future(
+                pool.run(functools.partial(sleep_and_return, 2)))
+            await asyncio.sleep(0)
+            assert pool.queued == 1
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            assert pool.queued == 0
+            return await first
+
+        try:
+            assert asyncio.run(run_all()) == 1
+        finally:
+            pool.shutdown()
+        assert pool.running == 0
+
+
+class TestDiffScheduler:
+    def test_routes_differs_to_pools(self):
+        default = DiffPool('default', 1, 1)
+        slow = DiffPool('slow', 1, 1)
+        scheduler = DiffScheduler({'default': default, 'slow': slow},
+                                  routes={'html_tree': 'slow'},
+                                  inline=['length'],
+                                  priorities={'html_tree': 3})
+
+        assert scheduler.is_inline(['length'])
+        assert not scheduler.is_inline(['length', 'html_token'])
+        assert scheduler.pool_for(['html_token']) is default
+        assert scheduler.pool_for(['length', 'html_tree']) is slow
+        assert scheduler.priority_for(['html_tree']) == 3
+        assert scheduler.priority_for(['html_tree', 'html_token']) == 0
+
+    def test_timeouts(self):
+        scheduler = DiffScheduler({'default': DiffPool('default', 1, 1)},
+                                  timeouts={'html_tree': 30,
+                                            'html_token': None},
+                                  default_timeout=10)
+        assert scheduler.timeout_for(['html_tree']) == 30
+        assert scheduler.timeout_for(['length', 'html_tree']) == 40
+        assert scheduler.timeout_for(['html_tree', 'html_token']) is None
+
+
+def exit_worker():
+    os._exit(1)
+
+
+class TestDiffPoolTimeouts:
+    def test_kills_only_workers_that_time_out(self):
+        pool = DiffPool('test', 2, 5)
+
+        async def run_all():
+            slow = pool.run(functools.partial(sleep_and_return, 'slow', 10),
+                            timeout=0.5)
+            fast = pool.run(functools.partial(sleep_and_return, 'fast', 0.8),
+                            timeout=5)
+            return await asyncio.gather(slow, fast, return_exceptions=True)
+
+        try:
+            start = time.monotonic()
+            results = asyncio.run(run_all())
+            assert time.monotonic() - start < 5
+            assert isinstance(results[0], DiffTimeoutError)
+            assert results[1] == 'fast'
+            assert pool.stats()['timeouts'] == 1
+
+            # The pool should still work.
+            assert asyncio.run(pool.run(
+                functools.partial(sleep_and_return, 'ok', 0))) == 'ok'
+        finally:
+            pool.shutdown()
+
+    def test_timeouts_are_not_counted_as_completed(self):
+        pool = DiffPool('test', 1, 5)
+        try:
+            with pytest.raises(DiffTimeoutError):
+                asyncio.run(pool.run(
+                    functools.partial(sleep_and_return, 'slow', 10),
+                    timeout=1.5))
+            stats = pool.stats()
+            assert stats['completed'] == 0
+            assert stats['failed'] == 1
+            assert stats['timeouts'] == 1
+            # The time limit shouldn't count towards how long tasks take.
+            assert pool.retry_after() == 1
+        finally:
+            pool.shutdown()
+
+    def test_reports_workers_that_die(self):
+        pool = DiffPool('test', 1, 5)
+        try:
+            with pytest.raises(WorkerDiedError):
+                asyncio.run(pool.run(exit_worker))
+            assert pool.running == 0
+        finally:
+            pool.shutdown()
+
+    def test_passes_errors_from_tasks(self):
+        pool = DiffPool('test', 1, 5)
+        try:
+            with pytest.raises(ValueError):
+                asyncio.run(pool.run(functools.partial(int, 'x')))
+            assert asyncio.run(pool.run(functools.partial(int, '5'))) == 5
+        finally:
+            pool.shutdown()
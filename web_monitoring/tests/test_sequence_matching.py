@@ -0,0 +1,79 @@
+import difflib
+import random
+import pytest
+from web_monitoring.sequence_matching import MyersSequenceMatcher
+
+
+def apply_opcodes(a, b, opcodes):
+    "Rebuild `b` from `a` with a list of opcodes, checking they are valid."
+    result = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert (i1, j1) == (i, j)
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+            result.extend(a[i1:i2])
+        else:
+            result.extend(b[j1:j2])
+        i, j = i2, j2
+    assert (i, j) == (len(a), len(b))
+    return result
+
+
+def longest_common_subsequence(a, b):
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in reversed(range(len(a))):
+        for j in reversed(range(len(b))):
+            if a[i] == b[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+    return lengths[0][0]
+
+
+@pytest.mark.parametrize('a,b', [
+    ('', ''),
+    ('abc', ''),
+    ('', 'abc'),
+    ('abc', 'abc'),
+    ('abcdef', 'abxdef'),
+    ('the quick brown fox', 'the quack brown box'),
+])
+def test_opcodes_match_difflib_for_simple_changes(a, b):
+    matcher = MyersSequenceMatcher(a, b)
+    expected = difflib.SequenceMatcher(a=a, b=b, autojunk=False)
+    assert matcher.get_opcodes() == expected.get_opcodes()
+    assert matcher.get_matching_blocks() == [
+        tuple(block) for block in expected.get_matching_blocks()]
+
+
+def test_finds_the_longest_common_subsequence():
+    rng = random.Random(0)
+    for _ in range(500):
+        a = [rng.randint(0, 5) for _ in range(rng.randint(0, 25))]
+        b = [item for item in a if rng.random() < 0.8]
+        b.extend(rng.randint(0, 5) for _ in range(rng.randint(0, 5)))
+        matcher = MyersSequenceMatcher(a, b)
+        assert apply_opcodes(a, b, matcher.get_opcodes()) == b
+        matched = sum(size for _, _, size in matcher.get_matching_blocks())
+        assert matched == longest_common_subsequence(a, b)
+
+
+@pytest.mark.parametrize('anchors', [True, False])
+def test_opcodes_are_valid_when_cost_is_limited(anchors):
+    rng = random.Random(0)
+    for _ in range(500):
+        a = [rng.randint(0, 20) for _ in range(rng.randint(0, 40))]
+        b = [rng.randint(0, 20) for _ in range(rng.randint(0, 40))]
+        for max_cost in (0, 1, 3):
+            matcher = MyersSequenceMatcher(a, b, max_cost=max_cost,
+                                           anchors=anchors)
+            assert apply_opcodes(a, b, matcher.get_opcodes()) == b
+
+
+def test_splits_very_different_sequences_at_unique_anchors():
+    a = list('xxAyyBzzC')
+    b = list('qqAqqqBqqC')
+    matcher = MyersSequenceMatcher(a, b, max_cost=1)
+    assert matcher.get_matching_blocks() == [(2, 2, 1), (5, 6, 1), (8, 9, 1),
+                                             (9, 10, 0)]
@@ -0,0 +1,45 @@
+import os
+import tempfile
+from web_monitoring.caching import CachedResponse
+from web_monitoring.transfer import (receive, run_and_share, SharedBytes,
+                                     worker_responses)
+
+
+def test_shared_bytes():
+    with tempfile.TemporaryDirectory() as directory:
+        shared = SharedBytes.create(b'Hello', directory)
+        assert shared.read() == b'Hello'
+        shared.remove()
+        assert not os.path.exists(shared.path)
+
+        assert SharedBytes.create(b'', directory).read() == b''
+
+
+def test_worker_responses():
+    response = CachedResponse('http://a.com/', b'Hello',
+                              {'Content-Type': 'text/html',
+                               'Set-Cookie': 'a=b'})
+    with tempfile.TemporaryDirectory() as directory:
+        with worker_responses([response], 1, directory) as (shared,):
+            assert isinstance(shared._body, SharedBytes)
+            assert os.listdir(directory)
+            assert shared.request.url == 'http://a.com/'
+            assert shared.body == b'Hello'
+            assert dict(shared.headers) == {'Content-Type': 'text/html'}
+        # Files should be cleaned up after the context is done.
+        assert not os.listdir(directory)
+
+        with worker_responses([response], 100, directory) as (shared,):
+            assert shared._body == b'Hello'
+            assert not os.listdir(directory)
+
+
+def test_run_and_share():
+    with tempfile.TemporaryDirectory() as directory:
+        result = run_and_share(lambda: {'diff': 'x' * 100}, 10, directory)
+        assert isinstance(result, SharedBytes)
+        assert receive(result) == {'diff': 'x' * 100}
+        assert not os.listdir(directory)
+
+        result = run_and_share(lambda: {'diff': 'x'}, 1000, directory)
+        assert receive(result) == {'diff': 'x'}
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+import tornado.netutil
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from web_monitoring.upstream import CachingResolver, UpstreamClient
+
+
+class CountingResolver(tornado.netutil.Resolver):
+    def initialize(self):
+        self.lookups = 0
+
+    async def resolve(self, host, port, family=0):
+        self.lookups += 1
+        return [(family, ('127.0.0.1', port))]
+
+
+def test_caching_resolver_remembers_lookups():
+    async def resolve():
+        counting = CountingResolver()
+        resolver = CachingResolver(resolver=counting, ttl=10)
+        first = await resolver.resolve('example.com', 80)
+        second = await resolver.resolve('example.com', 80)
+        await resolver.resolve('example.org', 80)
+        return first, second, counting.lookups
+
+    first, second, lookups = asyncio.run(resolve())
+    assert first == second
+    assert lookups == 2
+
+
+def test_http2_requires_curl():
+    with pytest.raises(ValueError):
+        UpstreamClient(backend='simple', http2=True)
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    async def get(self):
+        self.application.settings['state']['running'] += 1
+        state = self.application.settings['state']
+        state['max_running'] = max(state['max_running'], state['running'])
+        await asyncio.sleep(0.05)
+        state['running'] -= 1
+        self.write('Hello')
+
+
+class UpstreamClientTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.state = {'running': 0, 'max_running': 0}
+        return tornado.web.Application([(r'/.*', SlowHandler)],
+                                       state=self.state)
+
+    @gen_test
+    async def test_limits_requests_per_host(self):
+        client = UpstreamClient(max_clients=10, max_per_host=2)
+        try:
+            responses = await asyncio.gather(*(
+                client.fetch(self.get_url(f'/{index}')) for index in range(5)))
+        finally:
+            client.close()
+
+        assert all(response.body == b'Hello' for response in responses)
+        assert self.state['max_running'] == 2
+        assert client.stats() == {'active': 0, 'waiting': 0}
+
+    @gen_test
+    async def test_applies_default_timeouts(self):
+        client = UpstreamClient(request_timeout=0.01)
+        try:
+            with pytest.raises(tornado.httpclient.HTTPClientError):
+                await client.fetch(self.get_url('/'))
+        finally:
+            client.close()
@@ -0,0 +1,182 @@
+"""
+Lean transfer of content and results between the diffing server and the
+worker processes that run differs.
+
+Handing a Tornado `HTTPResponse` to a `ProcessPoolExecutor` pickles the whole
+object (its request, headers, buffer and body) and pushes it through a pipe,
+and large results (rendered HTML diffs are often several megabytes) take the
+same path back. Instead, the server sends a `WorkerResponse`, which has only
+the URL, the body and the `Content-Type` header. Bodies and results that are
+larger than a threshold are written to memory-mapped temporary files
+(`SharedBytes`), so only a file path goes through the pipe.
+
+Files are created in `/dev/shm` where it is available, since it is backed by
+memory rather than by a disk.
+"""
+from contextlib import contextmanager
+import mmap
+import os
+import pickle
+import tempfile
+import tornado.httputil
+
+
+# Prefer a memory-backed filesystem for shared files.
+DEFAULT_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedBytes:
+    """
+    Bytes stored in a temporary file so they can be passed to another process
+    by path. Use `SharedBytes.create()` to make one. The file is not removed
+    automatically; call `remove()` when it's no longer needed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file holding the bytes.
+    size : int
+        Number of bytes in the file.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    @classmethod
+    def create(cls, data, directory=None):
+        "Write bytes to a new temporary file."
+        descriptor, path = tempfile.mkstemp(prefix='wm-diff-',
+                                            dir=directory or DEFAULT_DIRECTORY)
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        return cls(path, len(data))
+
+    def read(self):
+        "Read the bytes from the file."
+        # Empty files can't be memory-mapped.
+        if self.size == 0:
+            return b''
+        with open(self.path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return data[:]
+
+    def remove(self):
+        "Remove the file."
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def share(data, threshold, directory=None):
+    """
+    Get a `SharedBytes` for `data` if it is at least `threshold` bytes long.
+    Otherwise, return `data` as-is. A `threshold` of 0 turns sharing off.
+    """
+    if threshold and len(data) >= threshold:
+        return SharedBytes.create(data, directory)
+    return data
+
+
+class WorkerRequest:
+    "An HTTPRequest-like object for `WorkerResponse`."
+    def __init__(self, url):
+        self.url = url
+
+
+class WorkerResponse:
+    """
+    An HTTPResponse-like object with just enough information for differs.
+    It's cheap to pickle because its body may be a `SharedBytes`, which is
+    only read when the `body` attribute is used.
+
+    Parameters
+    ----------
+    url : str
+    body : bytes or SharedBytes
+    content_type : str, optional
+    """
+    error = None
+
+    def __init__(self, url, body, content_type=None):
+        self.request = WorkerRequest(url)
+        self._body = body
+        self._shared = body if isinstance(body, SharedBytes) else None
+        self.headers = tornado.httputil.HTTPHeaders()
+        if content_type is not None:
+            self.headers['Content-Type'] = content_type
+
+    @classmethod
+    def from_response(cls, response, threshold, directory=None):
+        "Create a `WorkerResponse` from any HTTPResponse-like object."
+        return cls(response.request.url,
+                   share(response.body, threshold, directory),
+                   response.headers.get('Content-Type'))
+
+    @property
+    def body(self):
+        if isinstance(self._body, SharedBytes):
+            self._body = self._shared.read()
+        return self._body
+
+    def remove(self):
+        "Remove the file holding the body, if there is one."
+        if self._shared is not None:
+            self._shared.remove()
+
+
+@contextmanager
+def worker_responses(responses, threshold, directory=None):
+    """
+    A context manager that converts HTTPResponse-like objects to
+    `WorkerResponse` objects for the duration of the context, and cleans up
+    any files they used afterward.
+
+    Parameters
+    ----------
+    responses : sequence of HTTPResponse
+    threshold : int
+        Bodies at least this many bytes long are shared through files. Use
+        0 to never share through files.
+    directory : str, optional
+        Where to create files. Defaults to `/dev/shm` if it exists.
+
+    Yields
+    ------
+    list of WorkerResponse
+    """
+    converted = []
+    try:
+        for response in responses:
+            converted.append(WorkerResponse.from_response(response, threshold,
+                                                          directory))
+        yield converted
+    finally:
+        for response in converted:
+            response.remove()
+
+
+def run_and_share(task, threshold, directory=None):
+    """
+    Call `task` and pickle its result so it can be returned from a worker
+    process. Large results are written to a file (see `share()`). Use
+    `receive()` to get the actual result back.
+    """
+    return share(pickle.dumps(task(), protocol=pickle.HIGHEST_PROTOCOL),
+                 threshold,
+                 directory)
+
+
+def receive(shared):
+    """
+    Get the result of a task run with `run_and_share()` and clean up any file
+    it was stored in.
+    """
+    if isinstance(shared, SharedBytes):
+        try:
+            data = shared.read()
+        finally:
+            shared.remove()
+    else:
+        data = shared
+    return pickle.loads(data)
@@ -0,0 +1,201 @@
+"""
+The HTTP client used to fetch content to diff from upstream servers.
+
+Nearly all the content we diff comes from a handful of hosts (e.g. an S3
+bucket and web.archive.org), so `UpstreamClient` wraps a Tornado
+`AsyncHTTPClient` with settings for that situation: it limits how many
+requests go to each host at once, applies default timeouts, caches DNS
+lookups, and can use the curl backend, which keeps connections alive between
+requests and can speak HTTP/2. (Tornado's default backend opens a new
+connection for each request.)
+
+The curl backend requires the optional `pycurl` package.
+"""
+import asyncio
+import importlib
+import sys
+import time
+import tornado.httpclient
+import tornado.ioloop
+import tornado.netutil
+import tornado.simple_httpclient
+from urllib.parse import urlsplit
+
+
+BACKENDS = ('simple', 'curl')
+
+
+class CachingResolver(tornado.netutil.Resolver):
+    """
+    A DNS resolver that remembers the results of another resolver for a
+    while, so requests to the same host don't each wait on a lookup.
+
+    Parameters
+    ----------
+    resolver : tornado.netutil.Resolver, optional
+        The resolver to cache results from. Defaults to Tornado's default.
+    ttl : float, optional
+        Number of seconds to remember results for.
+    """
+    def initialize(self, resolver=None, ttl=300):
+        self.resolver = resolver or tornado.netutil.Resolver()
+        self.ttl = ttl
+        self._cache = {}
+
+    async def resolve(self, host, port, family=0):
+        key = (host, port, family)
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        result = await self.resolver.resolve(host, port, family)
+        self._cache[key] = (time.monotonic() + self.ttl, result)
+        return result
+
+    def close(self):
+        self.resolver.close()
+        self._cache.clear()
+
+
+class UpstreamClient:
+    """
+    An HTTP client for fetching content from upstream servers. Its `fetch()`
+    method works like `AsyncHTTPClient.fetch()`.
+
+    Parameters
+    ----------
+    backend : str, optional
+        Either `simple` (Tornado's built-in client) or `curl` (requires
+        `pycurl`). Only `curl` reuses connections.
+    max_clients : int, optional
+        Maximum number of requests to make at once. Others wait in a queue.
+    max_per_host : int, optional
+        Maximum number of requests to make to any one host at once. If 0 or
+        `None`, the only limit is `max_clients`.
+    http2 : bool, optional
+        Use HTTP/2 where servers support it. Requires the `curl` backend.
+    dns_cache_ttl : float, optional
+        Number of seconds to cache DNS lookups for. If 0, lookups aren't
+        cached. (The `curl` backend has its own cache, which this sets the
+        duration of.)
+    connect_timeout : float, optional
+        Default number of seconds to wait for a connection.
+    request_timeout : float, optional
+        Default number of seconds to wait for a whole request.
+    max_body_size : int, optional
+        Largest response body the client will read. If 0 or `None`, there's
+        no limit. (Only used by the `simple` backend, which otherwise limits
+        bodies to 100 MB.)
+    """
+    def __init__(self, backend='simple', max_clients=10, max_per_host=None,
+                 http2=False, dns_cache_ttl=300, connect_timeout=20,
+                 request_timeout=20, max_body_size=None):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown HTTP client backend: "{backend}" '
+                             f'(must be one of {", ".join(BACKENDS)})')
+        if http2 and backend != 'curl':
+            raise ValueError('HTTP/2 requires the "curl" backend')
+
+        self.backend = backend
+        self.max_clients = max_clients
+        self.max_per_host = max_per_host
+        self.http2 = http2
+        self.dns_cache_ttl = dns_cache_ttl
+        self.defaults = {'connect_timeout': connect_timeout,
+                         'request_timeout': request_timeout}
+        self.max_body_size = max_body_size
+        self.active = 0
+        self.waiting = 0
+        # Maps host names to a list of the number of requests to that host
+        # (including ones waiting for the host's limit) and a semaphore that
+        # enforces the limit.
+        self._hosts = {}
+        self._client = None
+        if backend == 'curl':
+            # Fail early if pycurl isn't installed.
+            importlib.import_module('tornado.curl_httpclient')
+
+    def _get_client(self):
+        # Tornado clients belong to a single IOLoop, so make a new one if the
+        # current loop has changed (e.g. in tests).
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self._client is None or self._client.io_loop is not io_loop:
+            if self._client is not None:
+                self._client.close()
+            self._client = self._create_client()
+        return self._client
+
+    def _create_client(self):
+        if self.backend == 'curl':
+            from tornado import curl_httpclient
+            defaults = dict(self.defaults,
+                            prepare_curl_callback=self._prepare_curl)
+            return curl_httpclient.CurlAsyncHTTPClient(
+                force_instance=True,
+                max_clients=self.max_clients,
+                defaults=defaults)
+
+        resolver = None
+        if self.dns_cache_ttl:
+            resolver = CachingResolver(ttl=self.dns_cache_ttl)
+        return tornado.simple_httpclient.SimpleAsyncHTTPClient(
+            force_instance=True,
+            max_clients=self.max_clients,
+            resolver=resolver,
+            defaults=self.defaults,
+            max_body_size=self.max_body_size or sys.maxsize)
+
+    def _prepare_curl(self, curl):
+        import pycurl
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, int(self.dns_cache_ttl))
+        if self.http2:
+            curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2_0)
+
+    async def fetch(self, request, **kwargs):
+        """
+        Fetch a URL. Takes the same arguments as `AsyncHTTPClient.fetch()`,
+        but waits first if there are already `max_per_host` requests to the
+        URL's host.
+        """
+        if not self.max_per_host:
+            return await self._fetch(request, **kwargs)
+
+        if isinstance(request, tornado.httpclient.HTTPRequest):
+            host = urlsplit(request.url).netloc
+        else:
+            host = urlsplit(request).netloc
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = [0,
+                                         asyncio.Semaphore(self.max_per_host)]
+        entry[0] += 1
+        try:
+            self.waiting += 1
+            try:
+                await entry[1].acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                return await self._fetch(request, **kwargs)
+            finally:
+                entry[1].release()
+        finally:
+            entry[0] -= 1
+            if entry[0] == 0:
+                del self._hosts[host]
+
+    async def _fetch(self, request, **kwargs):
+        self.active += 1
+        try:
+            return await self._get_client().fetch(request, **kwargs)
+        finally:
+            self.active -= 1
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def stats(self):
+        return {'active': self.active,
+                'waiting': self.waiting}